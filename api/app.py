@@ -5,16 +5,24 @@ from contextlib import asynccontextmanager
 from typing import List
 
 import redis.asyncio as redis
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request, Query
 from fastapi_limiter import FastAPILimiter
 from fastapi_limiter.depends import RateLimiter
-from starlette.responses import StreamingResponse
+from starlette.responses import StreamingResponse, Response, FileResponse
 
+from libs.executors import run_blocking
 from libs.http import OptimizedAsyncClient
-from libs.models import RequestData, RepoCrawlStats
-from libs.rag import answer_query
+from libs.models import RequestData, RepoCrawlStats, ChatQuery
+from libs import admin, admission, metrics, deadline, disconnect, profiling
+from libs.admission import Overloaded
+from libs.deadline import DeadlineExceeded
+from libs.proxies import embeddings, reranker
+from libs.proxies.breaker import CircuitOpen
+from libs.proxies.providers import hf_embeddings, hf_reranker, corcel
+from libs.rag import answer_query, retrieval_cache, answer_cache
 from libs.stats import CrawlStats
-from libs.utils import register_profiling_middleware, async_chain
+from libs.profiling import register_profiling_middleware
+from libs.utils import async_chain
 
 logger = logging.getLogger()
 logger.setLevel(os.environ['LOG_LEVEL'])
@@ -25,14 +33,28 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 redis_url = os.environ['REDIS_URL']
+# Per client, per endpoint
+rate_limit_per_minute = int(os.getenv('RATE_LIMIT_PER_MINUTE', 60))
 
 
 @asynccontextmanager
-async def lifespan(_: FastAPI):
-    """Simple rate limiting layer"""
+async def lifespan(fastapi_app: FastAPI):
+    """Simple rate limiting layer, plus the app-lifetime http connection pool"""
     redis_connection = redis.from_url(redis_url, encoding="utf8")
     await FastAPILimiter.init(redis_connection)
+
+    if os.getenv('EMBEDDINGS_CACHE_REDIS') == 'TRUE':
+        embeddings.query_cache.redis = redis_connection
+
+    # One pooled client for the lifetime of the app, with a dedicated pool for each upstream
+    fastapi_app.state.http_client = OptimizedAsyncClient(
+        hosts={
+            hf_embeddings.url, hf_reranker.url, corcel.url,
+            embeddings.hedger.secondary_url, reranker.hedger.secondary_url
+        }
+    )
     yield
+    await fastapi_app.state.http_client.aclose()
     await FastAPILimiter.close()
 
 
@@ -40,18 +62,17 @@ app = FastAPI(lifespan=lifespan)
 register_profiling_middleware(app)
 
 
-async def get_http_client():
-    """Helper func to keep a client hot"""
-    async with OptimizedAsyncClient() as client:
-        yield client
-        
-        
+async def get_http_client(request: Request) -> OptimizedAsyncClient:
+    """Helper func to keep a client hot, shared across all requests"""
+    return request.app.state.http_client
+
+
 async def get_stats_client():
     """Helper func to keep a client hot"""
     yield CrawlStats()
 
 
-@app.get("/repos/", dependencies=[Depends(RateLimiter(times=60, seconds=60))])
+@app.get("/repos/", dependencies=[Depends(RateLimiter(times=rate_limit_per_minute, seconds=60))])
 async def repos(
         crawl_stats: CrawlStats = Depends(get_stats_client)
 ) -> List[RepoCrawlStats]:
@@ -65,7 +86,7 @@ async def repos(
     """
     start = time.perf_counter()
 
-    all_repos = crawl_stats.get_repos()
+    all_repos = await run_blocking(crawl_stats.get_repos)
 
     time_elapsed = time.perf_counter() - start
     logger.info(f'Retrieved repos in {time_elapsed:.2f} seconds')
@@ -73,9 +94,78 @@ async def repos(
     return all_repos
 
 
-@app.post("/chat/", dependencies=[Depends(RateLimiter(times=60, seconds=60))])
+@app.get("/stats/", dependencies=[Depends(admin.require_admin)])
+async def stats(client: OptimizedAsyncClient = Depends(get_http_client)) -> dict:
+    """Runtime stats for the api process, like the state of the http connection pools."""
+    return {
+        'http': client.pool_stats(),
+        'query_embedding_cache': embeddings.query_cache.stats(),
+        'retrieval_cache': retrieval_cache.stats(),
+        'answer_cache': answer_cache.stats(),
+        'breakers': {
+            'reranker': reranker.breaker.stats(),
+            'embeddings': embeddings.breaker.stats(),
+        },
+        'hedgers': {
+            'reranker': reranker.hedger.stats(),
+            'embeddings': embeddings.hedger.stats(),
+        },
+        'admission': {
+            bulkhead.name: bulkhead.stats()
+            for bulkhead in (admission.chat, admission.llm, admission.reranker,
+                             admission.embeddings)
+        },
+        'metrics': metrics.snapshot(),
+    }
+
+
+@app.get("/metrics", dependencies=[Depends(admin.require_admin)])
+async def prometheus_metrics() -> Response:
+    """All the metrics recorded so far, in the Prometheus text format (e.g. the latency of each
+    stage of answering a query, by repo)."""
+    return Response(
+        content=metrics.render_prometheus(),
+        media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.get("/profiles/", dependencies=[Depends(admin.require_admin)])
+async def profiles() -> List[dict]:
+    """The sampled request profiles kept on disk, newest first."""
+    return await run_blocking(profiling.list_profiles)
+
+
+@app.get("/profiles/merged", dependencies=[Depends(admin.require_admin)])
+async def merged_profiles(ids: List[str] = Query(None)) -> dict:
+    """Several speedscope profiles merged into one, aggregating the requests they profiled.
+
+    Args:
+        ids: (List[str]) the profiles to merge, all the speedscope ones if none are given.
+    """
+    if not ids:
+        ids = [profile['id'] for profile in await run_blocking(profiling.list_profiles)
+               if profile['format'] == 'speedscope']
+
+    try:
+        return await run_blocking(profiling.merge_speedscope, ids)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@app.get("/profiles/{profile_id}", dependencies=[Depends(admin.require_admin)])
+async def profile(profile_id: str) -> FileResponse:
+    """Download a single request profile."""
+    path = profiling.profile_path(profile_id)
+
+    if path is None:
+        raise HTTPException(status_code=404, detail='No such profile')
+
+    return FileResponse(path, filename=profile_id)
+
+
+@app.post("/chat/", dependencies=[Depends(RateLimiter(times=rate_limit_per_minute, seconds=60))])
 async def chat_with_repo(
         request: RequestData,
+        http_request: Request,
         client: OptimizedAsyncClient = Depends(get_http_client)
 ) -> StreamingResponse:
     """Endpoint for chatting with your repo.
@@ -84,29 +174,80 @@ async def chat_with_repo(
 
     Args:
         request: (RequestData) the request.
+        http_request: (Request) the underlying http request, to watch for disconnects.
         client: (OptimizedAsyncClient) the client to use throughout the pipeline.
     """
-    try:
-        start = time.perf_counter()
+    if not isinstance(request.last_message.content, ChatQuery):
+        raise HTTPException(status_code=400, detail='The last message must be a chat query')
+    repo = request.last_message.content.repo
+
+    # Every stage from here on gets its timeout from what's left of the request's budget
+    request_deadline = deadline.start()
 
-        rag_payload = await answer_query(request.last_message, request.history, client)
+    start = time.perf_counter()
+
+    async def answer():
+        # Shed load up front rather than letting every queued request blow its deadline
+        async with admission.chat.slot():
+            rag_payload = await answer_query(request.last_message, request.history, client)
         rag_time_elapsed = time.perf_counter() - start
-        logger.info(f'Got context in {rag_time_elapsed:.2f}s, {len(rag_payload.formatted)} tokens')
+        logger.info(f'Got context in {rag_time_elapsed:.2f}s, {rag_payload.tokens} tokens, '
+                    f'{rag_payload.dropped} docs dropped, degraded={rag_payload.degraded}')
 
         # Wait for the first response chunk. This helps with profiling, exposing real runtime.
         first_chunk_start = time.perf_counter()
-        first_chunk = await rag_payload.stream.__anext__()
+        first_chunk = await deadline.run_stage('first_token', rag_payload.stream.__anext__)
+        request_deadline.mark('ttft')
         logger.info(f'Got first response chunk in {time.perf_counter() - first_chunk_start:.2f}s')
 
+        return rag_payload, first_chunk
+
+    try:
+        # Nobody's waiting for the answer if the client is gone, so stop working on it
+        rag_payload, first_chunk = await disconnect.cancel_on_disconnect(http_request, answer())
+
         logger.info(f'Total query time: {time.perf_counter() - start:.2f}s')
-        return StreamingResponse(
-            async_chain(first_chunk, rag_payload.stream),
-            media_type="text/html"
+        headers = {'Server-Timing': request_deadline.server_timing()}
+        if rag_payload.degraded:
+            # Let the client know which stages were skipped to build the context
+            headers['X-Degraded'] = ','.join(rag_payload.degraded)
+
+        return disconnect.ClosingStreamingResponse(
+            disconnect.track_stream(async_chain(first_chunk, rag_payload.stream), repo),
+            media_type="text/html",
+            headers=headers
         )
 
     except AssertionError:
         raise HTTPException(status_code=400, detail='Not a valid repository')
 
+    except disconnect.ClientDisconnected:
+        # Nginx's "client closed request", nobody's going to see it anyway
+        return Response(status_code=499)
+
+    except DeadlineExceeded as e:
+        logger.warning(f'Failed to process request, {e}: {request_deadline.breakdown()}')
+        raise HTTPException(status_code=504, detail={
+            'message': f'Deadline exceeded at stage {e.stage}',
+            **request_deadline.breakdown()
+        })
+
+    except CircuitOpen as e:
+        logger.warning(f'Failed to process request, {e}')
+        raise HTTPException(status_code=503, detail='An upstream service is unavailable')
+
+    except Overloaded as e:
+        logger.warning(f'Failed to process request, {e}')
+        raise HTTPException(
+            status_code=503,
+            detail='Too many requests in flight, try again later',
+            headers={'Retry-After': str(e.retry_after)})
+
     except Exception:
         logger.exception(f'Failed to process request: {request}')
         raise HTTPException(status_code=500, detail='An error occurred while processing the query')
+
+    finally:
+        # Failed requests too, a stage blowing the deadline is a regression worth seeing. An
+        # invalid repo fails before any stage is recorded, so it can't pollute the labels.
+        deadline.observe(request_deadline, repo)
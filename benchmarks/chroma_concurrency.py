@@ -0,0 +1,110 @@
+"""Concurrency benchmark for the Chroma query step of the /chat/ pipeline.
+
+Fires a burst of concurrent, /chat/-shaped pipelines (embedding round trip, Chroma query,
+first LLM chunk) against a seeded in-memory Chroma collection, whose query is slowed down to
+simulate the latency of the Chroma HTTP server. Each latency level is run twice:
+
+    - inline: the query runs straight on the event loop (what `sim_search` used to do).
+    - offloaded: the query runs through `libs.executors.run_blocking`.
+
+With inline queries the p99 grows linearly with (concurrency x chroma latency), since every
+query stalls the loop for everyone else. Offloaded, p99 stays close to a single query's latency
+as long as the concurrency fits in the storage thread pool.
+
+Usage:
+    python benchmarks/chroma_concurrency.py --concurrency 32 --latencies 0.01 0.05 0.1
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+import uuid
+
+import chromadb
+import numpy as np
+from chromadb.config import Settings
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from libs.executors import run_blocking  # noqa: E402
+
+dimensions = 768
+upstream_latency = 0.05  # embeddings call and time to first LLM chunk, both awaited
+
+
+class SlowCollection:
+    """Wraps a Chroma collection and adds a fixed, blocking delay to every query"""
+
+    def __init__(self, collection, latency):
+        self.collection = collection
+        self.latency = latency
+
+    def query(self, **kwargs):
+        time.sleep(self.latency)
+        return self.collection.query(**kwargs)
+
+
+def seed_collection(size: int):
+    client = chromadb.EphemeralClient(settings=Settings(anonymized_telemetry=False))
+    collection = client.create_collection(name=f'bench-{uuid.uuid4().hex[:8]}')
+    vectors = np.random.default_rng(0).random((size, dimensions), dtype=np.float32)
+
+    for start in range(0, size, 1000):
+        batch = vectors[start:start + 1000]
+        collection.add(
+            ids=[str(idx) for idx in range(start, start + len(batch))],
+            embeddings=batch.tolist(),
+            documents=[f'document {idx}' for idx in range(start, start + len(batch))],
+        )
+
+    return collection
+
+
+async def pipeline(collection: SlowCollection, offload: bool, top_k: int) -> float:
+    start = time.perf_counter()
+    query_embedding = np.random.random(dimensions).tolist()
+
+    await asyncio.sleep(upstream_latency)  # embeddings endpoint
+
+    if offload:
+        await run_blocking(collection.query, query_embeddings=[query_embedding], n_results=top_k)
+    else:
+        collection.query(query_embeddings=[query_embedding], n_results=top_k)
+
+    await asyncio.sleep(upstream_latency)  # first chunk of the LLM stream
+
+    return time.perf_counter() - start
+
+
+def percentile(values, pct):
+    return statistics.quantiles(values, n=100)[pct - 1]
+
+
+async def run(collection, latency, concurrency, offload, top_k):
+    slow_collection = SlowCollection(collection, latency)
+    timings = await asyncio.gather(*(
+        pipeline(slow_collection, offload, top_k) for _ in range(concurrency)
+    ))
+    return percentile(timings, 50), percentile(timings, 99)
+
+
+async def main(args):
+    collection = seed_collection(args.size)
+    print(f'{"latency":>8} {"mode":>10} {"p50":>8} {"p99":>8}')
+
+    for latency in args.latencies:
+        for offload in (False, True):
+            p50, p99 = await run(collection, latency, args.concurrency, offload, args.top_k)
+            mode = 'offloaded' if offload else 'inline'
+            print(f'{latency:>8.3f} {mode:>10} {p50:>8.3f} {p99:>8.3f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--size', type=int, default=5000, help='vectors in the collection')
+    parser.add_argument('--top-k', type=int, default=35)
+    parser.add_argument('--latencies', type=float, nargs='+', default=[0.01, 0.05, 0.1])
+
+    asyncio.run(main(parser.parse_args()))
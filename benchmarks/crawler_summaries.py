@@ -0,0 +1,103 @@
+"""Wall clock benchmark of summarizing a repo's files and snippets, as the crawler does.
+
+Runs `libs.splitting.split_documents` over a synthetic repo (a few large files, plus many
+small ones), with the llm calls replaced by a fixed latency, twice:
+
+    - sequential: the snippets of a file are summarized one after the other, like they used to.
+    - concurrent: up to `--snippet-concurrency` snippets of a file are summarized at once, and
+      up to `--summary-concurrency` summaries across all files.
+
+Sequential, a repo takes about as long as its largest file has snippets (times the latency).
+Concurrent, about `snippets / snippet concurrency` times the latency, as long as the global
+limit isn't the bottleneck. Pass --rate-limited to also go through the proxies' llm rate
+limiter, which caps the summaries per second for real crawls, whatever the concurrency.
+
+Usage:
+    python benchmarks/crawler_summaries.py --files 50 --large-files 3 --large-chunks 40
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+for name in ('HF_API_KEY', 'CORCEL_API_KEY', 'HF_RERANKER_API', 'HF_EMBEDDINGS_API'):
+    os.environ.setdefault(name, 'benchmark')
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from langchain_core.documents import Document  # noqa: E402
+
+from libs import splitting  # noqa: E402
+from libs.models import Repo  # noqa: E402
+from libs.proxies import rate_limiter  # noqa: E402
+
+
+def function_source(name: str, rng: random.Random) -> str:
+    """A python function, about one splitter chunk long"""
+    body = '\n'.join(f'    value_{line} = {name}_input.get("{rng.random():.6f}")'
+                     for line in range(9))
+    return f'def {name}({name}_input):\n{body}\n    return value_0\n'
+
+
+def synthetic_repo(files: int, large_files: int, large_chunks: int, seed: int) -> Repo:
+    rng = random.Random(seed)
+    documents = []
+
+    for file_idx in range(files + large_files):
+        chunks = large_chunks if file_idx < large_files else rng.randint(1, 5)
+        file_path = f'package/module_{file_idx}.py'
+        documents.append(Document(
+            page_content='\n\n'.join(
+                function_source(f'function_{file_idx}_{idx}', rng) for idx in range(chunks)),
+            metadata={'source': file_path, 'file_path': file_path,
+                      'file_name': os.path.basename(file_path)}))
+
+    return Repo(name='benchmark', branch='main', url='', documents=documents, tree='',
+                summary={})
+
+
+async def run(args: argparse.Namespace, snippet_concurrency: int) -> tuple:
+    calls = 0
+
+    async def perform_task(task, client):
+        nonlocal calls
+        calls += 1
+        if args.rate_limited:
+            async with rate_limiter:
+                await asyncio.sleep(args.latency)
+        else:
+            await asyncio.sleep(args.latency)
+        return f'Summary of a {type(task).__name__}'
+
+    splitting.perform_task = perform_task
+    splitting.snippet_summary_concurrency = snippet_concurrency
+    splitting.summary_concurrency = args.summary_concurrency
+
+    repo = synthetic_repo(args.files, args.large_files, args.large_chunks, args.seed)
+    start = time.perf_counter()
+    chunks = await splitting.split_documents(repo, client=None)
+
+    return time.perf_counter() - start, len(chunks), calls
+
+
+def main(args: argparse.Namespace):
+    print(f'{"mode":>10} {"seconds":>8} {"chunks":>7} {"llm calls":>10}')
+
+    for mode, snippet_concurrency in (('sequential', 1), ('concurrent', args.snippet_concurrency)):
+        elapsed, chunks, calls = asyncio.run(run(args, snippet_concurrency))
+        print(f'{mode:>10} {elapsed:>8.2f} {chunks:>7} {calls:>10}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=50, help='small files, 1 to 5 chunks')
+    parser.add_argument('--large-files', type=int, default=3)
+    parser.add_argument('--large-chunks', type=int, default=40)
+    parser.add_argument('--latency', type=float, default=0.5, help='seconds per llm call')
+    parser.add_argument('--snippet-concurrency', type=int, default=8)
+    parser.add_argument('--summary-concurrency', type=int, default=32)
+    parser.add_argument('--rate-limited', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+
+    main(parser.parse_args())
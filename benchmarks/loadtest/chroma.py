@@ -0,0 +1,103 @@
+"""An in-memory Chroma server, seeded with a synthetic collection for every crawl target.
+
+Documents look like the crawler's (a summary per file, plus its code snippets), with the raw
+code kept in the metadata, so the api never needs the blob store. They're embedded with the
+stubs' embeddings, so queries sent through `stubs.py` find related documents.
+
+Usage:
+    python benchmarks/loadtest/chroma.py --port 9101 --files 200 --snippets-per-file 5
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+import chromadb
+import uvicorn
+from chromadb.config import Settings
+from chromadb.server.fastapi import FastAPI
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from libs import crawl_targets  # noqa: E402
+from stubs import embed  # noqa: E402
+
+topics = [
+    'miner', 'validator', 'reward', 'stake', 'subnet', 'query', 'embedding', 'crawler',
+    'config', 'weights', 'axon', 'dendrite', 'synapse', 'prompt', 'dataset', 'scoring',
+    'metagraph', 'wallet', 'registration', 'inference', 'cache', 'protocol', 'chunk', 'stream',
+]
+
+
+def synthetic_documents(rng: random.Random, files: int, snippets_per_file: int):
+    """Yield (id, document, metadata) tuples, shaped like the crawler's"""
+    for file_idx in range(files):
+        file_topics = rng.sample(topics, 3)
+        file_path = f'{file_topics[0]}/{"_".join(file_topics[1:])}_{file_idx}.py'
+        yield (
+            f'{file_path}:summary',
+            f'This file handles the {" and ".join(file_topics)} logic of the project, '
+            f'defining how the {file_topics[0]} deals with {file_topics[1]} updates.',
+            {'document_type': 'file-summary', 'file_path': file_path, 'language': 'python'})
+
+        for snippet_idx in range(snippets_per_file):
+            topic, other = rng.sample(file_topics, 2)
+            code = '\n'.join([
+                f'def {topic}_{other}_{snippet_idx}(self, {other}):',
+                f'    """Update the {topic} given a new {other}"""',
+                *(f'    {topic}_{line} = self.{other}.get({line})' for line in range(12)),
+                f'    return {topic}_0',
+            ])
+            yield (
+                f'{file_path}:{snippet_idx}',
+                f'Updates the {topic} from a {other}, returning the first {topic} value.',
+                {'document_type': 'code-snippet', 'file_path': file_path,
+                 'language': 'python', 'original_page_content': code})
+
+
+def seed(client, files: int, snippets_per_file: int, seed_value: int):
+    for target in crawl_targets:
+        rng = random.Random(f'{seed_value}-{target.repo_id}')
+        ids, documents, metadatas = zip(*synthetic_documents(rng, files, snippets_per_file))
+        collection = client.get_or_create_collection(name=target.target_collection)
+
+        for start in range(0, len(ids), 1000):
+            collection.add(
+                ids=list(ids[start:start + 1000]),
+                documents=list(documents[start:start + 1000]),
+                metadatas=list(metadatas[start:start + 1000]),
+                embeddings=[embed(document) for document in documents[start:start + 1000]])
+
+        print(f'Seeded {target.target_collection} with {len(ids)} documents', flush=True)
+
+
+def main(args: argparse.Namespace):
+    settings = Settings(is_persistent=False, allow_reset=True, anonymized_telemetry=False)
+    server = uvicorn.Server(uvicorn.Config(
+        FastAPI(settings).app(), host=args.host, port=args.port, log_level='warning'))
+    thread = threading.Thread(target=server.run)
+    thread.start()
+
+    while not server.started:
+        time.sleep(0.05)
+
+    client = chromadb.HttpClient(
+        host=args.host, port=args.port, settings=Settings(anonymized_telemetry=False))
+    seed(client, args.files, args.snippets_per_file, args.seed)
+    # Tells whoever started us that the collections are ready
+    print('Chroma ready', flush=True)
+
+    thread.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9101)
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--snippets-per-file', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+
+    main(parser.parse_args())
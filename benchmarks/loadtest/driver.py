@@ -0,0 +1,198 @@
+"""Load driver for the api's /chat/ and /repos/ endpoints.
+
+Runs `--concurrency` workers for `--duration` seconds, each firing requests back to back,
+a `--repos-ratio` fraction of them at /repos/ and the rest at /chat/ (a `--history-ratio`
+fraction of those with a chat history). Reports, per endpoint, the throughput, the p50, p95
+and p99 latency (to the end of the response), the time to first byte (for /chat/, the time
+to the first token) and the error rate, by status.
+
+Results are printed, and written as JSON to `--output` (together with the run's settings and
+the current commit), to diff runs across commits.
+
+Usage:
+    python benchmarks/loadtest/driver.py --url http://127.0.0.1:8080 --concurrency 16 \
+        --duration 30 --output results.json
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict
+
+import httpx
+
+questions = [
+    'How does the miner compute its rewards?',
+    'Where is the validator scoring implemented?',
+    'How are weights set on the metagraph?',
+    'What does the crawler do with the embeddings?',
+    'How do I register a wallet on the subnet?',
+    'How is the stream of synapse responses handled?',
+    'Where is the config for the axon loaded?',
+    'How does the cache get invalidated?',
+]
+follow_ups = ['Can you elaborate on that?', 'Show me an example', 'And what about the stake?']
+
+
+def summarize(values: list) -> dict:
+    if len(values) < 2:
+        return {'p50': values[0], 'p95': values[0], 'p99': values[0], 'mean': values[0]} \
+            if values else {}
+
+    quantiles = statistics.quantiles(values, n=100, method='inclusive')
+    return {
+        'p50': round(quantiles[49], 4),
+        'p95': round(quantiles[94], 4),
+        'p99': round(quantiles[98], 4),
+        'mean': round(statistics.fmean(values), 4),
+    }
+
+
+def chat_payload(rng: random.Random, repos: list, history_ratio: float) -> dict:
+    repo = rng.choice(repos)
+    question = rng.choice(questions)
+    messages = [{'role': 'user', 'content': {'query': question, 'repo': repo}}]
+
+    if rng.random() < history_ratio:
+        messages += [
+            {'role': 'assistant', 'content': {'answer': 'It happens in the forward pass.',
+                                              'repo': repo}},
+            {'role': 'user', 'content': {'query': rng.choice(follow_ups), 'repo': repo}},
+        ]
+
+    return {'messages': messages}
+
+
+class Results:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.ttfb = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+
+    def record(self, endpoint: str, status: str, latency: float, ttfb: float | None):
+        self.statuses[endpoint][status] += 1
+        if status == '200':
+            self.latencies[endpoint].append(latency)
+            if ttfb is not None:
+                self.ttfb[endpoint].append(ttfb)
+
+    def report(self, elapsed: float) -> dict:
+        report = {}
+
+        for endpoint, statuses in self.statuses.items():
+            total = sum(statuses.values())
+            ok = statuses.get('200', 0)
+            report[endpoint] = {
+                'requests': total,
+                'throughput': round(ok / elapsed, 2),
+                'error_rate': round((total - ok) / total, 4) if total else 0.0,
+                'statuses': dict(statuses),
+                'latency': summarize(self.latencies[endpoint]),
+                'ttfb': summarize(self.ttfb[endpoint]),
+            }
+
+        return report
+
+
+async def request(client: httpx.AsyncClient, endpoint: str, payload: dict | None, results):
+    start = time.perf_counter()
+    ttfb = None
+
+    try:
+        if payload is None:
+            async with client.stream('GET', '/repos/') as response:
+                await response.aread()
+        else:
+            async with client.stream('POST', '/chat/', json=payload) as response:
+                async for _ in response.aiter_bytes():
+                    if ttfb is None:
+                        ttfb = time.perf_counter() - start
+        status = str(response.status_code)
+    except httpx.HTTPError as e:
+        status = type(e).__name__
+
+    results.record(endpoint, status, time.perf_counter() - start, ttfb)
+
+
+async def worker(client, args, rng, results, stop_at):
+    while time.perf_counter() < stop_at:
+        if rng.random() < args.repos_ratio:
+            await request(client, 'repos', None, results)
+        else:
+            await request(
+                client, 'chat', chat_payload(rng, args.repos, args.history_ratio), results)
+
+
+def current_commit() -> str | None:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args: argparse.Namespace) -> dict:
+    """Run the load test, returning its results"""
+    results = Results()
+    limits = httpx.Limits(max_connections=args.concurrency)
+
+    async with httpx.AsyncClient(
+            base_url=args.url, limits=limits, timeout=args.timeout) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            worker(client, args, random.Random(args.seed + idx), results, start + args.duration)
+            for idx in range(args.concurrency)
+        ))
+        elapsed = time.perf_counter() - start
+
+    return {
+        'commit': current_commit(),
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'elapsed': round(elapsed, 2),
+        'settings': {key: value for key, value in vars(args).items() if key != 'output'},
+        'endpoints': results.report(elapsed),
+    }
+
+
+def print_report(report: dict):
+    print(f'{"endpoint":>8} {"reqs":>6} {"req/s":>7} {"errors":>7} {"p50":>7} {"p95":>7} '
+          f'{"p99":>7} {"ttfb50":>7} {"ttfb99":>7}')
+
+    for endpoint, stats in report['endpoints'].items():
+        latency, ttfb = stats['latency'], stats['ttfb']
+        print(f'{endpoint:>8} {stats["requests"]:>6} {stats["throughput"]:>7.2f} '
+              f'{stats["error_rate"]:>7.2%} {latency.get("p50", 0):>7.3f} '
+              f'{latency.get("p95", 0):>7.3f} {latency.get("p99", 0):>7.3f} '
+              f'{ttfb.get("p50", 0):>7.3f} {ttfb.get("p99", 0):>7.3f}')
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--repos-ratio', type=float, default=0.1)
+    parser.add_argument('--history-ratio', type=float, default=0.3)
+    parser.add_argument('--repos', nargs='+', default=['subnet-18', 'subnet-19', 'myself'])
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+
+
+def main(args: argparse.Namespace):
+    report = asyncio.run(run(args))
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(report, out, indent=2)
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argument_parser.add_argument('--url', default='http://127.0.0.1:8080')
+    add_arguments(argument_parser)
+
+    sys.exit(main(argument_parser.parse_args()))
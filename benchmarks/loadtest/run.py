@@ -0,0 +1,163 @@
+"""Load test the api offline: start the stub upstreams, a seeded in-memory Chroma and the api
+itself, run the load driver against it, then tear everything down.
+
+Only Redis (for the rate limiter) and MongoDB (for /repos/) aren't stubbed, point the api at
+them with REDIS_URL, MONGO_HOST and MONGO_PORT (defaults to localhost, e.g. from
+`docker compose up redis mongodb`). The api's tuning env vars (e.g. REQUEST_DEADLINE, see
+`tuning_vars`) are passed on to it as is, to benchmark different settings, while everything
+else is left out, so the api never calls (nor sends keys to) a real upstream.
+
+Usage:
+    python benchmarks/loadtest/run.py --concurrency 16 --duration 30 --ttft 0.5 \
+        --tokens-per-second 50 --output results.json
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+import driver
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+here = os.path.dirname(os.path.abspath(__file__))
+
+# What the processes need to run at all
+system_vars = ('PATH', 'HOME', 'LANG', 'LC_ALL', 'TMPDIR', 'VIRTUAL_ENV', 'SYSTEMROOT')
+# Redis and MongoDB, the only upstreams that aren't stubbed
+infra_vars = ('REDIS_URL', 'MONGO_HOST', 'MONGO_PORT')
+# The api's settings that can be benchmarked. No upstream urls or keys, e.g. of the hedgers
+tuning_vars = (
+    'REQUEST_DEADLINE', 'DEADLINE_FIRST_TOKEN_RESERVE', 'STREAM_READ_TIMEOUT',
+    'RATE_LIMIT_PER_MINUTE', 'LOG_LEVEL',
+    'HTTP_MAX_CONNECTIONS', 'HTTP_MAX_CONNECTIONS_PER_HOST', 'HTTP_MAX_KEEPALIVE_CONNECTIONS',
+    'HTTP_MAX_KEEPALIVE_CONNECTIONS_PER_HOST', 'HTTP_KEEPALIVE_EXPIRY',
+    'EMBEDDINGS_CACHE_SIZE', 'EMBEDDINGS_CACHE_TTL', 'EMBEDDINGS_CACHE_REDIS',
+    'EMBEDDINGS_BATCH_MAX_WAIT_MS', 'EMBEDDINGS_BATCH_MAX_SIZE',
+    'RETRIEVAL_CACHE_SIZE', 'RETRIEVAL_CACHE_TTL', 'ANSWER_CACHE_ENABLED',
+    'ANSWER_CACHE_MAX_BYTES', 'ANSWER_CACHE_THRESHOLD', 'BLOB_CACHE_SIZE',
+    'COLLECTION_CACHE_TTL', 'STORAGE_MAX_WORKERS',
+    'SIM_SEARCH_TOP_K', 'SIM_SEARCH_FETCH_K', 'VECTOR_SEARCH_MODE', 'LOCAL_INDEX_QUANTIZE_ABOVE',
+    'ADAPTIVE_CANDIDATES', 'CANDIDATES_DISTANCE_GAP', 'CANDIDATES_DISTANCE_RATIO',
+    'RERANK_MIN_CANDIDATES', 'CONTEXT_TOKEN_BUDGET', 'TOKENIZER_ENCODING',
+    'COMPRESSION_ENABLED', 'COMPRESSION_MIN_LINES', 'COMPRESSION_SUMMARY_OVERLAP',
+    'COMPRESSION_WINDOW_LINES',
+    'REPHRASE_GATE', 'REPHRASE_GATE_MAX_OVERLAP', 'REPHRASE_GATE_MIN_WORDS',
+    'SPECULATIVE_RETRIEVAL', 'SPECULATIVE_REUSE_THRESHOLD', 'SPECULATIVE_WITH_LAST_TURN',
+    'SINGLEFLIGHT_ENABLED', 'SINGLEFLIGHT_SHARE_STREAM',
+    'PROFILING_ENABLED', 'PROFILING_SAMPLE_RATE', 'PROFILING_SLOW_THRESHOLD',
+    'PROFILING_INTERVAL', 'PROFILING_DIR', 'PROFILING_MAX_PROFILES',
+    *(f'{prefix}_{name}' for prefix in ('EMBEDDINGS', 'RERANKER') for name in (
+        'TIMEOUT', 'SLOW_CALL', 'BREAKER_FAILURE_RATE', 'BREAKER_WINDOW', 'BREAKER_MIN_CALLS',
+        'BREAKER_OPEN_FOR', 'HEDGING', 'HEDGING_BUDGET', 'HEDGING_WINDOW',
+        'HEDGING_MIN_SAMPLES')),
+    *(f'ADMISSION_{bulkhead}_{name}' for bulkhead in ('CHAT', 'LLM', 'RERANKER', 'EMBEDDINGS')
+      for name in ('MAX_CONCURRENT', 'MAX_QUEUE', 'MAX_WAIT')),
+)
+
+
+def start(name: str, command: list, env: dict, ready: str = None) -> subprocess.Popen:
+    """Start a process, waiting until it prints `ready`, if given"""
+    process = subprocess.Popen(
+        command, env=env, cwd=root, text=True,
+        stdout=subprocess.PIPE if ready else None, stderr=None)
+
+    if ready:
+        for line in process.stdout:
+            if ready in line:
+                break
+        else:
+            raise RuntimeError(f'{name} exited before being ready')
+
+    return process
+
+
+def wait_for(url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url).raise_for_status()
+            return
+        except httpx.HTTPError:
+            time.sleep(0.25)
+
+    raise TimeoutError(f'{url} not up after {timeout}s')
+
+
+def main(args: argparse.Namespace):
+    stubs_url = f'http://127.0.0.1:{args.stubs_port}'
+    defaults = {
+        'REDIS_URL': 'redis://localhost:6379',
+        'MONGO_HOST': 'localhost',
+        'MONGO_PORT': '27017',
+        'SIM_SEARCH_TOP_K': '35',
+        'LOG_LEVEL': 'WARNING',
+        'RATE_LIMIT_PER_MINUTE': str(10 ** 9),
+        'PROFILING_ENABLED': 'FALSE',
+    }
+    passed_on = {
+        name: os.environ[name]
+        for name in (*system_vars, *infra_vars, *tuning_vars) if name in os.environ
+    }
+    stub_env = {
+        'HF_EMBEDDINGS_API': f'{stubs_url}/embeddings',
+        'HF_RERANKER_API': f'{stubs_url}/rerank',
+        'CORCEL_API_URL': f'{stubs_url}/v1',
+        'HF_API_KEY': 'stub',
+        'CORCEL_API_KEY': 'stub',
+        'OPENAI_API_KEY': 'stub',
+        'CHROMA_HOST': '127.0.0.1',
+        'CHROMA_PORT': str(args.chroma_port),
+        'ANONYMIZED_TELEMETRY': 'FALSE',
+        'PYTHONPATH': root,
+    }
+    # The stubs always win, whatever the environment says
+    env = {**defaults, **passed_on, **stub_env}
+
+    processes = []
+    try:
+        processes.append(start('stubs', [
+            sys.executable, os.path.join(here, 'stubs.py'), '--port', str(args.stubs_port),
+            '--ttft', str(args.ttft), '--tokens-per-second', str(args.tokens_per_second),
+            '--answer-tokens', str(args.answer_tokens),
+            '--embeddings-latency', str(args.embeddings_latency),
+            '--rerank-latency', str(args.rerank_latency)
+        ], env))
+        processes.append(start('chroma', [
+            sys.executable, os.path.join(here, 'chroma.py'), '--port', str(args.chroma_port),
+            '--files', str(args.files), '--seed', str(args.seed)
+        ], env, ready='Chroma ready'))
+        processes.append(start('api', [
+            sys.executable, '-m', 'uvicorn', 'app:app', '--app-dir', os.path.join(root, 'api'),
+            '--port', str(args.api_port), '--log-level', 'warning'
+        ], env))
+
+        wait_for(f'{stubs_url}/docs')
+        wait_for(f'http://127.0.0.1:{args.api_port}/docs')
+
+        args.url = f'http://127.0.0.1:{args.api_port}'
+        driver.main(args)
+
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stubs-port', type=int, default=9100)
+    parser.add_argument('--chroma-port', type=int, default=9101)
+    parser.add_argument('--api-port', type=int, default=9102)
+    parser.add_argument('--files', type=int, default=200, help='files per seeded repo')
+    parser.add_argument('--ttft', type=float, default=0.5, help='llm seconds to first token')
+    parser.add_argument('--tokens-per-second', type=float, default=50)
+    parser.add_argument('--answer-tokens', type=int, default=200)
+    parser.add_argument('--embeddings-latency', type=float, default=0.02)
+    parser.add_argument('--rerank-latency', type=float, default=0.1)
+    driver.add_arguments(parser)
+
+    main(parser.parse_args())
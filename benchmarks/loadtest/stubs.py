@@ -0,0 +1,112 @@
+"""Local stand-ins for the api's paid upstreams, so it can be load tested offline.
+
+Serves, on a single port:
+
+    - POST /embeddings/: the HF embeddings endpoint. Embeddings are hashed bags of words, so
+      texts sharing words end up close to each other, and the same text always gets the same
+      vector (the Chroma seeding in `chroma.py` relies on it).
+    - POST /rerank/: the HF reranker endpoint, scoring documents by word overlap with the query.
+    - POST /v1/text/cortext/chat: the Corcel chat endpoint. Streams the answer as server sent
+      events after `--ttft` seconds, at `--tokens-per-second`, or answers in one go when the
+      request asks for `"stream": false` (like the query rephrasing does), with a canned rephrase.
+
+Usage:
+    python benchmarks/loadtest/stubs.py --port 9100 --ttft 0.5 --tokens-per-second 50
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import re
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+dimensions = 768
+_word = re.compile(r'\w+')
+
+
+def words(text: str) -> list:
+    return _word.findall(text.lower())
+
+
+def embed(text: str) -> list:
+    """A normalized, hashed bag of words"""
+    vector = np.zeros(dimensions, dtype=np.float32)
+
+    for word in words(text):
+        digest = hashlib.blake2b(word.encode(), digest_size=8).digest()
+        bucket = int.from_bytes(digest[:4], 'little') % dimensions
+        vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+
+def overlap(query: str, document: str) -> float:
+    query_words, document_words = set(words(query)), set(words(document))
+    return len(query_words & document_words) / (len(query_words) or 1)
+
+
+def create_app(args: argparse.Namespace) -> FastAPI:
+    app = FastAPI()
+
+    @app.post('/embeddings/')
+    async def embeddings(request: Request):
+        payload = await request.json()
+        await asyncio.sleep(args.embeddings_latency)
+        return [embed(text) for text in payload['inputs']]
+
+    @app.post('/rerank/')
+    async def rerank(request: Request):
+        inputs = (await request.json())['inputs']
+        await asyncio.sleep(args.rerank_latency)
+        scores = [overlap(inputs['query'], document) for document in inputs['documents']]
+        return sorted(
+            ({'corpus_id': idx, 'score': score} for idx, score in enumerate(scores)),
+            key=lambda rank: rank['score'],
+            reverse=True)
+
+    @app.post('/v1/text/cortext/chat')
+    async def chat(request: Request):
+        payload = await request.json()
+        question = payload['messages'][-1]['content']
+
+        if payload.get('stream') is False:
+            await asyncio.sleep(args.ttft)
+            # Good enough for a rephrased query, the last words of the prompt, in the format
+            # the rephraser expects
+            rephrased = ' '.join(words(question)[-12:])
+            return [{'choices': [{'delta': {'content': f'Rephrased: {rephrased}'}}]}]
+
+        async def stream():
+            await asyncio.sleep(args.ttft)
+            for idx in range(args.answer_tokens):
+                event = {'choices': [{'delta': {'content': f'token{idx} '}}]}
+                yield f'data: {json.dumps(event)}\n\n'
+                await asyncio.sleep(1 / args.tokens_per_second)
+            yield 'data: [DONE]\n\n'
+
+        return StreamingResponse(stream(), media_type='text/event-stream')
+
+    return app
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--embeddings-latency', type=float, default=0.02)
+    parser.add_argument('--rerank-latency', type=float, default=0.1)
+    parser.add_argument('--ttft', type=float, default=0.5, help='seconds to the first token')
+    parser.add_argument('--tokens-per-second', type=float, default=50)
+    parser.add_argument('--answer-tokens', type=int, default=200)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    uvicorn.run(create_app(arguments), host=arguments.host, port=arguments.port,
+                log_level='warning')
@@ -0,0 +1,110 @@
+"""Latency and recall benchmark: local vector index vs `Collection.query`.
+
+Seeds a Chroma collection with clustered random vectors (roughly how summaries of the same
+repo area group together), then runs the same queries through:
+
+    - chroma: `collection.query`, the HNSW index behind the Chroma server.
+    - local: `libs.vector_index.LocalVectorIndex`, exact brute force.
+    - local-int8: the same, with the int8 quantized layout.
+
+Recall@k is measured against the exact (float32) results. By default the collection lives in
+an in-process Chroma, which leaves out the HTTP hop and JSON (de)serialization the api pays
+for every query; pass --chroma-host to benchmark against a real Chroma server instead.
+
+Usage:
+    python benchmarks/vector_search.py --size 20000 --queries 200 --top-k 35
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+import uuid
+
+import chromadb
+import numpy as np
+from chromadb.config import Settings
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from libs.vector_index import load_index  # noqa: E402
+
+
+def seed_collection(client, size: int, dimensions: int, rng: np.random.Generator):
+    collection = client.create_collection(name=f'bench-{uuid.uuid4().hex[:8]}')
+    centers = rng.normal(size=(max(size // 50, 1), dimensions))
+    vectors = centers[rng.integers(len(centers), size=size)] + \
+        rng.normal(scale=0.3, size=(size, dimensions))
+
+    for start in range(0, size, 1000):
+        batch = vectors[start:start + 1000]
+        indexes = range(start, start + len(batch))
+        collection.add(
+            ids=[str(idx) for idx in indexes],
+            embeddings=batch.tolist(),
+            documents=[f'summary {idx}' for idx in indexes],
+            metadatas=[{'file_path': f'file_{idx % 100}.py'} for idx in indexes]
+        )
+
+    return collection, centers
+
+
+def timed(func, queries, top_k):
+    timings, results = [], []
+
+    for query in queries:
+        start = time.perf_counter()
+        results.append(func(query_embeddings=[query], n_results=top_k)['ids'][0])
+        timings.append(time.perf_counter() - start)
+
+    return timings, results
+
+
+def recall(results, truth):
+    return statistics.mean(len(set(r) & set(t)) / len(t) for r, t in zip(results, truth))
+
+
+def main(args):
+    rng = np.random.default_rng(0)
+
+    if args.chroma_host:
+        client = chromadb.HttpClient(host=args.chroma_host, port=args.chroma_port,
+                                     settings=Settings(anonymized_telemetry=False))
+    else:
+        client = chromadb.EphemeralClient(settings=Settings(anonymized_telemetry=False))
+
+    collection, centers = seed_collection(client, args.size, args.dimensions, rng)
+    queries = (centers[rng.integers(len(centers), size=args.queries)] +
+               rng.normal(scale=0.3, size=(args.queries, args.dimensions))).tolist()
+
+    local = load_index(collection, quantize=False)
+    local_int8 = load_index(collection, quantize=True)
+    _, truth = timed(local.query, queries, args.top_k)
+
+    print(f'{args.size} vectors x {args.dimensions} dims, {args.queries} queries, '
+          f'top_k={args.top_k}')
+    print(f'{"engine":>12} {"p50 ms":>8} {"p99 ms":>8} {"recall":>8} {"index MB":>9}')
+
+    for name, func, size in (
+            ('chroma', collection.query, None),
+            ('local', local.query, local.nbytes),
+            ('local-int8', local_int8.query, local_int8.nbytes)):
+        timings, results = timed(func, queries, args.top_k)
+        quantiles = statistics.quantiles(timings, n=100)
+        size = f'{size / 2 ** 20:>9.1f}' if size else f'{"-":>9}'
+
+        print(f'{name:>12} {quantiles[49] * 1000:>8.2f} {quantiles[98] * 1000:>8.2f} '
+              f'{recall(results, truth):>8.3f} {size}')
+
+    client.delete_collection(collection.name)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=20_000)
+    parser.add_argument('--dimensions', type=int, default=768)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--top-k', type=int, default=35)
+    parser.add_argument('--chroma-host', default=None)
+    parser.add_argument('--chroma-port', type=int, default=8000)
+
+    main(parser.parse_args())
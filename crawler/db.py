@@ -1,23 +1,114 @@
 import logging
 import os
+from typing import List, Set
 
 import chromadb
+from chromadb.api import ClientAPI
+from chromadb.api.models.Collection import Collection
 from chromadb.config import Settings
 
+from libs import splitting
+
 logger = logging.getLogger(__name__)
 
 
+def connect() -> ClientAPI:
+    return chromadb.HttpClient(
+        host=os.environ['CHROMA_HOST'], port=int(os.environ['CHROMA_PORT']),
+        # todo: check what allow_reset does
+        settings=Settings(allow_reset=True, anonymized_telemetry=False))
+
+
+def get_live_collection(collection_name, emb_func) -> Collection | None:
+    """The published collection, to update in place, or None if there isn't one yet"""
+    db_client = connect()
+
+    if collection_name not in [c.name for c in db_client.list_collections()]:
+        return None
+
+    return db_client.get_collection(name=collection_name, embedding_function=emb_func)
+
+
+def get_file_chunk_ids(collection: Collection, file_paths: List[str]) -> List[str]:
+    """The ids of all the chunks (file summary and snippets) of these files.
+
+    Chunk ids are the `splitting.vecdb_idx_fmt` of the chunk's file path, so a file's chunks
+    are the ones with its path as their id prefix. Chroma can't filter ids by prefix, so this
+    lists them all, which is cheap next to the embeddings of a single chunk.
+
+    Args:
+        collection: (Collection) the collection to look up.
+        file_paths: (list) the paths of the files, relative to the repo root.
+
+    Returns:
+        The ids of the chunks, in the collection's order.
+    """
+    if not file_paths:
+        return []
+
+    prefixes = tuple(
+        splitting.vecdb_idx_fmt.format(source=file_path, index='') for file_path in file_paths)
+
+    return [idx for idx in collection.get(include=[])['ids'] if idx.startswith(prefixes)]
+
+
+def set_revision(collection: Collection, revision: str, repo_summary: str | None = None):
+    """Bump the revision of a collection updated in place, which changes its version (see
+    `libs.storage.collection_version`) for the api to drop anything derived from it.
+
+    Args:
+        collection: (Collection) the collection updated in place.
+        revision: (str) the commit it's now built from.
+        repo_summary: (str) the repo summary its chunks were summarized with, if it changed.
+    """
+    # Chroma refuses any hnsw settings on modify, even unchanged ones
+    metadata = {
+        key: value for key, value in (collection.metadata or {}).items()
+        if not key.startswith('hnsw:')
+    }
+    metadata['revision'] = revision
+    if repo_summary:
+        metadata['repo_summary'] = repo_summary
+
+    collection.modify(metadata=metadata)
+
+
+def get_blob_keys(page_size: int = 5000) -> Set[str]:
+    """The keys of the blobs (see `libs.blobs`) referenced by any collection, temp ones
+    included, as the api or a crawl in progress might still be reading them"""
+    db_client = connect()
+    keys = set()
+
+    for collection in db_client.list_collections():
+        offset = 0
+        while metadatas := collection.get(
+                include=['metadatas'], limit=page_size, offset=offset)['metadatas']:
+            keys.update(metadata['content_hash'] for metadata in metadatas
+                        if metadata and 'content_hash' in metadata)
+            offset += page_size
+
+    return keys
+
+
 class VectorDBCollection:
     """Context manager to handle collection creation/deletion for ChromaDB"""
 
-    def __init__(self, collection_name, emb_func):
+    def __init__(
+            self,
+            collection_name,
+            emb_func,
+            revision: str | None = None,
+            repo_summary: str | None = None,
+    ):
         self.emb_func = emb_func
+        # Kept with the collection, for incremental crawls to build on, see `set_revision`
+        self.metadata = {
+            key: value for key, value in
+            {'revision': revision, 'repo_summary': repo_summary}.items() if value
+        }
         self._main_collection = collection_name
         self._temp_collection = f'{self._main_collection}.temp'
-        self._db_client = chromadb.HttpClient(
-            host=os.environ['CHROMA_HOST'], port=int(os.environ['CHROMA_PORT']),
-            # todo: check what allow_reset does
-            settings=Settings(allow_reset=True, anonymized_telemetry=False))
+        self._db_client = connect()
         logger.info(f'Successfully connected to ChromaDB, heartbeat={self._db_client.heartbeat()}')
 
     def __enter__(self):
@@ -35,7 +126,8 @@ class VectorDBCollection:
         logger.info(f'Creating new {self._temp_collection} collection')
         return self._db_client.create_collection(
             name=self._temp_collection,
-            embedding_function=self.emb_func)
+            embedding_function=self.emb_func,
+            metadata=self.metadata or None)
 
     def __exit__(self, exc_type, exc_value, traceback):
         """Upon exiting, delete the MAIN collection and replace it with the TEMP one."""
@@ -59,5 +151,3 @@ class VectorDBCollection:
 
         logger.info(f'Successfully created new {self._main_collection} '
                     f'with a total vector count of {new_collection.count()}')
-
-
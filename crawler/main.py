@@ -1,15 +1,21 @@
 import asyncio
+import difflib
 import logging
 import os
 import tempfile
+from datetime import datetime, timezone
+
+from chromadb.api.models.Collection import Collection
 
 import db
-from libs import splitting, crawl_targets
+import libs.stats
+from libs import splitting, crawl_targets, blobs
 from libs.http import OptimizedAsyncClient
-from libs.models import RepoCrawlTarget
+from libs.models import Repo, RepoChanges, RepoCrawlTarget
 from libs.proxies import perform_task, summaries
 from libs.proxies.embeddings import HFEmbeddingFunc
-from repository import load_repo, check_if_crawl_needed
+from repository import (
+    load_repo, check_if_crawl_needed, diff_since, list_files_at, load_markdown_at)
 
 log_level = os.environ['LOG_LEVEL']
 logger = logging.getLogger()
@@ -20,63 +26,242 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
+# Only re-crawl the files changed since the last crawled commit, unless the repo summary (built
+# from the root readme and tree) is likely off, see `plan_incremental_crawl`
+incremental_crawl = os.getenv('INCREMENTAL_CRAWL', 'TRUE') == 'TRUE'
+incremental_min_readme_similarity = float(os.getenv('INCREMENTAL_MIN_README_SIMILARITY', 0.8))
+incremental_max_tree_change = float(os.getenv('INCREMENTAL_MAX_TREE_CHANGE', 0.2))
+
+
+def plan_incremental_crawl(repo: Repo, last_crawled_sha: str | None) -> RepoChanges | None:
+    """Figure out which files to re-crawl, if the repo can be crawled incrementally.
+
+    Everything gets re-crawled (i.e. this returns None) when:
+
+    - incremental crawls are off, or the crawl is forced;
+    - the repo wasn't crawled to completion before, or its last crawled commit is gone;
+    - the root readme (expanded with the markdown files it references) changed significantly,
+      or a large part of the tree was added or deleted. Every file and snippet summary builds
+      on the repo summary and tree, so past that, the summaries of the unchanged files are
+      likely off too.
+
+    Args:
+        repo: (Repo) the freshly checked out repo.
+        last_crawled_sha: (str) the commit the live collection was built from, if any.
+
+    Returns:
+        The files changed since the last crawled commit, or None for a full crawl.
+    """
+    if not incremental_crawl or os.getenv('FORCE_CRAWL') == 'TRUE':
+        return None
+
+    if last_crawled_sha is None:
+        logger.info(f'No previously crawled commit for {repo.url}, crawling everything')
+        return None
+
+    changes = diff_since(repo.path, last_crawled_sha)
+    if changes is None:
+        return None
+
+    # Both sides count every tracked file, binaries included, as the diff doesn't tell them apart
+    tree_change = (len(changes.added) + len(changes.deleted)) / max(
+        len(list_files_at(repo.path, last_crawled_sha)), 1)
+    if tree_change > incremental_max_tree_change:
+        logger.info(f'{tree_change:.0%} of the tree of {repo.url} changed since commit '
+                    f'{last_crawled_sha}, crawling everything')
+        return None
+
+    # The repo summary is built from the root readme expanded with the markdown files it
+    # references, so any of them changing can throw it off
+    changed = changes.added + changes.modified + changes.deleted
+    if any(file_path.lower().endswith('.md') for file_path in changed):
+        similarity = difflib.SequenceMatcher(
+            None,
+            expanded_readme_at(repo.path, last_crawled_sha),
+            expanded_readme_at(repo.path, 'HEAD'),
+        ).ratio()
+
+        if similarity < incremental_min_readme_similarity:
+            logger.info(f'Root readme of {repo.url} changed since commit {last_crawled_sha} '
+                        f'(similarity {similarity:.2f}), crawling everything')
+            return None
+
+    logger.info(f'Crawling {repo.url} incrementally since commit {last_crawled_sha}: '
+                f'{len(changes.added)} files added, {len(changes.modified)} modified, '
+                f'{len(changes.deleted)} deleted')
+    return changes
+
+
+def expanded_readme_at(repo_path: str, commit: str) -> str:
+    """The root readme at a commit, expanded like `summarize_repo` does, or empty if missing"""
+    try:
+        return splitting.expand_root_readme(load_markdown_at(repo_path, commit))
+    except (splitting.MissingRootReadme, splitting.MultipleRootReadmes):
+        return ''
+
+
+async def summarize_repo(repo: Repo, client: OptimizedAsyncClient):
+    """Summarize the repo, from its (expanded) root readme and tree"""
+    # Find and expand the root readme file to embed all the other referenced .md files.
+    # This block of (hopefully) high-level repo knowledge is used to perform a repo summary.
+    expanded_readme = splitting.expand_root_readme(repo.documents)
+    repo_summary_task = summaries.SummarizeRepo(
+        content=expanded_readme,
+        repo_name=repo.name,
+        tree=repo.tree,
+    )
+    repo.summary = await perform_task(repo_summary_task, client)
+
+
+async def rebuild_collection(
+        crawl_details: RepoCrawlTarget,
+        repo: Repo,
+        client: OptimizedAsyncClient,
+        emb_func: HFEmbeddingFunc,
+):
+    """Crawl every file of the repo into a new collection, swapped in for the live one"""
+    await summarize_repo(repo, client)
+
+    chunks = await splitting.split_documents(
+        repo=repo,
+        client=client
+    )
+
+    # Keep the vector db lean, the raw code goes to the blob store
+    blobs.offload_raw_content(chunks, blobs.get_store())
+
+    with db.VectorDBCollection(
+            crawl_details.target_collection, emb_func,
+            revision=repo.commit, repo_summary=repo.summary) as vecdb_client:
+        vecdb_client.add(
+            documents=[chunk.page_content for chunk in chunks],
+            metadatas=[chunk.metadata for chunk in chunks],
+            ids=[chunk.metadata['vecdb_idx'] for chunk in chunks],
+
+        )
+
+
+async def update_collection(
+        collection: Collection,
+        repo: Repo,
+        changes: RepoChanges,
+        client: OptimizedAsyncClient,
+):
+    """Crawl only the changed files of the repo, into the live collection.
+
+    The chunks of the added and modified files are upserted first, and only then are the
+    chunks of the deleted files dropped, together with whatever is left over from the modified
+    ones (e.g. a file that now has fewer snippets), so no file goes missing in between.
+
+    The repo summary the collection was built with is reused, `plan_incremental_crawl` only
+    lets through changes too small to throw it off.
+    """
+    stale_ids = db.get_file_chunk_ids(collection, changes.modified + changes.deleted)
+    changed = set(changes.added + changes.modified)
+    # Binary files don't get loaded, nothing to crawl for them
+    documents = [doc for doc in repo.documents if doc.metadata['file_path'] in changed]
+    chunks = []
+
+    if documents:
+        repo.summary = (collection.metadata or {}).get('repo_summary')
+        if not repo.summary:
+            # Collections built before the summary was kept with them, summarized from the
+            # whole repo before narrowing it down to the changed files
+            await summarize_repo(repo, client)
+        repo.documents = documents
+
+        chunks = await splitting.split_documents(
+            repo=repo,
+            client=client
+        )
+        blobs.offload_raw_content(chunks, blobs.get_store())
+
+        collection.upsert(
+            documents=[chunk.page_content for chunk in chunks],
+            metadatas=[chunk.metadata for chunk in chunks],
+            ids=[chunk.metadata['vecdb_idx'] for chunk in chunks],
+        )
+
+    fresh_ids = {chunk.metadata['vecdb_idx'] for chunk in chunks}
+    if leftover_ids := [idx for idx in stale_ids if idx not in fresh_ids]:
+        collection.delete(ids=leftover_ids)
+
+    if not chunks and not leftover_ids:
+        # Nothing the api serves changed, so don't make it drop its caches for nothing
+        logger.info(f'No chunks of {collection.name} changed')
+        return
+
+    db.set_revision(collection, repo.commit, repo_summary=repo.summary or None)
+    logger.info(f'Updated {collection.name} with {len(chunks)} chunks, removed '
+                f'{len(leftover_ids)}, total vector count of {collection.count()}')
+
 
 async def crawl_repo(
         crawl_details: RepoCrawlTarget,
         client: OptimizedAsyncClient,
         emb_func: HFEmbeddingFunc,
+        stats: libs.stats.CrawlStats,
+        started: datetime,
 ):
     """Main crawler function.
 
     This holds most of the crawling logic, while using LLM calls to also summarize various
     entities (the repo itself, files and code snippets).
 
+    If the repo was crawled before, only the files changed since the last crawled commit get
+    summarized and embedded again, see `plan_incremental_crawl`.
+
     Args:
         crawl_details: (RepoCrawlDetails): the details of the repo to crawl (url, branch, etc)
         client (OptimizedAsyncClient): The httpx client to use.
         emb_func (HFEmbeddingFunc): The embedding function to use for crawling.
+        stats (CrawlStats): The crawl stats, to look up and save the crawled commit.
+        started (datetime): when the crawl run started, the blobs stored since are kept.
 
-    Once crawled and processed, insert everything into a chroma collection.
+    Once crawled and processed, insert everything into a chroma collection, and delete the
+    blobs no longer referenced by any collection.
     """
     with tempfile.TemporaryDirectory() as tmp_dir:
         logger.info(f'Loading repository "{crawl_details.url}:{crawl_details.branch}" at {tmp_dir}')
         repo = await load_repo(crawl_details.url, crawl_details.branch, tmp_dir)
 
-        # Find and expand the root readme file to embed all the other referenced .md files.
-        # This block of (hopefully) high-level repo knowledge is used to perform a repo summary.
-        expanded_readme = splitting.expand_root_readme(repo.documents)
-        repo_summary_task = summaries.SummarizeRepo(
-            content=expanded_readme,
-            repo_name=repo.name,
-            tree=repo.tree,
-        )
-        repo_summary = await perform_task(repo_summary_task, client)
-        repo.summary = repo_summary
+        try:
+            last_crawled_sha = stats.get_repo_stats(crawl_details.repo_id).last_crawled_sha
+        except libs.stats.NoStatsFound:
+            last_crawled_sha = None
 
-        chunks = await splitting.split_documents(
-            repo=repo,
-            client=client
-        )
+        collection = db.get_live_collection(crawl_details.target_collection, emb_func)
+        changes = plan_incremental_crawl(repo, last_crawled_sha) if collection else None
+
+        if changes is None:
+            await rebuild_collection(crawl_details, repo, client, emb_func)
+        else:
+            await update_collection(collection, repo, changes, client)
 
-        with db.VectorDBCollection(crawl_details.target_collection, emb_func) as vecdb_client:
-            vecdb_client.add(
-                documents=[chunk.page_content for chunk in chunks],
-                metadatas=[chunk.metadata for chunk in chunks],
-                ids=[chunk.metadata['vecdb_idx'] for chunk in chunks],
+        stats.update_crawled_commit(crawl_details.repo_id, repo.commit)
 
-            )
+    try:
+        # Both the swapped out collection and the chunks updated in place leave blobs behind
+        blobs.get_store().collect_garbage(db.get_blob_keys(), since=started)
+    except Exception:
+        logger.exception(f'Failed to collect the blobs left by {crawl_details.target_collection}:')
 
 
 async def crawl(targets):
     """Helper function to create all crawling tasks (one per repo defined in the yaml file)"""
     client = OptimizedAsyncClient()
     emb_func = HFEmbeddingFunc(client)
+    stats = libs.stats.CrawlStats()
+    # The other repos' crawls run concurrently, their blobs aren't referenced until they're done
+    started = datetime.now(timezone.utc)
 
     tasks = [
         asyncio.create_task(crawl_repo(
             crawl_details=repo_crawl_details,
             client=client,
-            emb_func=emb_func
+            emb_func=emb_func,
+            stats=stats,
+            started=started,
         ))
         async for repo_crawl_details in check_if_crawl_needed(targets, client)
     ]
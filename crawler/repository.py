@@ -4,12 +4,14 @@ from datetime import datetime
 from typing import AsyncGenerator, List
 from urllib.parse import urlparse
 
+import git
 import httpx
 from directory_tree import display_tree
 from langchain_community.document_loaders import GitLoader
+from langchain_core.documents import Document
 
 import libs.stats
-from libs.models import Repo, RepoCrawlStats, RepoCrawlTarget
+from libs.models import Repo, RepoChanges, RepoCrawlStats, RepoCrawlTarget
 from libs.storage import vector_db
 
 logger = logging.getLogger(__name__)
@@ -57,10 +59,77 @@ async def load_repo(url: str, branch, temp_path: str) -> Repo:
         url=url,
         documents=git_loader.load(),
         tree=display_tree(root_path, string_rep=True),
+        path=root_path,
+        commit=git.Repo(root_path).head.commit.hexsha,
     )
     return repo
 
 
+def diff_since(repo_path: str, commit: str) -> RepoChanges | None:
+    """The files changed between a past commit and the checked out one.
+
+    Renames are reported as the old path deleted and the new one added, and any other kind of
+    change (like the file mode) as modified.
+
+    Args:
+        repo_path: (str) where the repo is checked out, with its full history.
+        commit: (str) the sha of the past commit.
+
+    Returns:
+        The changed files, or None if the commit isn't part of the checked out history anymore
+        (e.g. after a force push).
+    """
+    git_repo = git.Repo(repo_path)
+
+    try:
+        output = git_repo.git.diff('--name-status', '--no-renames', '-z', commit, 'HEAD')
+    except git.GitCommandError:
+        logger.exception(f'Failed to diff {repo_path} since commit {commit}:')
+        return None
+
+    changes = RepoChanges()
+    # With -z, the status and the path are separate NUL terminated fields, and the paths
+    # aren't quoted
+    fields = output.strip('\0').split('\0') if output else []
+
+    for status, file_path in zip(fields[::2], fields[1::2]):
+        if status == 'A':
+            changes.added.append(file_path)
+        elif status == 'D':
+            changes.deleted.append(file_path)
+        else:
+            changes.modified.append(file_path)
+
+    return changes
+
+
+def list_files_at(repo_path: str, commit: str) -> List[str]:
+    """The paths of all the files tracked at a commit, binaries included"""
+    output = git.Repo(repo_path).git.ls_tree('-r', '--name-only', '-z', commit)
+    return output.strip('\0').split('\0') if output else []
+
+
+def load_markdown_at(repo_path: str, commit: str) -> List[Document]:
+    """The markdown files at a commit, as documents like the ones `load_repo` gives.
+
+    Args:
+        repo_path: (str) where the repo is checked out, with its full history.
+        commit: (str) the sha of the commit, or any other revision (like HEAD).
+
+    Returns:
+        A document per markdown file, with its path and name in the metadata.
+    """
+    git_repo = git.Repo(repo_path)
+
+    return [
+        Document(
+            page_content=git_repo.git.show(f'{commit}:{file_path}'),
+            metadata={'file_path': file_path, 'file_name': os.path.basename(file_path)},
+        )
+        for file_path in list_files_at(repo_path, commit) if file_path.lower().endswith('.md')
+    ]
+
+
 async def get_repo_metadata(
         crawl: RepoCrawlTarget,
         client: httpx.AsyncClient
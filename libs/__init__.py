@@ -84,3 +84,5 @@ def validate_crawl_targets(targets):
 
 
 crawl_targets = validate_crawl_targets(_crawl_targets)
+# The same targets, looked up by repo id
+crawl_targets_by_id = {target.repo_id: target for target in crawl_targets}
@@ -0,0 +1,37 @@
+"""Gate for the api's operational endpoints (runtime stats, metrics and profiles), which expose
+internals and query data not meant for the public.
+
+They're only served when an `ADMIN_TOKEN` is set, and only to requests carrying it as a
+bearer token (`Authorization: Bearer <token>`), e.g. a Prometheus scrape job configured with
+it. Without a token set, they don't exist as far as clients can tell.
+"""
+import hmac
+import os
+
+from fastapi import HTTPException, Request
+
+admin_token = os.getenv('ADMIN_TOKEN') or None
+
+
+def is_admin(request: Request) -> bool:
+    """Whether the request carries the admin token"""
+    if admin_token is None:
+        return False
+
+    scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(
+        credentials.encode(), admin_token.encode())
+
+
+async def require_admin(request: Request):
+    """Dependency of the admin only endpoints.
+
+    Raises:
+        HTTPException: 404 if there's no admin token set, 401 if the request doesn't carry it.
+    """
+    if admin_token is None:
+        raise HTTPException(status_code=404, detail='Not Found')
+
+    if not is_admin(request):
+        raise HTTPException(
+            status_code=401, detail='Not authorized', headers={'WWW-Authenticate': 'Bearer'})
@@ -0,0 +1,136 @@
+"""Admission control, so a burst of requests can't overwhelm the upstreams.
+
+Each upstream (and the /chat/ pipeline as a whole) sits behind a Bulkhead: a bounded number of
+concurrent calls, plus a short queue of calls waiting for a slot, for a short while. Past
+that, calls are rejected straight away with Overloaded, which the api turns into a 503 with
+a Retry-After, rather than letting every request's latency go up.
+"""
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator
+
+from libs import metrics
+
+logger = logging.getLogger(__name__)
+
+queue_depth = metrics.gauge('admission_queue_depth', 'Calls waiting for a slot, by upstream')
+in_flight = metrics.gauge('admission_in_flight', 'Calls holding a slot, by upstream')
+wait_time = metrics.histogram(
+    'admission_wait_seconds', 'Time spent waiting for a slot, by upstream',
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5))
+rejections = metrics.counter(
+    'admission_rejections_total', 'Calls rejected for lack of capacity, by upstream and reason')
+
+
+class Overloaded(Exception):
+    def __init__(self, upstream: str, reason: str, retry_after: int):
+        super().__init__(f'{upstream} is overloaded ({reason}), retry after {retry_after}s')
+        self.upstream = upstream
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Bulkhead:
+    """Caps the concurrent calls to an upstream, with a bounded queue and a max wait.
+
+    Args:
+        name: (str) the upstream.
+        max_concurrent: (int) how many calls can hold a slot at once.
+        max_queue: (int) how many calls can wait for a slot, the rest are rejected.
+        max_wait: (float) how many seconds a call can wait for a slot.
+    """
+
+    def __init__(self, name: str, max_concurrent: int, max_queue: int, max_wait: float):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._waiting = 0
+        # How long the latest calls held their slot, to tell clients when to come back
+        self._hold_times = deque(maxlen=100)
+
+    @classmethod
+    def from_env(cls, name: str, max_concurrent: int, max_queue: int, max_wait: float):
+        """Build a bulkhead configured by `ADMISSION_{NAME}_*` env vars, falling back to these
+        defaults"""
+        prefix = f'ADMISSION_{name.upper()}'
+        return cls(
+            name=name,
+            max_concurrent=int(os.getenv(f'{prefix}_MAX_CONCURRENT', max_concurrent)),
+            max_queue=int(os.getenv(f'{prefix}_MAX_QUEUE', max_queue)),
+            max_wait=float(os.getenv(f'{prefix}_MAX_WAIT', max_wait)),
+        )
+
+    def retry_after(self) -> int:
+        """Seconds until the queue has likely drained, going by the recent hold times"""
+        if not self._hold_times:
+            return 1
+        mean_hold = sum(self._hold_times) / len(self._hold_times)
+        return max(1, math.ceil(mean_hold * (self._waiting + 1) / self.max_concurrent))
+
+    def _reject(self, reason: str):
+        rejections.inc(upstream=self.name, reason=reason)
+        raise Overloaded(self.name, reason, self.retry_after())
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold a slot for the duration of a call.
+
+        Raises:
+            Overloaded: if the queue is full, or no slot freed up within `max_wait`.
+        """
+        if self._semaphore.locked() and self._waiting >= self.max_queue:
+            self._reject('queue_full')
+
+        start = time.perf_counter()
+        self._waiting += 1
+        queue_depth.inc(upstream=self.name)
+        try:
+            async with asyncio.timeout(self.max_wait):
+                await self._semaphore.acquire()
+        except TimeoutError:
+            self._reject('max_wait')
+        finally:
+            self._waiting -= 1
+            queue_depth.dec(upstream=self.name)
+            wait_time.observe(time.perf_counter() - start, upstream=self.name)
+
+        acquired_at = time.perf_counter()
+        in_flight.inc(upstream=self.name)
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+            in_flight.dec(upstream=self.name)
+            self._hold_times.append(time.perf_counter() - acquired_at)
+
+    async def hold(self, stream: AsyncGenerator) -> AsyncGenerator:
+        """Pass a stream through, holding a slot for as long as it's streaming"""
+        try:
+            async with self.slot():
+                async for chunk in stream:
+                    yield chunk
+        finally:
+            await stream.aclose()
+
+    def stats(self) -> dict:
+        return {
+            'max_concurrent': self.max_concurrent,
+            'waiting': self._waiting,
+            'retry_after': self.retry_after(),
+        }
+
+
+# Whole /chat/ pipelines, and each of the upstreams they call. The crawler shares the proxies
+# but not their bulkheads, the llm's slots are taken by the api's calls (see `libs.rag`)
+chat = Bulkhead.from_env('chat', max_concurrent=128, max_queue=64, max_wait=2)
+llm = Bulkhead.from_env('llm', max_concurrent=64, max_queue=32, max_wait=2)
+reranker = Bulkhead.from_env('reranker', max_concurrent=16, max_queue=32, max_wait=1)
+embeddings = Bulkhead.from_env('embeddings', max_concurrent=32, max_queue=64, max_wait=1)
@@ -0,0 +1,157 @@
+import hashlib
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Dict, List, Set
+
+from langchain_core.documents import Document
+from pymongo import MongoClient, UpdateOne
+
+from libs.caching import LRUCache
+from libs.executors import run_blocking
+
+# Raw content of blobs never changes (the key is its hash), so cached blobs never go stale
+_blob_cache = LRUCache(max_size=int(os.getenv('BLOB_CACHE_SIZE', 4096)))
+_default_store = None
+
+logger = logging.getLogger(__name__)
+
+
+class BlobStore:
+    """Content-addressed store for the raw code of the crawled documents.
+
+    Keeping the raw code out of the vector db metadata means sim search results stay lean, and
+    the raw code only gets fetched for the few documents which make it into the final context.
+    """
+
+    def __init__(self, connection_string: str | None = None):
+        connection_string = connection_string or \
+            f'mongodb://{os.environ["MONGO_HOST"]}:{os.environ["MONGO_PORT"]}/stats'
+
+        self.client = MongoClient(connection_string)
+        self.collection = self.client.get_default_database()['blobs']
+
+    @staticmethod
+    def key(content: str) -> str:
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def put_many(self, contents: List[str]) -> List[str]:
+        """Store a list of blobs, returning their keys. Blobs that already exist only get their
+        `touched_at` bumped, which keeps them from being collected, see `collect_garbage`.
+
+        Args:
+            contents: (List[str]) the raw contents to store.
+
+        Returns:
+            The list of keys, in the same order as the contents.
+        """
+        keys = [self.key(content) for content in contents]
+        touched_at = datetime.now(timezone.utc)
+        operations = {
+            key: UpdateOne(
+                {'_id': key},
+                {'$setOnInsert': {'content': content}, '$set': {'touched_at': touched_at}},
+                upsert=True)
+            for key, content in zip(keys, contents)
+        }
+
+        if operations:
+            self.collection.bulk_write(list(operations.values()), ordered=False)
+
+        return keys
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        """Fetch a list of blobs by key.
+
+        Args:
+            keys: (List[str]) the keys of the blobs.
+
+        Returns:
+            A dict of key -> raw content, for all the blobs found.
+        """
+        return {
+            blob['_id']: blob['content']
+            for blob in self.collection.find({'_id': {'$in': list(set(keys))}})
+        }
+
+    def collect_garbage(self, referenced: Set[str], since: datetime, batch_size: int = 1000) -> int:
+        """Delete the blobs no longer referenced by any collection.
+
+        Blobs stored or re-stored since `since` are kept regardless, as a crawl still in
+        progress might not have published the collection referencing them yet.
+
+        Args:
+            referenced: (Set[str]) the keys of all the blobs the collections still reference.
+            since: (datetime) when the earliest crawl still in progress started.
+            batch_size: (int) how many blobs to delete per call.
+
+        Returns:
+            How many blobs were deleted.
+        """
+        # Blobs from before `touched_at` was kept count as old
+        untouched = {'touched_at': {'$not': {'$gte': since}}}
+        garbage = [
+            blob['_id'] for blob in self.collection.find(untouched, {'_id': 1})
+            if blob['_id'] not in referenced
+        ]
+
+        deleted = 0
+        for start in range(0, len(garbage), batch_size):
+            # Checked again, the blob could have been re-stored in the meantime
+            result = self.collection.delete_many(
+                {'_id': {'$in': garbage[start:start + batch_size]}, **untouched})
+            deleted += result.deleted_count
+
+        logger.info(f'Deleted {deleted} unreferenced blobs, {len(referenced)} still referenced')
+        return deleted
+
+
+def get_store() -> BlobStore:
+    """The process-wide blob store, connected on first use"""
+    global _default_store
+
+    if _default_store is None:
+        _default_store = BlobStore()
+
+    return _default_store
+
+
+def offload_raw_content(documents: List[Document], store: BlobStore):
+    """Move the raw content of the code snippets out of their metadata and into the blob store,
+    keeping just its key (as `content_hash`) in the metadata.
+
+    The raw content of the file summaries is dropped, only the snippets' code makes it into the
+    context (see `hydrate_raw_content`)."""
+    snippets = [doc for doc in documents if doc.metadata['document_type'] == 'code-snippet']
+    keys = store.put_many([doc.metadata.pop('original_page_content') for doc in snippets])
+
+    for doc, key in zip(snippets, keys):
+        doc.metadata['content_hash'] = key
+
+    for doc in documents:
+        doc.metadata.pop('original_page_content', None)
+
+
+async def hydrate_raw_content(documents: List[Document], store: BlobStore):
+    """Put the raw content of the code snippets back into their metadata, fetching from the
+    blob store whatever isn't cached locally yet.
+
+    Documents from collections crawled before the blob store existed still carry their raw
+    content in the metadata, so they're left alone.
+    """
+    to_hydrate = [
+        doc for doc in documents
+        if doc.metadata['document_type'] == 'code-snippet'
+        and 'original_page_content' not in doc.metadata
+    ]
+
+    missing = [
+        doc.metadata['content_hash'] for doc in to_hydrate
+        if _blob_cache.get(doc.metadata['content_hash']) is None
+    ]
+    if missing:
+        for key, content in (await run_blocking(store.get_many, missing)).items():
+            _blob_cache.set(key, content)
+
+    for doc in to_hydrate:
+        doc.metadata['original_page_content'] = _blob_cache.get(doc.metadata['content_hash'], '')
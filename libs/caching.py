@@ -0,0 +1,180 @@
+import re
+import time
+from collections import OrderedDict
+from typing import Any, AsyncGenerator, Callable, Hashable, List
+
+import numpy as np
+
+from libs.models import CachedAnswer
+
+_whitespace = re.compile(r'\s+')
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a user query for use in a cache key, so trivially different spellings of the
+    same question (casing, extra whitespace) end up on the same entry"""
+    return _whitespace.sub(' ', query).strip().lower()
+
+
+class LRUCache:
+    """A bounded, in-process LRU cache with an optional per-entry time to live.
+
+    Not thread-safe, it's meant to be used from within the event loop.
+    """
+
+    def __init__(self, max_size: int, ttl: float | None = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        try:
+            value, expires_at = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def evict(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Evict all the entries whose key matches the predicate, returning how many"""
+        keys = [key for key in self._entries if predicate(key)]
+        for key in keys:
+            del self._entries[key]
+
+        return len(keys)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hit_rate, 4),
+        }
+
+
+class SemanticAnswerCache:
+    """Cache of full streamed answers, looked up by query embedding similarity.
+
+    Answers are bucketed by (repo, collection version), and a lookup returns the closest
+    cached answer in the bucket, as long as its cosine similarity to the query is at least
+    `threshold`. Eviction is LRU, bounded by the total size of the cached answers.
+    """
+
+    def __init__(self, threshold: float, max_bytes: int):
+        self.threshold = threshold
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._next_id = 0
+
+    @staticmethod
+    def _unit(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def lookup(self, repo: str, version: str, embedding: List[float]) -> CachedAnswer | None:
+        candidates = [
+            (entry_id, answer) for entry_id, answer in self._entries.items()
+            if answer.repo == repo and answer.version == version
+        ]
+
+        if candidates:
+            vectors = np.stack([answer.embedding for _, answer in candidates])
+            similarities = vectors @ self._unit(embedding)
+            best = int(np.argmax(similarities))
+
+            if similarities[best] >= self.threshold:
+                entry_id, answer = candidates[best]
+                self._entries.move_to_end(entry_id)
+                self.hits += 1
+                return answer
+
+        self.misses += 1
+        return None
+
+    def store(self, answer: CachedAnswer):
+        answer.embedding = self._unit(answer.embedding)
+
+        self._entries[self._next_id] = answer
+        self._next_id += 1
+        self.size_bytes += answer.size_bytes
+
+        while self.size_bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.size_bytes -= evicted.size_bytes
+
+    def evict_version(self, version: str) -> int:
+        """Evict all the answers built from a given collection version, returning how many"""
+        stale = [
+            entry_id for entry_id, answer in self._entries.items() if answer.version == version]
+        for entry_id in stale:
+            self.size_bytes -= self._entries.pop(entry_id).size_bytes
+
+        return len(stale)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+
+        return {
+            'size': len(self._entries),
+            'size_bytes': self.size_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+async def tee_stream(stream: AsyncGenerator, on_complete: Callable[[List[str]], None]):
+    """Pass a stream through, calling `on_complete` with all of its chunks once (and only if)
+    it has been consumed to the end"""
+    chunks = []
+
+    try:
+        async for chunk in stream:
+            chunks.append(chunk)
+            yield chunk
+
+        on_complete(chunks)
+    finally:
+        # Closing the tee early must close the stream as well, and whatever it holds
+        await stream.aclose()
+
+
+async def replay_stream(chunks: List[str]):
+    """Stream back a previously recorded answer"""
+    for chunk in chunks:
+        yield chunk
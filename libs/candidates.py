@@ -0,0 +1,121 @@
+"""Adaptive selection of the sim search results sent to the reranker.
+
+The cross-encoder's latency grows with the number of candidates, so instead of always sending
+a fixed top_k, the sim search over-fetches, near-duplicates are collapsed, and the list is cut
+where the distances show the relevant results ending: a gap much bigger than the ones before
+it, or results drifting too far from the best one.
+"""
+import logging
+import os
+from typing import List
+
+import numpy as np
+
+from libs import metrics
+
+logger = logging.getLogger(__name__)
+
+adaptive_candidates_enabled = os.getenv('ADAPTIVE_CANDIDATES', 'TRUE') == 'TRUE'
+# Cut where the gap between consecutive distances is this many times the median gap
+candidates_distance_gap = float(os.getenv('CANDIDATES_DISTANCE_GAP', 3.0))
+# Cut where the distance is this much (relative) further than the best candidate's
+candidates_distance_ratio = float(os.getenv('CANDIDATES_DISTANCE_RATIO', 0.5))
+
+candidate_counts = metrics.histogram(
+    'rerank_candidates', 'Candidates fetched, sent to the reranker and kept in the context',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+
+
+def collapse_duplicates(sim_vectors: dict) -> List[int]:
+    """Find the candidates worth reranking, skipping near-duplicates: documents with the same
+    summary, and file summaries of files whose snippets already rank better.
+
+    Args:
+        sim_vectors: (dict) the sim search result, sorted by distance.
+
+    Returns:
+        List[int]: the indexes of the candidates to keep, in the same order.
+    """
+    keep, summaries, files_with_snippets = [], set(), set()
+
+    for idx, (document, metadata) in enumerate(zip(
+            sim_vectors['documents'][0], sim_vectors['metadatas'][0])):
+        summary = ' '.join(document.lower().split())
+        if summary in summaries:
+            continue
+
+        if metadata['document_type'] == 'code-snippet':
+            files_with_snippets.add(metadata['file_path'])
+        elif metadata['file_path'] in files_with_snippets:
+            continue
+
+        summaries.add(summary)
+        keep.append(idx)
+
+    return keep
+
+
+def cut_point(distances: List[float], min_k: int, max_k: int) -> int:
+    """Find how many of the (sorted) candidates to keep, between `min_k` and `max_k`.
+
+    Args:
+        distances: (List[float]) the candidates' distances, ascending.
+        min_k: (int) the least candidates to keep.
+        max_k: (int) the most candidates to keep.
+
+    Returns:
+        int: the number of candidates to keep.
+    """
+    distances = np.asarray(distances[:max_k], dtype=np.float64)
+    if len(distances) <= min_k:
+        return len(distances)
+
+    cut = len(distances)
+
+    # Drifted too far from the best candidate (meaningless for an exact match)
+    if distances[0] > 0:
+        too_far = np.nonzero(distances > distances[0] * (1 + candidates_distance_ratio))[0]
+        if len(too_far):
+            cut = int(too_far[0])
+
+    # A clear gap between the relevant results and the rest
+    gaps = np.diff(distances)
+    median_gap = np.median(gaps)
+    for idx in range(min_k - 1, len(gaps)):
+        if gaps[idx] > candidates_distance_gap * median_gap and gaps[idx] > 0:
+            cut = min(cut, idx + 1)
+            break
+
+    return max(min_k, cut)
+
+
+def select_candidates(sim_vectors: dict, min_k: int, max_k: int) -> dict:
+    """Collapse near-duplicates and cut the sim search results down to the candidates worth
+    sending to the reranker.
+
+    Args:
+        sim_vectors: (dict) the (over-fetched) sim search result, sorted by distance.
+        min_k: (int) the least candidates to send.
+        max_k: (int) the most candidates to send.
+
+    Returns:
+        A sim search result with just the selected candidates.
+    """
+    fetched = len(sim_vectors['ids'][0])
+
+    if not adaptive_candidates_enabled:
+        selected = list(range(min(fetched, max_k)))
+    else:
+        selected = collapse_duplicates(sim_vectors)
+        distances = [sim_vectors['distances'][0][idx] for idx in selected]
+        selected = selected[:cut_point(distances, min_k, max_k)]
+
+    candidate_counts.observe(fetched, stage='fetched')
+    candidate_counts.observe(len(selected), stage='sent')
+    logger.info(f'Sending {len(selected)}/{fetched} candidates to the reranker')
+
+    return {
+        key: [[values[0][idx] for idx in selected]]
+        for key, values in sim_vectors.items()
+        if key in ('ids', 'documents', 'metadatas', 'distances') and values
+    }
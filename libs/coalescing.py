@@ -0,0 +1,199 @@
+import asyncio
+import contextvars
+import logging
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, Hashable
+
+from libs import deadline, metrics
+
+logger = logging.getLogger(__name__)
+
+coalesced_calls = metrics.counter(
+    'coalesced_calls_total',
+    'Calls that joined an identical in-flight call instead of running, by kind')
+
+
+class _Flight:
+    def __init__(self, task: asyncio.Task, flight_deadline: deadline.Deadline | None):
+        self.task = task
+        self.deadline = flight_deadline
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Deduplicates identical concurrent calls.
+
+    The first caller for a key runs the coroutine; everyone else arriving while it's still in
+    flight awaits the very same result (or exception). The call is shielded, so one caller
+    going away doesn't cancel the work for the others, but it is cancelled once they all did.
+
+    The call runs under a deadline of its own, with what's left of the first caller's budget.
+    Its stages are recorded into every caller's deadline, and each caller only waits for as
+    long as its own deadline allows.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._flights: Dict[Hashable, _Flight] = {}
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable]) -> Any:
+        """Run `func`, unless a call with the same key is already in flight.
+
+        Args:
+            key: (Hashable) identifies identical calls.
+            func: (Callable) returns the coroutine to run.
+
+        Returns:
+            The result of the (shared) call.
+        """
+        request_deadline = deadline.current()
+
+        if flight := self._flights.get(key):
+            coalesced_calls.inc(kind=self.name)
+        else:
+            flight = self._flights[key] = self._start(key, func, request_deadline)
+
+        flight.waiters += 1
+        try:
+            async with deadline.stage(f'{self.name}_flight'):
+                return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if request_deadline is not None and flight.deadline is not None:
+                request_deadline.merge(flight.deadline)
+
+            if not flight.waiters and not flight.task.done():
+                logger.info(f'All callers left, cancelling the {self.name} call')
+                flight.task.cancel()
+                self._forget(key, flight)
+
+    def _start(
+            self,
+            key: Hashable,
+            func: Callable[[], Awaitable],
+            request_deadline: deadline.Deadline | None,
+    ) -> _Flight:
+        # Started in a context of its own, so the call doesn't record into (nor time out with)
+        # the first caller's deadline
+        context = contextvars.copy_context()
+        flight_deadline = None
+        if request_deadline is not None:
+            flight_deadline = context.run(deadline.start, request_deadline.remaining())
+
+        flight = _Flight(asyncio.create_task(func(), context=context), flight_deadline)
+        flight.task.add_done_callback(lambda _: self._forget(key, flight))
+        return flight
+
+    def _forget(self, key: Hashable, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def __len__(self):
+        return len(self._flights)
+
+
+class StreamBroadcast:
+    """Fans a single upstream stream out to any number of subscribers.
+
+    Chunks are buffered, so a subscriber joining late replays the stream from the beginning.
+    The upstream is only pulled once, by a pump task started with the first subscriber, and is
+    closed early if every subscriber goes away before it's done.
+    """
+
+    def __init__(self, stream: AsyncGenerator):
+        self._stream = stream
+        self._chunks = []
+        self._done = False
+        self._error = None
+        self._changed = asyncio.Condition()
+        self._pump_task = None
+        self._subscribers = 0
+
+    @property
+    def done(self) -> bool:
+        return self._done
+
+    @property
+    def subscribers(self) -> int:
+        return self._subscribers
+
+    async def _pump(self):
+        try:
+            async for chunk in self._stream:
+                self._chunks.append(chunk)
+                async with self._changed:
+                    self._changed.notify_all()
+        except Exception as e:
+            self._error = e
+        finally:
+            self._done = True
+            await self._stream.aclose()
+            async with self._changed:
+                self._changed.notify_all()
+
+    async def subscribe(self) -> AsyncGenerator:
+        if self._pump_task is None:
+            self._pump_task = asyncio.create_task(self._pump())
+
+        self._subscribers += 1
+        position = 0
+
+        try:
+            while True:
+                if position < len(self._chunks):
+                    yield self._chunks[position]
+                    position += 1
+                elif self._done:
+                    if self._error:
+                        raise self._error
+                    return
+                else:
+                    async with self._changed:
+                        await self._changed.wait_for(
+                            lambda: position < len(self._chunks) or self._done)
+        finally:
+            self._subscribers -= 1
+            if not self._subscribers and not self._done:
+                logger.info('All subscribers left, closing the upstream stream')
+                self._pump_task.cancel()
+
+
+class StreamBroadcasts:
+    """Registry of the in-progress broadcasts, one per key"""
+
+    def __init__(self):
+        self._broadcasts: Dict[Hashable, StreamBroadcast] = {}
+
+    def subscribe(self, key: Hashable, stream_factory: Callable[[], AsyncGenerator]):
+        """Subscribe to the in-progress broadcast for this key, starting a new one (with the
+        stream returned by `stream_factory`) if there isn't any.
+
+        Args:
+            key: (Hashable) identifies identical streams.
+            stream_factory: (Callable) returns the upstream stream, only called when needed.
+
+        Returns:
+            AsyncGenerator: the subscriber's stream.
+        """
+        broadcast = self._broadcasts.get(key)
+
+        if broadcast is None or broadcast.done:
+            broadcast = self._broadcasts[key] = StreamBroadcast(stream_factory())
+        else:
+            coalesced_calls.inc(kind='stream')
+
+        return self._subscribe(key, broadcast)
+
+    async def _subscribe(self, key: Hashable, broadcast: StreamBroadcast):
+        stream = broadcast.subscribe()
+
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+            if self._broadcasts.get(key) is broadcast and (
+                    broadcast.done or not broadcast.subscribers):
+                del self._broadcasts[key]
+
+    def __len__(self):
+        return len(self._broadcasts)
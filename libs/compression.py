@@ -0,0 +1,163 @@
+"""Query-aware compression of the retrieved documents, before they're packed into the prompt.
+
+A code snippet is a ~512 char chunk of a file, of which often only a few lines have anything
+to do with the question. Snippets are trimmed down to windows around the lines sharing words
+with the query, and summaries repeated across the snippets of the same file are only kept once.
+"""
+import logging
+import os
+import re
+from typing import List, Set
+
+from libs import metrics
+from libs.models import RAGDocument
+from libs.tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+compression_enabled = os.getenv('COMPRESSION_ENABLED', 'TRUE') == 'TRUE'
+# Lines of context kept around each line matching the query
+compression_window_lines = int(os.getenv('COMPRESSION_WINDOW_LINES', 2))
+# Snippets with fewer lines than this are left alone
+compression_min_lines = int(os.getenv('COMPRESSION_MIN_LINES', 8))
+# Summaries of the same file sharing at least this fraction of their words are duplicates
+compression_summary_overlap = float(os.getenv('COMPRESSION_SUMMARY_OVERLAP', 0.8))
+
+omitted_lines_marker = '...'
+
+context_tokens = metrics.histogram(
+    'context_compression_tokens',
+    'Tokens of the retrieved documents, before and after compression, by stage',
+    buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000))
+
+# Lines opening a definition, kept with the matching lines they enclose
+_signatures = re.compile(
+    r'\s*(?:(?:export|public|private|protected|static|async|pub)\s+)*'
+    r'(?:def|class|function|func|fn|interface|struct)\b')
+_identifiers = re.compile(r'[A-Za-z][A-Za-z0-9]*|[0-9]+')
+_camel_case = re.compile(r'[A-Z]?[a-z0-9]+|[A-Z]+(?![a-z])')
+_stop_words = {
+    'a', 'an', 'the', 'is', 'are', 'was', 'be', 'do', 'does', 'did', 'i', 'you', 'we', 'it',
+    'me', 'my', 'your', 'of', 'in', 'on', 'for', 'to', 'with', 'at', 'by', 'from', 'as', 'and',
+    'or', 'how', 'what', 'why', 'when', 'where', 'which', 'who', 'can', 'could', 'should',
+    'would', 'will', 'this', 'that', 'there', 'any', 'some', 'about', 'into', 'if', 'not',
+    'self', 'none', 'true', 'false', 'return', 'def', 'import',
+}
+
+
+def terms(text: str) -> Set[str]:
+    """Lowercased words of a text, with identifiers split up (`get_db` and `getDb` both give
+    `get` and `db`), minus stop words"""
+    words = set()
+
+    for identifier in _identifiers.findall(text):
+        words.update(part.lower() for part in _camel_case.findall(identifier))
+        words.add(identifier.lower())
+
+    return {word for word in words if len(word) > 1 and word not in _stop_words}
+
+
+def trim_code(code: str, query_terms: Set[str], window: int) -> str:
+    """Keep only the lines sharing words with the query, plus `window` lines around them and
+    the signatures of the definitions (functions, classes, etc) each of them is part of.
+
+    Args:
+        code: (str) the raw code of the snippet.
+        query_terms: (Set[str]) the terms of the query.
+        window: (int) how many lines to keep before and after each matching line.
+
+    Returns:
+        str: the trimmed code, with a marker where lines were left out. The code is returned
+        untouched if no line matches, the reranker found it relevant for some other reason.
+    """
+    lines = code.splitlines()
+    matches = [idx for idx, line in enumerate(lines) if terms(line) & query_terms]
+
+    if not matches:
+        return code
+
+    signatures = [idx for idx, line in enumerate(lines) if _signatures.match(line)]
+
+    keep = set()
+    for idx in matches:
+        keep.update(range(max(0, idx - window), min(len(lines), idx + window + 1)))
+
+        # The definitions above the line which it's indented under, e.g. its method and class
+        indent = _indent(lines[idx])
+        for signature in reversed(signatures):
+            if signature < idx and _indent(lines[signature]) < indent:
+                keep.add(signature)
+                indent = _indent(lines[signature])
+
+    trimmed = []
+    for idx, line in enumerate(lines):
+        if idx in keep:
+            trimmed.append(line)
+        elif not trimmed or trimmed[-1] != omitted_lines_marker:
+            trimmed.append(omitted_lines_marker)
+
+    return '\n'.join(trimmed)
+
+
+def _indent(line: str) -> int:
+    return len(line) - len(line.lstrip())
+
+
+def _is_duplicate(summary_terms: Set[str], seen: List[Set[str]]) -> bool:
+    for other in seen:
+        smallest = min(len(summary_terms), len(other)) or 1
+        if len(summary_terms & other) / smallest >= compression_summary_overlap:
+            return True
+    return False
+
+
+def compress_context(query: str, documents: List[RAGDocument]) -> List[RAGDocument]:
+    """Shrink the documents down to what's relevant for the query.
+
+    Args:
+        query: (str) the (rephrased) search query.
+        documents: (List[RAGDocument]) the reranked documents, best first.
+
+    Returns:
+        A list of compressed copies of the documents, in the same order. Docs left with
+        neither a summary nor code are dropped.
+    """
+    if not compression_enabled:
+        return documents
+
+    query_terms = terms(query)
+    seen_summaries = {}
+    compressed = []
+    tokens_before = tokens_after = 0
+
+    for doc in documents:
+        tokens_before += count_tokens(str(doc))
+        metadata = dict(doc.metadata)
+        summary = doc.page_content
+
+        # Best ranked docs come first, so they get to keep their summary
+        file_summaries = seen_summaries.setdefault(metadata['file_path'], [])
+        summary_terms = terms(summary)
+        if _is_duplicate(summary_terms, file_summaries):
+            summary = ''
+        else:
+            file_summaries.append(summary_terms)
+
+        if metadata['document_type'] == 'code-snippet':
+            code = metadata['original_page_content']
+            if len(code.splitlines()) >= compression_min_lines:
+                metadata['original_page_content'] = trim_code(
+                    code, query_terms, compression_window_lines)
+        elif not summary:
+            continue
+
+        compressed_doc = RAGDocument(page_content=summary, metadata=metadata)
+        tokens_after += count_tokens(str(compressed_doc))
+        compressed.append(compressed_doc)
+
+    context_tokens.observe(tokens_before, stage='before')
+    context_tokens.observe(tokens_after, stage='after')
+    logger.info(f'Compressed context from {tokens_before} to {tokens_after} tokens '
+                f'({len(documents) - len(compressed)} docs dropped)')
+
+    return compressed
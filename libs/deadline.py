@@ -0,0 +1,173 @@
+"""Per-request deadlines, carried through every stage of answering a query.
+
+The /chat/ endpoint starts a Deadline for the request, which is then visible (through a
+context var) to every coroutine and task working on it. Each stage runs under
+`deadline.stage(...)`, which times it out when the request's budget runs out, and records how
+long it took, for the breakdown returned when the deadline is blown (and the per-stage latency
+metrics). Stages that can't be timed out, like cpu bound ones, are only `measure`d.
+"""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Dict, List, TypeVar
+
+from libs import metrics
+
+T = TypeVar('T')
+
+request_deadline = float(os.getenv('REQUEST_DEADLINE', 30))
+# Time kept in reserve for the llm's first token by the stages that can be skipped
+first_token_reserve = float(os.getenv('DEADLINE_FIRST_TOKEN_RESERVE', 5))
+
+_current: ContextVar['Deadline | None'] = ContextVar('deadline', default=None)
+
+stage_latency = metrics.histogram(
+    'stage_latency_seconds', 'Time spent in each stage of answering a query, by stage and repo',
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, stage: str, deadline: 'Deadline'):
+        super().__init__(f'Deadline of {deadline.budget}s exceeded at stage {stage}')
+        self.stage = stage
+        self.deadline = deadline
+
+
+class Deadline:
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + budget
+        self.stages: Dict[str, float] = {}
+        self.skipped: List[str] = []
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    @asynccontextmanager
+    async def stage(self, name: str, reserve: float = 0.0):
+        """Run a stage within the remaining budget.
+
+        Args:
+            name: (str) the name of the stage, for the breakdown.
+            reserve: (float) seconds of the budget the stage must leave for the ones after it.
+
+        Raises:
+            DeadlineExceeded: if the stage had no budget left to begin with, or ran out of it.
+        """
+        budget = self.remaining() - reserve
+        if budget <= 0:
+            self.skipped.append(name)
+            raise DeadlineExceeded(name, self)
+
+        start = time.monotonic()
+        timeout = asyncio.timeout(budget)
+        try:
+            async with timeout:
+                yield
+        except TimeoutError as e:
+            # Only if it's our timeout, not an upstream's
+            if not timeout.expired():
+                raise
+            self.skipped.append(name)
+            raise DeadlineExceeded(name, self) from e
+        finally:
+            self._record(name, time.monotonic() - start)
+
+    @contextmanager
+    def measure(self, name: str):
+        """Record how long a stage took, without timing it out"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._record(name, time.monotonic() - start)
+
+    def mark(self, name: str):
+        """Record the time since the request started as a stage, e.g. the time to first token"""
+        self._record(name, time.monotonic() - self.started_at)
+
+    def merge(self, other: 'Deadline'):
+        """Record the stages of another deadline as this one's, e.g. of a call shared with other
+        requests (see `libs.coalescing.SingleFlight`)"""
+        for name, elapsed in other.stages.items():
+            self._record(name, elapsed)
+        self.skipped.extend(name for name in other.skipped if name not in self.skipped)
+
+    def _record(self, name: str, elapsed: float):
+        # Stages running more than once (or concurrently) add up
+        self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    def server_timing(self) -> str:
+        """The stages' timings as a Server-Timing header value, in milliseconds"""
+        return ', '.join(
+            f'{name};dur={elapsed * 1000:.1f}' for name, elapsed in self.stages.items())
+
+    def breakdown(self) -> dict:
+        return {
+            'budget': self.budget,
+            'elapsed': round(time.monotonic() - self.started_at, 4),
+            'stages': {name: round(elapsed, 4) for name, elapsed in self.stages.items()},
+            'skipped': self.skipped,
+        }
+
+
+def observe(deadline: Deadline, repo: str):
+    """Record the timings of a request's stages in the stage latency metrics"""
+    for name, elapsed in deadline.stages.items():
+        stage_latency.observe(elapsed, stage=name, repo=repo)
+
+
+def start(budget: float = None) -> Deadline:
+    """Start a deadline for the current request (i.e. the current context)"""
+    deadline = Deadline(request_deadline if budget is None else budget)
+    _current.set(deadline)
+    return deadline
+
+
+def current() -> Deadline | None:
+    return _current.get()
+
+
+@asynccontextmanager
+async def stage(name: str, reserve: float = 0.0):
+    """`Deadline.stage` for the current request's deadline, a no-op outside of one"""
+    deadline = current()
+
+    if deadline is None:
+        yield
+        return
+
+    async with deadline.stage(name, reserve):
+        yield
+
+
+@contextmanager
+def measure(name: str):
+    """`Deadline.measure` for the current request's deadline, a no-op outside of one"""
+    deadline = current()
+
+    if deadline is None:
+        yield
+        return
+
+    with deadline.measure(name):
+        yield
+
+
+async def run_stage(name: str, func: Callable[[], Awaitable[T]], reserve: float = 0.0) -> T:
+    """Run a call as a stage of the current request, see `stage`.
+
+    Args:
+        name: (str) the name of the stage.
+        func: (Callable) returns what to await, only called if the stage has budget left, so a
+            skipped stage doesn't leave a coroutine that's never awaited behind.
+        reserve: (float) seconds of the budget the stage must leave for the ones after it.
+
+    Returns:
+        Whatever the call returned.
+    """
+    async with stage(name, reserve):
+        return await func()
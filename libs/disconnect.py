@@ -0,0 +1,126 @@
+"""Stop working on requests whose client went away.
+
+Building the context and streaming the answer both keep going after the client disconnects,
+unless told otherwise: the context pipeline isn't tied to the connection at all, and a
+stream suspended mid-send is never closed. Which means paying for llm tokens nobody reads.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import AsyncGenerator, Awaitable, TypeVar
+
+import anyio
+from fastapi import Request
+from starlette.responses import StreamingResponse
+from starlette.types import Send
+
+from libs import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+cancelled_requests = metrics.counter(
+    'cancelled_requests_total', 'Requests cancelled because the client disconnected, by stage')
+tokens_saved = metrics.counter(
+    'cancelled_tokens_saved_total',
+    'Estimated answer tokens not generated thanks to cancelling, by stage')
+tokens_per_second = metrics.histogram(
+    'stream_tokens_per_second', 'Rate at which answers are streamed back, by repo',
+    buckets=(5, 10, 20, 40, 80, 160, 320))
+
+# Token counts of the latest complete answers, to estimate how long a cancelled one would've been
+_answer_tokens = deque(maxlen=100)
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+def expected_answer_tokens() -> float:
+    return sum(_answer_tokens) / len(_answer_tokens) if _answer_tokens else 0.0
+
+
+async def wait_for_disconnect(request: Request):
+    """Returns once the client disconnects. Only to be used after the request body was read"""
+    while (await request.receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def cancel_on_disconnect(request: Request, awaitable: Awaitable[T]) -> T:
+    """Await something on behalf of a request, cancelling it if the client disconnects first.
+
+    Args:
+        request: (Request) the request.
+        awaitable: (Awaitable) the work to do.
+
+    Raises:
+        ClientDisconnected: if the client disconnected before the work was done.
+
+    Returns:
+        The result of the work.
+    """
+    work = asyncio.ensure_future(awaitable)
+    disconnect = asyncio.create_task(wait_for_disconnect(request))
+
+    try:
+        done, _ = await asyncio.wait({work, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnect.cancel()
+        if not work.done():
+            work.cancel()
+
+    if work not in done:
+        cancelled_requests.inc(stage='context')
+        tokens_saved.inc(expected_answer_tokens(), stage='context')
+        logger.info('Client disconnected, cancelled building the answer')
+        raise ClientDisconnected()
+
+    return work.result()
+
+
+async def track_stream(stream: AsyncGenerator, repo: str) -> AsyncGenerator:
+    """Pass an llm stream through, counting its tokens (and the rate they're streamed at), and
+    close it as soon as it's no longer consumed.
+
+    Each chunk of the stream is one or more events, each carrying (roughly) a single token.
+
+    Args:
+        stream: (AsyncGenerator) the llm stream.
+        repo: (str) the repo the answer is about, to label the tokens/s metric with.
+    """
+    tokens = 0
+    start = time.perf_counter()
+
+    try:
+        async for chunk in stream:
+            tokens += chunk.count('data:')
+            yield chunk
+    except (GeneratorExit, asyncio.CancelledError):
+        cancelled_requests.inc(stage='stream')
+        tokens_saved.inc(max(expected_answer_tokens() - tokens, 0), stage='stream')
+        logger.info(f'Client disconnected after {tokens} tokens, closing the llm stream')
+        raise
+    else:
+        _answer_tokens.append(tokens)
+        if elapsed := time.perf_counter() - start:
+            tokens_per_second.observe(tokens / elapsed, repo=repo)
+    finally:
+        await stream.aclose()
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """A StreamingResponse that closes its body iterator when the client disconnects.
+
+    Starlette only cancels the streaming task, so a body iterator suspended at a `yield` (while
+    the previous chunk was being sent) is left open until it gets garbage collected.
+    """
+
+    async def stream_response(self, send: Send) -> None:
+        try:
+            await super().stream_response(send)
+        finally:
+            # The streaming task is being cancelled, closing the iterator needs shielding
+            with anyio.CancelScope(shield=True):
+                await self.body_iterator.aclose()
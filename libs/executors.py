@@ -0,0 +1,28 @@
+import asyncio
+import functools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+max_workers = int(os.getenv('STORAGE_MAX_WORKERS', 16))
+
+# Shared, bounded pool for the blocking storage clients (chromadb, pymongo), so that a slow
+# query only ties up one of these threads instead of the whole event loop
+storage_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='storage')
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking callable on the storage thread pool and await its result.
+
+    Args:
+        func: (Callable) the blocking function to call.
+        *args: positional args for `func`.
+        **kwargs: keyword args for `func`.
+
+    Returns:
+        Whatever `func` returns.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(storage_executor, functools.partial(func, *args, **kwargs))
@@ -1,17 +1,60 @@
 import logging
+import os
+from typing import Iterable
 
 import httpx
 from httpx import AsyncClient
 
 logger = logging.getLogger(__name__)
 
+pool_limits = httpx.Limits(
+    max_connections=int(os.getenv('HTTP_MAX_CONNECTIONS', 100)),
+    max_keepalive_connections=int(os.getenv('HTTP_MAX_KEEPALIVE_CONNECTIONS', 20)),
+    keepalive_expiry=float(os.getenv('HTTP_KEEPALIVE_EXPIRY', 60)),
+)
+per_host_limits = httpx.Limits(
+    max_connections=int(os.getenv('HTTP_MAX_CONNECTIONS_PER_HOST', 20)),
+    max_keepalive_connections=int(os.getenv('HTTP_MAX_KEEPALIVE_CONNECTIONS_PER_HOST', 10)),
+    keepalive_expiry=float(os.getenv('HTTP_KEEPALIVE_EXPIRY', 60)),
+)
+
 
 class OptimizedAsyncClient(AsyncClient):
-    """Wrapper for httpx.AsyncClient to provide an interface for keeping SSL handshakes warm"""
+    """Wrapper for httpx.AsyncClient to provide an interface for keeping SSL handshakes warm.
+
+    Meant to be long-lived (one per process) so the connection pool, and with it the
+    TLS/HTTP2 sessions, survive across requests. Every host passed in `hosts` gets its own
+    dedicated pool, capped by `host_limits`, while any other host shares the default pool.
+    """
+
+    def __init__(
+            self,
+            *args,
+            hosts: Iterable[str] = (),
+            host_limits: httpx.Limits = per_host_limits,
+            **kwargs):
+        kwargs.setdefault('limits', pool_limits)
+        mounts = kwargs.pop('mounts', {})
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs, http2=True)
+        for url in hosts:
+            host = httpx.URL(url).host
+            mounts[f'all://{host}'] = httpx.AsyncHTTPTransport(http2=True, limits=host_limits)
+
+        super().__init__(*args, **kwargs, mounts=mounts, http2=True)
         self.warmed_up_hosts = set()
+        self.connections_opened = 0
+        self.handshakes_performed = 0
+
+    async def send(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        """Hook into httpcore's tracing so we can count new connections and TLS handshakes"""
+        request.extensions.setdefault('trace', self._trace)
+        return await super().send(request, **kwargs)
+
+    async def _trace(self, event_name: str, _: dict):
+        if event_name == 'connection.connect_tcp.complete':
+            self.connections_opened += 1
+        elif event_name == 'connection.start_tls.complete':
+            self.handshakes_performed += 1
 
     async def warmup_if_needed(self, url, headers):
         host = httpx.URL(url).host
@@ -23,3 +66,28 @@ class OptimizedAsyncClient(AsyncClient):
             return await self.head(url, headers=headers)
         else:
             logger.debug(f'Skipping warmup for host: {host}')
+
+    def pool_stats(self) -> dict:
+        """Snapshot of the connection pools held by this client.
+
+        Returns:
+            A dict with the number of active/idle connections per pool, as well as the totals
+            of connections opened and TLS handshakes performed over the client's lifetime.
+        """
+        pools = {'default': self._transport}
+        pools.update({pattern.pattern: transport for pattern, transport in self._mounts.items()})
+
+        stats = {}
+        for name, transport in pools.items():
+            connections = getattr(getattr(transport, '_pool', None), 'connections', [])
+            stats[name] = {
+                'active': sum(1 for c in connections if not c.is_idle() and not c.is_closed()),
+                'idle': sum(1 for c in connections if c.is_idle()),
+            }
+
+        return {
+            'pools': stats,
+            'connections_opened': self.connections_opened,
+            'handshakes_performed': self.handshakes_performed,
+            'warmed_up_hosts': sorted(self.warmed_up_hosts),
+        }
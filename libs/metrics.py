@@ -0,0 +1,181 @@
+"""Minimal in-process metrics, so we can size caches and pools without attaching a profiler.
+
+Metrics are registered once at module level (e.g. `hits = metrics.counter(...)`) and
+aggregated per label set, with `snapshot()` returning everything recorded so far, and
+`render_prometheus()` the same in the Prometheus text format.
+"""
+import threading
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+_registry: Dict[str, 'Metric'] = {}
+_lock = threading.Lock()
+
+
+def _label_key(labels: dict) -> Tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _label_str(key: Tuple) -> str:
+    return ','.join(f'{name}={value}' for name, value in key) or 'all'
+
+
+def _prometheus_labels(key: Tuple) -> str:
+    if not key:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in key
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class Metric(ABC):
+    kind = ''
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+
+    @abstractmethod
+    def snapshot(self) -> dict:
+        """Everything recorded so far, by label set"""
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        """The metric's samples, in the Prometheus text format"""
+
+    def prometheus(self) -> str:
+        return '\n'.join([
+            f'# HELP {self.name} {self.description}',
+            f'# TYPE {self.name} {self.kind}',
+            *self.samples()
+        ])
+
+
+class _Value(Metric, ABC):
+    """A single value per label set"""
+
+    def __init__(self, name: str, description: str):
+        super().__init__(name, description)
+        self.values = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels):
+        with _lock:
+            self.values[_label_key(labels)] += amount
+
+    def value(self, **labels) -> float:
+        return self.values.get(_label_key(labels), 0)
+
+    def snapshot(self) -> dict:
+        return {_label_str(key): value for key, value in self.values.items()}
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{_prometheus_labels(key)} {value}'
+                for key, value in list(self.values.items())]
+
+
+class Counter(_Value):
+    """A monotonically increasing value, e.g. the number of cache hits. As is the Prometheus
+    convention, counter names end with `_total`."""
+    kind = 'counter'
+
+
+class Gauge(_Value):
+    """A value that goes up and down, e.g. the number of queued requests"""
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        with _lock:
+            self.values[_label_key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """A distribution of observed values, e.g. latencies, bucketed by upper bound"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, buckets: Tuple[float, ...]):
+        super().__init__(name, description)
+        self.buckets = tuple(sorted(buckets))
+        self.counts = defaultdict(lambda: [0] * (len(self.buckets) + 1))
+        self.sums = defaultdict(float)
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+
+        with _lock:
+            counts = self.counts[key]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[idx] += 1
+                    break
+            else:
+                counts[-1] += 1
+
+            self.sums[key] += value
+
+    def snapshot(self) -> dict:
+        snapshot = {}
+
+        for key, counts in self.counts.items():
+            total = sum(counts)
+            snapshot[_label_str(key)] = {
+                'count': total,
+                'sum': round(self.sums[key], 6),
+                'mean': round(self.sums[key] / total, 6) if total else 0.0,
+                'buckets': dict(zip([*map(str, self.buckets), '+Inf'], counts)),
+            }
+
+        return snapshot
+
+    def samples(self) -> List[str]:
+        samples = []
+
+        for key, counts in list(self.counts.items()):
+            # Prometheus buckets are cumulative, ours only count what fell in between bounds
+            cumulative = 0
+            for bound, count in zip([*map(str, self.buckets), '+Inf'], counts):
+                cumulative += count
+                labels = _prometheus_labels((*key, ('le', bound)))
+                samples.append(f'{self.name}_bucket{labels} {cumulative}')
+
+            samples.append(f'{self.name}_sum{_prometheus_labels(key)} {self.sums[key]}')
+            samples.append(f'{self.name}_count{_prometheus_labels(key)} {cumulative}')
+
+        return samples
+
+
+def counter(name: str, description: str) -> Counter:
+    """Get or register a counter"""
+    return _register(Counter, name, description)
+
+
+def gauge(name: str, description: str) -> Gauge:
+    """Get or register a gauge"""
+    return _register(Gauge, name, description)
+
+
+def histogram(name: str, description: str, buckets: Tuple[float, ...]) -> Histogram:
+    """Get or register a histogram"""
+    return _register(Histogram, name, description, buckets=buckets)
+
+
+def snapshot() -> dict:
+    """All the metrics recorded so far, by name"""
+    return {name: metric.snapshot() for name, metric in _registry.items()}
+
+
+def render_prometheus() -> str:
+    """All the metrics recorded so far, in the Prometheus text exposition format"""
+    return '\n'.join(metric.prometheus() for metric in list(_registry.values())) + '\n'
+
+
+def _register(metric_class, name, description, **kwargs):
+    with _lock:
+        if name not in _registry:
+            _registry[name] = metric_class(name, description, **kwargs)
+        return _registry[name]
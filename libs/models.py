@@ -14,6 +14,15 @@ class Repo(BaseModel):
     documents: List
     tree: str
     summary: Dict = {}
+    path: str | None = None  # where it's checked out
+    commit: str | None = None  # the checked out commit sha
+
+
+class RepoChanges(BaseModel):
+    """The files changed between two commits of a repo, by path"""
+    added: List[str] = []
+    modified: List[str] = []
+    deleted: List[str] = []
 
 
 class RepoOwner(BaseModel):
@@ -37,6 +46,7 @@ class RepoCrawlStats(BaseModel):
     description: str | None = None  # this might be None
     owner: RepoOwner
     branch: RepoBranch
+    last_crawled_sha: str | None = None  # the commit the vector db collection was built from
 
 
 class RepoCrawlTarget(BaseModel):
@@ -195,6 +205,12 @@ contextual_code_fmt = """
 {code}
 *** Summary: ***: {summary}"""
 
+# For snippets whose summary was already given for another snippet of the same file
+contextual_code_only_fmt = """
+*** File: *** {path}
+*** Code: *** 
+{code}"""
+
 code_fmt = """```{language}
 {raw_code}
 ```"""
@@ -208,7 +224,8 @@ class RAGDocument(Document):
                 summary=self.page_content,
             )
         elif self.metadata['document_type'] == 'code-snippet':
-            return contextual_code_fmt.format(
+            fmt = contextual_code_fmt if self.page_content else contextual_code_only_fmt
+            return fmt.format(
                 path=self.metadata['file_path'],
                 summary=self.page_content,
                 code=code_fmt.format(
@@ -234,12 +251,54 @@ class LLMResponseChunk(BaseModel):
         return self.choices[0].delta.content
 
 
+class PackedContext(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    documents: List[Any]
+    formatted: str
+    tokens: int
+    dropped: int
+
+
 class RAGPayload(BaseModel):
     model_config = ConfigDict(arbitrary_types_allowed=True)
 
     stream: AsyncGenerator
     context: List[Any]
     formatted: str
+    tokens: int = 0
+    dropped: int = 0
+    # The stages skipped to build the context, e.g. the reranker being unavailable
+    degraded: List[str] = []
+
+
+class CachedAnswer(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    repo: str
+    version: str
+    embedding: Any
+    chunks: List[str]
+    context: List[Any]
+    formatted: str
+    tokens: int = 0
+
+    @property
+    def size_bytes(self):
+        return sum(len(chunk.encode()) for chunk in self.chunks) + len(self.formatted.encode())
+
+
+class RAGContext(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    context: List[Any]
+    formatted: str
+    collection_version: str
+    tokens: int = 0
+    dropped: int = 0
+    degraded: List[str] = []
+    query_embedding: Any = None
+    cached_answer: CachedAnswer | None = None
 
 
 class Rank(BaseModel):
@@ -0,0 +1,235 @@
+"""Sampled request profiling, kept in a bounded ring buffer on disk.
+
+Profiling every request (at a 1ms interval) slows all of them down, and rendering the
+profile on the event loop even more so. Instead, only some requests are profiled:
+    - a random `PROFILING_SAMPLE_RATE` fraction of them.
+    - those asking for it, with a `?profile=1` query param, only honoured for admin requests
+      (see `libs.admin`) and at most `PROFILING_FLAG_PER_MINUTE` times a minute.
+    - those slower than `PROFILING_SLOW_THRESHOLD` seconds, if set. Which means profiling
+      every request, but only keeping the slow ones.
+
+Profiles are rendered and written by a dedicated thread, to `PROFILING_DIR`, keeping only the
+latest `PROFILING_MAX_PROFILES` of them. Note that streaming responses are only profiled up to
+the start of the response, i.e. the first token of an answer.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from fastapi import Request, FastAPI
+from pyinstrument import Profiler
+from pyinstrument.renderers.html import HTMLRenderer
+from pyinstrument.renderers.speedscope import SpeedscopeRenderer
+
+from libs import admin, metrics
+
+logger = logging.getLogger(__name__)
+
+profiling_enabled = os.getenv('PROFILING_ENABLED') == 'TRUE'
+sample_rate = float(os.getenv('PROFILING_SAMPLE_RATE', 0.01))
+# Seconds, 0 disables it (as profiling every request isn't free)
+slow_threshold = float(os.getenv('PROFILING_SLOW_THRESHOLD', 0))
+interval = float(os.getenv('PROFILING_INTERVAL', 0.001))
+profiles_dir = Path(os.getenv('PROFILING_DIR', 'profiles'))
+max_profiles = int(os.getenv('PROFILING_MAX_PROFILES', 50))
+# Profiling at a 1ms interval is expensive, even for admins
+flag_per_minute = int(os.getenv('PROFILING_FLAG_PER_MINUTE', 6))
+
+# We map a profile type to a file extension, as well as a pyinstrument profile renderer
+profile_type_to_ext = {'html': 'html', 'speedscope': 'speedscope.json'}
+profile_type_to_renderer = {'html': HTMLRenderer, 'speedscope': SpeedscopeRenderer}
+
+# e.g. 1718000000000-1234ms-POST-chat.speedscope.json
+_profile_name = re.compile(
+    r'^(?P<created>\d+)-(?P<duration>\d+)ms-(?P<method>[A-Z]+)-(?P<path>[\w.-]*)\.'
+    r'(?P<ext>html|speedscope\.json)$')
+
+# A single thread, so rendering profiles can never starve anything else
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='profiling')
+
+profiles_written = metrics.counter(
+    'profiles_written_total', 'Request profiles kept, by the reason they were taken')
+
+# When the latest forced profiles were taken, to rate limit them
+_flagged_at = deque(maxlen=max(flag_per_minute, 1))
+
+
+def _allow_flag() -> bool:
+    """Whether another forced profile fits in the rate limit, counting it if so"""
+    now = time.monotonic()
+    if flag_per_minute <= 0 or (
+            len(_flagged_at) == flag_per_minute and now - _flagged_at[0] < 60):
+        return False
+    _flagged_at.append(now)
+    return True
+
+
+def _profile_reason(request: Request) -> str | None:
+    """Why the request should be profiled, or None if it shouldn't"""
+    if request.query_params.get('profile') == '1' and admin.is_admin(request) and _allow_flag():
+        return 'flag'
+    if random.random() < sample_rate:
+        return 'sampled'
+    if slow_threshold > 0:
+        return 'slow'
+    return None
+
+
+def save_profile(profiler: Profiler, profile_type: str, name: str):
+    """Render a profile and write it to the ring buffer, evicting the oldest ones. Blocking"""
+    renderer = profile_type_to_renderer[profile_type]()
+    profiles_dir.mkdir(parents=True, exist_ok=True)
+
+    path = profiles_dir / f'{name}.{profile_type_to_ext[profile_type]}'
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+    tmp_path.write_text(profiler.output(renderer=renderer))
+    # Listing never sees a half written profile
+    tmp_path.rename(path)
+
+    # Names start with a timestamp, so sorting them sorts by age
+    names = sorted(p.name for p in profiles_dir.iterdir() if _profile_name.match(p.name))
+    for stale in names[:-max_profiles]:
+        (profiles_dir / stale).unlink(missing_ok=True)
+
+
+def list_profiles() -> List[Dict]:
+    """The profiles in the ring buffer, newest first"""
+    if not profiles_dir.is_dir():
+        return []
+
+    profiles = []
+    for path in profiles_dir.iterdir():
+        if match := _profile_name.match(path.name):
+            profiles.append({
+                'id': path.name,
+                'created': int(match['created']) / 1000,
+                'duration': int(match['duration']) / 1000,
+                'method': match['method'],
+                'path': match['path'],
+                'format': 'speedscope' if match['ext'] == 'speedscope.json' else 'html',
+                'size': path.stat().st_size,
+            })
+
+    return sorted(profiles, key=lambda profile: profile['created'], reverse=True)
+
+
+def profile_path(profile_id: str) -> Path | None:
+    """The path to a profile, or None if there's no such profile"""
+    if not _profile_name.match(profile_id):
+        return None
+    path = profiles_dir / profile_id
+    return path if path.is_file() else None
+
+
+def merge_speedscope(profile_ids: List[str]) -> dict:
+    """Merge several speedscope profiles into a single one, played back to back, so their
+    left heavy (and sandwich) views aggregate all the requests.
+
+    Args:
+        profile_ids: (List[str]) the speedscope profiles to merge.
+
+    Returns:
+        The merged speedscope profile.
+    """
+    frames, frame_ids, events = [], {}, []
+    offset = 0.0
+
+    for profile_id in profile_ids:
+        path = profile_path(profile_id)
+        if path is None or not profile_id.endswith('.speedscope.json'):
+            raise ValueError(f'Not a speedscope profile: {profile_id}')
+
+        data = json.loads(path.read_text())
+        shared_frames = data['shared']['frames']
+
+        for profile in data['profiles']:
+            for event in profile['events']:
+                frame = shared_frames[event['frame']]
+                key = (frame['name'], frame.get('file'), frame.get('line'))
+
+                if key not in frame_ids:
+                    frame_ids[key] = len(frames)
+                    frames.append(frame)
+
+                events.append({
+                    'type': event['type'],
+                    'at': offset + event['at'] - profile['startValue'],
+                    'frame': frame_ids[key],
+                })
+
+            offset += profile['endValue'] - profile['startValue']
+
+    name = f'{len(profile_ids)} merged profiles'
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'activeProfileIndex': 0,
+        'exporter': 'chat-with-repo',
+        'profiles': [{
+            'type': 'evented',
+            'name': name,
+            'unit': 'seconds',
+            'startValue': 0.0,
+            'endValue': offset,
+            'events': events,
+        }],
+        'shared': {'frames': frames},
+    }
+
+
+def _log_failure(future):
+    if future.exception():
+        logger.error('Failed to save a profile', exc_info=future.exception())
+
+
+def register_profiling_middleware(app: FastAPI):
+    @app.middleware("http")
+    async def profile_request(request: Request, call_next: Callable):
+        """Profile the current request, if sampled, see the module's docstring.
+
+        Taken from https://pyinstrument.readthedocs.io/en/latest/guide.html
+        with small improvements.
+
+        Args:
+            request: (Request) FastAPI request.
+            call_next: (Callable) Function to call at the end of the request.
+
+        """
+        reason = _profile_reason(request) if profiling_enabled else None
+
+        if reason is None:
+            # Proceed without profiling
+            return await call_next(request)
+
+        # The default profile format is speedscope
+        profile_type = request.query_params.get('profile_format', 'speedscope')
+        if profile_type not in profile_type_to_ext:
+            profile_type = 'speedscope'
+
+        # We profile the request along with all additional middlewares, by interrupting
+        # the program every `interval` and recording the entire stack at that point
+        start = time.perf_counter()
+        with Profiler(interval=interval, async_mode='enabled') as profiler:
+            response = await call_next(request)
+        duration = time.perf_counter() - start
+
+        if reason == 'slow' and duration < slow_threshold:
+            return response
+
+        path = re.sub(r'[^\w.-]', '-', request.url.path.strip('/'))
+        name = f'{int(time.time() * 1000)}-{int(duration * 1000)}ms-{request.method}-{path}'
+        profiles_written.inc(reason=reason)
+
+        # Rendering takes a while, don't keep the response (or the event loop) waiting on it
+        asyncio.get_running_loop().run_in_executor(
+            _writer, save_profile, profiler, profile_type, name).add_done_callback(_log_failure)
+
+        return response
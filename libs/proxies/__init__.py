@@ -1,4 +1,5 @@
 import logging
+import os
 from typing import AsyncGenerator, Union
 
 import httpx
@@ -12,6 +13,8 @@ from libs.models import ProxyLLMTask
 logger = logging.getLogger(__name__)
 rate_limiter = AsyncLimiter(3, 2)
 timeout = httpx.Timeout(20, read=None)
+# Max wait between two chunks of a stream, so a stalled upstream can't hold it open forever
+stream_timeout = httpx.Timeout(20, read=float(os.getenv('STREAM_READ_TIMEOUT', 30)))
 
 
 class EmptyLLMResponse(Exception):
@@ -109,25 +112,37 @@ async def perform_task(task: ProxyLLMTask, client: OptimizedAsyncClient) -> str:
         return content
 
 
-async def stream_task(task: ProxyLLMTask) -> AsyncGenerator:
+async def stream_task(task: ProxyLLMTask, client: OptimizedAsyncClient) -> AsyncGenerator:
     """Prepare a payload for an llm task, fire it and stream back the response.
 
     Args:
         task: (ProxyLLMTask) the task to issue to the llm.
+        client: (OptimizedAsyncClient) a long-lived client, so the stream reuses a warm connection.
 
     Returns:
         AsyncGenerator: the response stream.
+
+    Raises:
+        httpx.HTTPStatusError: if the llm answers with an error status, before streaming
+            anything back.
     """
     payload = {
         "model": task.model.name,
         "messages": task.prompts.api_format()
     }
 
-    async with httpx.AsyncClient().stream(
+    async with client.stream(
             'POST',
             url=task.model.url,
             json=payload,
             headers=task.model.provider.headers,
-            timeout=timeout) as r:
+            timeout=stream_timeout) as r:
+        # Don't pass an error body off as the answer, it'd get cached and replayed too
+        if r.is_error:
+            await r.aread()
+            logger.error(f'Failed to stream from {task.model.url}, status {r.status_code}: '
+                         f'{r.text}')
+        r.raise_for_status()
+
         async for chunk in r.aiter_text():
             yield chunk
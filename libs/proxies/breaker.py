@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, TypeVar
+
+from libs import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+breaker_transitions = metrics.counter(
+    'circuit_breaker_transitions_total', 'Circuit breaker state changes, by breaker and new state')
+breaker_rejections = metrics.counter(
+    'circuit_breaker_rejections_total', 'Calls rejected by an open circuit breaker, by breaker')
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Stops calling an upstream that keeps failing (or crawling), so requests fail fast
+    instead of piling up behind it.
+
+    Outcomes of the last `window` calls are tracked, a call counting as failed if it raised or
+    took longer than `slow_call`. Once at least `min_calls` were made and the failure rate
+    reaches `failure_rate`, the breaker opens and calls are rejected with CircuitOpen. After
+    `open_for` seconds it goes half-open, letting a single probe call through: if it succeeds
+    the breaker closes again, otherwise it's back to open.
+    """
+    closed, open, half_open = 'closed', 'open', 'half_open'
+
+    def __init__(
+            self,
+            name: str,
+            timeout: float,
+            slow_call: float,
+            failure_rate: float = 0.5,
+            window: int = 20,
+            min_calls: int = 5,
+            open_for: float = 30):
+        self.name = name
+        self.timeout = timeout
+        self.slow_call = slow_call
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.open_for = open_for
+
+        self.state = self.closed
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probing = False
+
+    @classmethod
+    def from_env(cls, name: str, prefix: str, timeout: float, slow_call: float):
+        """Build a breaker configured by `{prefix}_*` env vars, falling back to these defaults"""
+        return cls(
+            name=name,
+            timeout=float(os.getenv(f'{prefix}_TIMEOUT', timeout)),
+            slow_call=float(os.getenv(f'{prefix}_SLOW_CALL', slow_call)),
+            failure_rate=float(os.getenv(f'{prefix}_BREAKER_FAILURE_RATE', 0.5)),
+            window=int(os.getenv(f'{prefix}_BREAKER_WINDOW', 20)),
+            min_calls=int(os.getenv(f'{prefix}_BREAKER_MIN_CALLS', 5)),
+            open_for=float(os.getenv(f'{prefix}_BREAKER_OPEN_FOR', 30)),
+        )
+
+    @property
+    def error_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return sum(not ok for ok in self._outcomes) / len(self._outcomes)
+
+    def _transition(self, state: str):
+        logger.warning(f'Circuit breaker {self.name}: {self.state} -> {state} '
+                       f'(failure rate {self.error_rate:.2f})')
+        self.state = state
+        breaker_transitions.inc(breaker=self.name, state=state)
+
+        if state == self.open:
+            self._opened_at = time.monotonic()
+        elif state == self.closed:
+            self._outcomes.clear()
+
+    def _admit(self) -> bool:
+        """Whether a call may go through, and if so, whether it's the half-open probe"""
+        if self.state == self.open and time.monotonic() - self._opened_at >= self.open_for:
+            self._transition(self.half_open)
+
+        if self.state == self.closed:
+            return False
+
+        if self.state == self.half_open and not self._probing:
+            self._probing = True
+            return True
+
+        breaker_rejections.inc(breaker=self.name)
+        raise CircuitOpen(f'{self.name} circuit breaker is {self.state}')
+
+    def _record(self, ok: bool, probe: bool):
+        if probe:
+            self._probing = False
+            self._transition(self.closed if ok else self.open)
+            return
+
+        self._outcomes.append(ok)
+
+        if self.state == self.closed and len(self._outcomes) >= self.min_calls \
+                and self.error_rate >= self.failure_rate:
+            self._transition(self.open)
+
+    async def call(self, func: Callable[[], Awaitable[T]]) -> T:
+        """Call the upstream through the breaker.
+
+        Args:
+            func: (Callable) returns the coroutine calling the upstream.
+
+        Raises:
+            CircuitOpen: if the breaker is open, the upstream isn't called at all.
+            TimeoutError: if the call took longer than the breaker's timeout.
+
+        Returns:
+            Whatever the call returned.
+        """
+        probe = self._admit()
+        start = time.perf_counter()
+
+        try:
+            async with asyncio.timeout(self.timeout):
+                result = await func()
+        except asyncio.CancelledError:
+            # Not the upstream's fault, but a probe must not leave the breaker stuck half-open
+            if probe:
+                self._probing = False
+            raise
+        except Exception:
+            self._record(False, probe)
+            raise
+
+        self._record(time.perf_counter() - start <= self.slow_call, probe)
+
+        return result
+
+    def stats(self) -> dict:
+        return {
+            'state': self.state,
+            'error_rate': round(self.error_rate, 4),
+            'calls': len(self._outcomes),
+        }
@@ -1,16 +1,24 @@
 import logging
+import os
 from typing import Sequence
 
+from langchain_community.document_transformers import LongContextReorder
 from langchain_core.documents import Document
 
-from libs.models import Model, ProxyLLMTask
+from libs import deadline
+from libs.models import Model, ProxyLLMTask, PackedContext
 from libs.proxies.providers import corcel
+from libs.tokens import count_tokens
 
 logger = logging.getLogger(__name__)
 
 prompt_separator = '\n\n' + '-' * 9 + '\n'
 reader = Model(name='gpt-4o', provider=corcel, endpoint='text/cortext/chat')
 
+long_context_reorder = LongContextReorder()
+# Max tokens of context to put in the prompt, bigger prompts mean slower first tokens
+context_token_budget = int(os.getenv('CONTEXT_TOKEN_BUDGET', 6000))
+
 
 class ChatWithRepo(ProxyLLMTask):
     extra_settings = {
@@ -130,13 +138,50 @@ class ChatWithRepo(ProxyLLMTask):
             {question}"""
 
 
-def format_context(contextual_docs: Sequence[Document]) -> str:
-    """Format the context template to pass to the final llm prompt
+def format_context(
+        contextual_docs: Sequence[Document],
+        token_budget: int = context_token_budget) -> PackedContext:
+    """Pack the contextual docs into the context template to pass to the final llm prompt.
+
+    Docs are taken greedily in the order they come in (best reranker score first), skipping
+    any doc that would go over the token budget. The ones that fit are then reordered for
+    "long context", to mitigate the "lost in the middle" effect.
 
     Args:
-        contextual_docs: (Sequence[Document]) a list of contextually related documents.
+        contextual_docs: (Sequence[Document]) a list of contextually related documents,
+            sorted by relevance.
+        token_budget: (int) max tokens for the whole context.
 
     Returns:
-        str: the context.
+        PackedContext: the docs that made it in, the context and its token count.
     """
-    return prompt_separator.join(str(doc) for doc in contextual_docs)
+    separator_tokens = count_tokens(prompt_separator)
+    packed, tokens = [], 0
+
+    with deadline.measure('pack'):
+        for doc in contextual_docs:
+            doc_tokens = count_tokens(str(doc)) + (separator_tokens if packed else 0)
+
+            if tokens + doc_tokens <= token_budget:
+                packed.append(doc)
+                tokens += doc_tokens
+
+    dropped = len(contextual_docs) - len(packed)
+    if dropped:
+        logger.info(f'Dropped {dropped}/{len(contextual_docs)} docs to fit the context in '
+                    f'{token_budget} tokens')
+
+    with deadline.measure('reorder'):
+        ordered = list(long_context_reorder.transform_documents(packed))
+
+    with deadline.measure('format'):
+        formatted = prompt_separator.join(str(doc) for doc in ordered)
+        # Counted again as a whole, tokens can merge across the doc boundaries
+        formatted_tokens = count_tokens(formatted)
+
+    return PackedContext(
+        documents=ordered,
+        formatted=formatted,
+        tokens=formatted_tokens,
+        dropped=dropped
+    )
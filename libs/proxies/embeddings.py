@@ -1,27 +1,51 @@
 import asyncio
+import hashlib
+import json
 import logging
+import os
 from concurrent.futures import ThreadPoolExecutor
-from typing import List
+from typing import List, Tuple
 
 from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
 
+from libs import admission, metrics
+from libs.caching import LRUCache, normalize_query
 from libs.http import OptimizedAsyncClient
 from libs.models import Model
+from libs.proxies.breaker import CircuitBreaker
+from libs.proxies.hedging import Hedger
 from libs.proxies.providers import hf_embeddings
 
 model = Model(name='', provider=hf_embeddings, endpoint='')
+# Identifies the model behind the endpoint, so swapping models can never serve stale vectors.
+# Override it when deploying a new model behind the same endpoint url.
+model_identity = os.getenv('HF_EMBEDDINGS_MODEL_ID', model.url)
+# Only guards the query embeddings, the crawler can afford to wait for the endpoint
+breaker = CircuitBreaker.from_env('embeddings', 'EMBEDDINGS', timeout=10, slow_call=3)
+hedger = Hedger.from_env('embeddings', 'EMBEDDINGS', model.url)
 
 logger = logging.getLogger(__name__)
 
+cache_lookups = metrics.counter(
+    'query_embedding_cache_lookups_total', 'Query embedding cache lookups, by tier and result')
+batch_sizes = metrics.histogram(
+    'query_embedding_batch_size', 'Number of queries sent per batched embeddings call',
+    buckets=(1, 2, 4, 8, 16, 32, 64))
+batch_fill = metrics.histogram(
+    'query_embedding_batch_fill', 'Batch size as a fraction of the maximum batch size',
+    buckets=(0.1, 0.25, 0.5, 0.75, 1.0))
+
 
 async def generate_embedding(
         documents: List[str],
-        client: OptimizedAsyncClient) -> List[List[float]]:
+        client: OptimizedAsyncClient,
+        url: str | None = None) -> List[List[float]]:
     """Generate one or more embeddings from a list of documents.
 
     Args:
         documents (List[str]): list of documents to compute embeddings for.
         client: (OptimizedAsyncClient): client to use for asynchronous requests.
+        url: (str) the endpoint to use, if not the model's.
 
     Returns:
         A list of embeddings for each document.
@@ -31,7 +55,7 @@ async def generate_embedding(
     }
 
     response = await client.post(
-        url=model.url,
+        url=url or model.url,
         json=payload,
         headers=model.provider.headers)
 
@@ -40,6 +64,181 @@ async def generate_embedding(
     return response.json()
 
 
+async def generate_query_embeddings(
+        queries: List[str],
+        client: OptimizedAsyncClient) -> List[List[float]]:
+    """Generate the embeddings for a list of queries, through the circuit breaker, hedging
+    slow requests if enabled"""
+    async with admission.embeddings.slot():
+        return await breaker.call(lambda: hedger.call(
+            lambda url: generate_embedding(queries, client, url)))
+
+
+class EmbeddingDispatcher:
+    """Micro-batches concurrent query embedding requests into a single endpoint call.
+
+    Requests are collected for up to `max_wait` seconds, or until `max_batch_size` of them are
+    pending, then sent as one batch. The resulting vectors are fanned back out to the waiting
+    callers. A `max_batch_size` of 1 disables batching altogether.
+    """
+
+    def __init__(self, max_wait: float, max_batch_size: int):
+        self.max_wait = max_wait
+        self.max_batch_size = max_batch_size
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._flush_handle = None
+        self._in_flight = set()
+
+    async def embed(self, text: str, client: OptimizedAsyncClient) -> List[float]:
+        """Get the embedding for a single text, as part of the next batch.
+
+        Args:
+            text: (str) the text to embed.
+            client: (OptimizedAsyncClient): client to use for asynchronous requests.
+
+        Returns:
+            The embedding.
+        """
+        if self.max_batch_size <= 1:
+            return (await generate_query_embeddings([text], client))[0]
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush(client)
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_wait, self._flush, client)
+
+        return await future
+
+    def _flush(self, client: OptimizedAsyncClient):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending = self._pending, []
+
+        if batch:
+            task = asyncio.create_task(self._send(batch, client))
+            # Keep a reference around, the event loop only keeps weak ones
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _send(self, batch: List[Tuple[str, asyncio.Future]], client: OptimizedAsyncClient):
+        # Identical queries in the same batch only need to be embedded once
+        texts = list(dict.fromkeys(text for text, _ in batch))
+
+        batch_sizes.observe(len(texts))
+        batch_fill.observe(len(batch) / self.max_batch_size)
+
+        try:
+            vectors = dict(zip(texts, await generate_query_embeddings(texts, client)))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for text, future in batch:
+                # The caller might have been cancelled in the meantime
+                if not future.done():
+                    future.set_result(vectors[text])
+
+
+dispatcher = EmbeddingDispatcher(
+    max_wait=float(os.getenv('EMBEDDINGS_BATCH_MAX_WAIT_MS', 5)) / 1000,
+    max_batch_size=int(os.getenv('EMBEDDINGS_BATCH_MAX_SIZE', 16))
+)
+
+
+class QueryEmbeddingCache:
+    """Cache of normalized query text -> embedding vector.
+
+    The first tier is a bounded in-process LRU. Optionally, a redis connection can be attached
+    as a second, shared tier (see `api.app.lifespan`), which survives restarts and is shared
+    by all the api workers.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.ttl = ttl
+        self.local = LRUCache(max_size=max_size, ttl=ttl)
+        self.redis = None
+
+    @staticmethod
+    def key(query: str) -> str:
+        return f'{model_identity}:{normalize_query(query)}'
+
+    @staticmethod
+    def redis_key(key: str) -> str:
+        return f'query-embedding:{hashlib.sha256(key.encode()).hexdigest()}'
+
+    async def get(self, query: str) -> List[float] | None:
+        key = self.key(query)
+
+        if (embedding := self.local.get(key)) is not None:
+            cache_lookups.inc(tier='local', result='hit')
+            return embedding
+        cache_lookups.inc(tier='local', result='miss')
+
+        if self.redis is not None:
+            try:
+                raw = await self.redis.get(self.redis_key(key))
+            except Exception:
+                logger.warning('Failed to read query embedding from redis', exc_info=True)
+                raw = None
+
+            if raw is not None:
+                cache_lookups.inc(tier='redis', result='hit')
+                embedding = json.loads(raw)
+                self.local.set(key, embedding)
+                return embedding
+            cache_lookups.inc(tier='redis', result='miss')
+
+        return None
+
+    async def set(self, query: str, embedding: List[float]):
+        key = self.key(query)
+        self.local.set(key, embedding)
+
+        if self.redis is not None:
+            try:
+                await self.redis.set(self.redis_key(key), json.dumps(embedding), ex=int(self.ttl))
+            except Exception:
+                logger.warning('Failed to write query embedding to redis', exc_info=True)
+
+    def stats(self) -> dict:
+        stats = self.local.stats()
+        stats['redis'] = self.redis is not None
+
+        return stats
+
+
+query_cache = QueryEmbeddingCache(
+    max_size=int(os.getenv('EMBEDDINGS_CACHE_SIZE', 4096)),
+    ttl=float(os.getenv('EMBEDDINGS_CACHE_TTL', 24 * 60 * 60))
+)
+
+
+async def embed_query(query: str, client: OptimizedAsyncClient) -> List[float]:
+    """Get the embedding for a single search query, going to the endpoint only on cache misses.
+
+    Args:
+        query: (str) the user's search query.
+        client: (OptimizedAsyncClient): client to use for asynchronous requests.
+
+    Returns:
+        The query embedding.
+    """
+    if (embedding := await query_cache.get(query)) is not None:
+        return embedding
+
+    embedding = await dispatcher.embed(query, client)
+    await query_cache.set(query, embedding)
+
+    return embedding
+
+
 # noinspection PyShadowingBuiltins,PyProtocol
 class HFEmbeddingFunc(EmbeddingFunction[Documents]):
     def __init__(self, client: OptimizedAsyncClient):
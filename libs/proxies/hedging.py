@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, TypeVar
+
+import numpy as np
+
+from libs import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+hedges_fired = metrics.counter(
+    'hedged_requests_fired_total', 'Duplicate requests sent to a slow endpoint, by endpoint')
+hedges_won = metrics.counter(
+    'hedged_requests_won_total',
+    'Duplicate requests that answered before the original, by endpoint')
+hedges_skipped = metrics.counter(
+    'hedged_requests_skipped_total', 'Duplicate requests not sent for lack of budget, by endpoint')
+
+
+class Hedger:
+    """Cuts the tail latency of an endpoint by racing a duplicate request against slow ones.
+
+    If a request hasn't returned after the endpoint's rolling p95 latency, the same request is
+    fired again (to `secondary_url`, if set) and whichever succeeds first wins, the other one
+    is cancelled. Duplicates are paid for out of a budget refilled by `budget` for every
+    request, so at most that fraction of extra load is put on the endpoint.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            url: str,
+            secondary_url: str | None = None,
+            enabled: bool = True,
+            budget: float = 0.05,
+            window: int = 200,
+            min_samples: int = 20):
+        self.name = name
+        self.url = url
+        self.secondary_url = secondary_url or url
+        self.enabled = enabled
+        self.budget = budget
+        self.min_samples = min_samples
+
+        self._latencies = deque(maxlen=window)
+        # Start with enough in the bank for a single hedge
+        self._tokens = 1.0
+
+    @classmethod
+    def from_env(cls, name: str, prefix: str, url: str):
+        """Build a hedger configured by `{prefix}_HEDGING*` env vars"""
+        return cls(
+            name=name,
+            url=url,
+            secondary_url=os.getenv(f'{prefix}_HEDGING_URL'),
+            enabled=os.getenv(f'{prefix}_HEDGING') == 'TRUE',
+            budget=float(os.getenv(f'{prefix}_HEDGING_BUDGET', 0.05)),
+            window=int(os.getenv(f'{prefix}_HEDGING_WINDOW', 200)),
+            min_samples=int(os.getenv(f'{prefix}_HEDGING_MIN_SAMPLES', 20)),
+        )
+
+    @property
+    def delay(self) -> float | None:
+        """How long to wait for a request before hedging it, None until there's enough data"""
+        if len(self._latencies) < self.min_samples:
+            return None
+        return float(np.percentile(self._latencies, 95))
+
+    def _take_token(self) -> bool:
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def call(self, func: Callable[[str], Awaitable[T]]) -> T:
+        """Make a request, hedging it if it's slow.
+
+        Args:
+            func: (Callable) given the endpoint url, returns the coroutine making the request.
+
+        Returns:
+            The result of the first request to succeed.
+        """
+        self._tokens = min(self._tokens + self.budget, 1 + self.budget)
+        start = time.perf_counter()
+
+        if not self.enabled or (delay := self.delay) is None:
+            result = await func(self.url)
+            self._latencies.append(time.perf_counter() - start)
+            return result
+
+        primary = asyncio.create_task(func(self.url))
+        tasks = {primary}
+
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+
+            if not done:
+                if self._take_token():
+                    hedges_fired.inc(endpoint=self.name)
+                    tasks.add(asyncio.create_task(func(self.secondary_url)))
+                else:
+                    hedges_skipped.inc(endpoint=self.name)
+
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            hedges_won.inc(endpoint=self.name)
+                        # Slow requests are recorded too, or the p95 would only ever go down
+                        self._latencies.append(time.perf_counter() - start)
+                        return task.result()
+
+                    error = error or task.exception()
+
+            raise error
+
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'delay': self.delay,
+            'budget_tokens': round(self._tokens, 4),
+        }
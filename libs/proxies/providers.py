@@ -26,5 +26,6 @@ corcel = Provider(
         "Content-Type": "application/json",
         "Authorization": f"Bearer {os.environ['CORCEL_API_KEY']}"
     },
-    url='https://api.corcel.io/v1'
+    # Overridable, e.g. to point the api at a stub for load testing
+    url=os.getenv('CORCEL_API_URL', 'https://api.corcel.io/v1')
 )
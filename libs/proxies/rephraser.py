@@ -1,9 +1,139 @@
-from libs.models import ProxyLLMTask, Model
+import logging
+import os
+import re
+from typing import List, NamedTuple
+
+from libs import metrics
+from libs.models import ProxyLLMTask, Model, Message
 from libs.proxies.providers import corcel
 
+logger = logging.getLogger(__name__)
+
 query_rephrase = Model(name='gpt-3.5-turbo', provider=corcel, endpoint='text/cortext/chat')
 chat_message_fmt = '{role}: {content}'
 
+# Local gate deciding if a query with a chat history needs rephrasing at all:
+#   off: always rephrase, shadow: always rephrase but log what the gate would've done,
+#   on: skip the rephrase llm call for queries the gate deems standalone
+rephrase_gate_mode = os.getenv('REPHRASE_GATE', 'shadow')
+# Queries with fewer content words than this aren't trusted to stand on their own
+rephrase_gate_min_words = int(os.getenv('REPHRASE_GATE_MIN_WORDS', 4))
+# Short queries sharing more than this fraction of their words with the previous question
+# are likely a follow up on it
+rephrase_gate_max_overlap = float(os.getenv('REPHRASE_GATE_MAX_OVERLAP', 0.5))
+
+gate_decisions = metrics.counter(
+    'rephrase_gate_decisions_total', 'Rephrase gate decisions, by mode, decision and reason')
+
+_words = re.compile(r"[a-z0-9_]+(?:'[a-z]+)?")
+# File names, paths, snake_case/CamelCase identifiers and `code`, which pin a query down
+_anchors = re.compile(
+    r'`[^`]+`|\b[\w/.-]+\.[a-z]{1,4}\b|\b[a-z0-9]+_[a-z0-9_]+\b|\b[A-Z][a-z0-9]+[A-Z]\w*\b')
+# Words that only make sense given what was said before
+_anaphora = {
+    'it', 'its', "it's", 'this', 'that', 'these', 'those', 'they', 'them', 'their', 'theirs',
+    'he', 'him', 'his', 'she', 'her', 'above', 'previous', 'former', 'latter',
+    'same', 'aforementioned', 'mentioned', 'else', 'instead', 'again', 'also', 'example',
+    'elaborate', 'further',
+}
+_follow_up_openers = (
+    'and ', 'but ', 'so ', 'or ', 'what about', 'how about', 'why not', 'then ', 'more ',
+    'tell me more', 'go on',
+)
+_stop_words = {
+    'a', 'an', 'the', 'is', 'are', 'was', 'were', 'be', 'do', 'does', 'did', 'i', 'you', 'we',
+    'me', 'my', 'your', 'our', 'of', 'in', 'on', 'for', 'to', 'with', 'at', 'by', 'from', 'as',
+    'how', 'what', 'why', 'when', 'where', 'which', 'who', 'can', 'could', 'should', 'would',
+    'will', 'there', 'any', 'some', 'about', 'into', 'up', 'get', 'use', 'used', 'using',
+}
+
+
+class GateDecision(NamedTuple):
+    rephrase: bool
+    reason: str
+
+
+def _content_words(text: str) -> List[str]:
+    return [word for word in _words.findall(text.lower()) if word not in _stop_words]
+
+
+def classify_query(query: str, chat_history: List[Message]) -> GateDecision:
+    """Cheap, local guess at whether a query needs the chat history to make sense.
+
+    Looks for anaphora and follow up phrasing first, then trusts queries that name a file or
+    identifier, or are long enough. What's left is short and unanchored: it's a follow up if
+    it shares enough words with the previous question, otherwise a change of topic.
+
+    Args:
+        query: (str) the user's latest query.
+        chat_history (List[Message]): the chat history.
+
+    Returns:
+        A GateDecision with whether the query needs rephrasing, and why.
+    """
+    lowered = query.strip().lower()
+    words = _words.findall(lowered)
+
+    for opener in _follow_up_openers:
+        if lowered.startswith(opener):
+            return GateDecision(True, 'follow_up')
+
+    for word in words:
+        if word in _anaphora:
+            return GateDecision(True, 'anaphora')
+
+    if _anchors.search(query):
+        return GateDecision(False, 'anchored')
+
+    content_words = _content_words(query)
+    if len(content_words) < 2:
+        return GateDecision(True, 'too_short')
+
+    if len(content_words) >= rephrase_gate_min_words:
+        return GateDecision(False, 'long')
+
+    previous_queries = [message for message in chat_history if message.role == 'user']
+    if not previous_queries:
+        return GateDecision(False, 'no_previous_query')
+
+    previous_words = set(_content_words(previous_queries[-1].content.raw))
+    overlap = len(set(content_words) & previous_words) / len(set(content_words))
+
+    if overlap > rephrase_gate_max_overlap:
+        return GateDecision(True, 'overlaps_previous')
+
+    return GateDecision(False, 'new_topic')
+
+
+def needs_rephrase(query: str, chat_history: List[Message]) -> bool:
+    """Whether to send the query (with its chat history) to be rephrased, as per the
+    REPHRASE_GATE mode. Decisions are logged and counted, so the llm calls saved (and, by
+    comparing the shadow logs with the rephrased queries, the cost in retrieval quality) can
+    be measured.
+
+    Args:
+        query: (str) the user's latest query.
+        chat_history (List[Message]): the chat history, might be an empty list.
+
+    Returns:
+        bool: True if the rephrase llm call is needed.
+    """
+    if not chat_history:
+        return False
+
+    if rephrase_gate_mode == 'off':
+        return True
+
+    decision = classify_query(query, chat_history)
+    gate_decisions.inc(
+        mode=rephrase_gate_mode,
+        decision='rephrase' if decision.rephrase else 'skip',
+        reason=decision.reason)
+    logger.info(f'Rephrase gate ({rephrase_gate_mode}): rephrase={decision.rephrase}, '
+                f'reason={decision.reason}, query="{query}"')
+
+    return decision.rephrase or rephrase_gate_mode != 'on'
+
 
 def strip_response(_, text: str) -> str:
     """Helper func to remove prefix from LLM response"""
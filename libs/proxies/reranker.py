@@ -1,21 +1,38 @@
 from typing import List
 
+from libs import admission
 from libs.http import OptimizedAsyncClient
 from libs.models import Model
+from libs.proxies.breaker import CircuitBreaker
+from libs.proxies.hedging import Hedger
 from libs.proxies.providers import hf_reranker
 
 model = Model(name='reranker', provider=hf_reranker, endpoint='')
+breaker = CircuitBreaker.from_env('reranker', 'RERANKER', timeout=10, slow_call=5)
+hedger = Hedger.from_env('reranker', 'RERANKER', model.url)
 
 
 async def rerank(query: str, documents: List[str], client: OptimizedAsyncClient):
-    """Helper function to create all crawling tasks (one per repo defined in the yaml file)"""
+    """Rerank the documents against the query, through the reranker's circuit breaker, hedging
+    slow requests if enabled.
+
+    Raises:
+        CircuitOpen: if the reranker has been failing, see `breaker`.
+        Overloaded: if there are too many reranking requests in flight already.
+    """
+    async with admission.reranker.slot():
+        return await breaker.call(lambda: hedger.call(
+            lambda url: _rerank(query, documents, client, url)))
+
+
+async def _rerank(query: str, documents: List[str], client: OptimizedAsyncClient, url: str):
     payload = {
         'query': query,
         'documents': documents
     }
 
     response = await client.post(
-        url=model.url,
+        url=url,
         json={'inputs': payload},
         headers=model.provider.headers)
 
@@ -1,19 +1,76 @@
 import asyncio
+import logging
 import os
+import time
 from asyncio import Task
-from typing import List
+from typing import AsyncGenerator, List, Tuple
 
-from langchain_community.document_transformers import LongContextReorder
+import httpx
+import numpy as np
 from langchain_core.documents import Document
 
-from libs import storage, crawl_targets
+from libs import storage, crawl_targets_by_id, blobs, metrics, deadline, admission
+from libs.caching import LRUCache, normalize_query, SemanticAnswerCache, tee_stream, replay_stream
+from libs.candidates import select_candidates, candidate_counts, adaptive_candidates_enabled
+from libs.coalescing import SingleFlight, StreamBroadcasts
+from libs.compression import compress_context
+from libs.deadline import DeadlineExceeded
 from libs.http import OptimizedAsyncClient
-from libs.models import RAGDocument, Message, RAGPayload
+from libs.models import RAGDocument, Message, RAGPayload, CachedAnswer, RAGContext
 from libs.proxies import reranker, embeddings, perform_task, rephraser, stream_task
+from libs.admission import Overloaded
+from libs.proxies.breaker import CircuitOpen
 from libs.proxies.chat import format_context, ChatWithRepo
 
-long_context_reorder = LongContextReorder()
+logger = logging.getLogger(__name__)
+
+# Max candidates sent to the reranker, out of the (over-fetched) sim search results
 sim_search_top_k = int(os.environ['SIM_SEARCH_TOP_K'])
+rerank_min_candidates = int(os.getenv('RERANK_MIN_CANDIDATES', 8))
+sim_search_fetch_k = int(os.getenv('SIM_SEARCH_FETCH_K', 2 * sim_search_top_k)) \
+    if adaptive_candidates_enabled else sim_search_top_k
+
+# Final (reranked and packed) context, keyed by
+# (repo, normalized query, collection version, sim_search_top_k)
+retrieval_cache = LRUCache(
+    max_size=int(os.getenv('RETRIEVAL_CACHE_SIZE', 1024)),
+    ttl=float(os.getenv('RETRIEVAL_CACHE_TTL', 60 * 60))
+)
+
+# Opt-in, replays whole answers for near-duplicate questions (only for requests without history)
+answer_cache_enabled = os.getenv('ANSWER_CACHE_ENABLED') == 'TRUE'
+answer_cache = SemanticAnswerCache(
+    threshold=float(os.getenv('ANSWER_CACHE_THRESHOLD', 0.97)),
+    max_bytes=int(os.getenv('ANSWER_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+)
+
+# Identical concurrent queries share one context pipeline, and optionally one llm stream
+singleflight_enabled = os.getenv('SINGLEFLIGHT_ENABLED', 'TRUE') == 'TRUE'
+singleflight_share_stream = os.getenv('SINGLEFLIGHT_SHARE_STREAM') == 'TRUE'
+context_flights = SingleFlight('context')
+stream_broadcasts = StreamBroadcasts()
+
+# With a chat history, sim search on the raw query while the rephrasing is in flight, and reuse
+# the results if the rephrased query's embedding is within the threshold of the raw one's
+speculative_retrieval_enabled = os.getenv('SPECULATIVE_RETRIEVAL') == 'TRUE'
+speculative_with_last_turn = os.getenv('SPECULATIVE_WITH_LAST_TURN') == 'TRUE'
+speculative_reuse_threshold = float(os.getenv('SPECULATIVE_REUSE_THRESHOLD', 0.9))
+
+context_latency = metrics.histogram(
+    'context_latency_seconds', 'Time to build the rag context, by retrieval mode',
+    buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 16))
+
+
+def evict_stale_retrievals(_: str, stale_version: str):
+    """Drop the cached retrievals and answers computed from a collection that has since been
+    swapped"""
+    evicted = retrieval_cache.evict(lambda key: key[2] == stale_version)
+    evicted_answers = answer_cache.evict_version(stale_version)
+    logger.info(f'Evicted {evicted} cached retrievals and {evicted_answers} cached answers '
+                f'for collection version {stale_version}')
+
+
+storage.collection_cache.add_swap_listener(evict_stale_retrievals)
 
 
 async def context_pipeline(
@@ -24,30 +81,43 @@ async def context_pipeline(
         # todo: refactor these warmup tasks into a sort of warmup controller for all the endpoints
         reranker_warm_up_future: Task = None,
         embeddings_warm_up_task: Task = None,
-) -> List[Document]:
+        candidates: dict = None,
+) -> Tuple[List[Document], bool]:
     """Main logic for building the RAG context.
 
     The pipeline consists of the following steps:
-        1. Perform a similarity search using the query.
-        2. Send documents to reranker.
-        3. Reorder for "long context".
-        4. Format into a {context} str to insert into the prompt.
+        1. Perform a similarity search using the query, over-fetching candidates.
+        2. Select the candidates worth reranking, see `libs.candidates`.
+        3. Send documents to reranker (or, if it's unavailable or there's no time left for it,
+           keep them in sim search order).
+        4. Fetch the raw code for the reranked documents.
+
+    Trimming the documents down to what's relevant for the query is left to
+    `compress_context`, and packing them into the {context} str to insert into the prompt
+    (reordered for "long context") to `format_context`.
 
     Args:
         query: (str) the user's search query.
-        sim_top_k: (int) the top_k for the sim search.
+        sim_top_k: (int) the max number of candidates to send to the reranker.
         client: (httpx.AsyncClient) the httpx client.
         vector_db_future: (Coroutine) the vector db.
         reranker_warm_up_future: (Task) if passed in, will await it.
         embeddings_warm_up_task: (Task) if passed in, will await it.
+        candidates: (dict) if passed in, skip the sim search and rerank these instead.
 
     Returns:
-        A list of RAGDocument objects.
+        A list of RAGDocument objects, sorted by reranker score, and whether the reranker was
+        skipped (the documents are then sorted by distance instead).
     """
     if embeddings_warm_up_task:
         embeddings_warm_up_task.result()
 
-    sim_vectors = await sim_search(query, sim_top_k, vector_db_future, client)
+    if candidates is None:
+        candidates = await sim_search(
+            query, max(sim_search_fetch_k, sim_top_k), vector_db_future, client)
+
+    sim_vectors = select_candidates(
+        candidates, min(rerank_min_candidates, sim_top_k), sim_top_k)
     docs, metas = sim_vectors['documents'][0], sim_vectors['metadatas'][0]
 
     # Perform a doc reranking step, feeding in the similar vectors, returning the result of
@@ -56,22 +126,36 @@ async def context_pipeline(
     if reranker_warm_up_future:
         reranker_warm_up_future.result()
 
-    reranker_response = reranker.rerank(query, docs, client)
+    skipped = False
+    try:
+        # Leave enough time for the llm to answer, a worse context beats no answer at all
+        ranks = await deadline.run_stage(
+            'rerank', lambda: reranker.rerank(query, docs, client),
+            reserve=deadline.first_token_reserve)
+    except (CircuitOpen, Overloaded, DeadlineExceeded, httpx.HTTPError, TimeoutError) as e:
+        # The sim search results are sorted by distance already
+        logger.warning(f'Reranker unavailable ({e!r}), falling back to the sim search order')
+        ranks = [{'corpus_id': idx} for idx in range(len(docs))]
+        skipped = True
 
     ranked_documents = []
     # Ranks are returned in order, which makes this easy
-    for rank in await reranker_response:
+    for rank in ranks:
+        # the `corpus_id` is the document index
+        metadata = metas[rank['corpus_id']]
+        if 'score' in rank:
+            metadata['rerank_score'] = rank['score']
         ranked_documents.append(
             RAGDocument(
-                # the `corpus_id` is the document index
                 page_content=docs[rank['corpus_id']],
-                metadata=metas[rank['corpus_id']]
+                metadata=metadata
             ))
 
-    # Final touches, apply a long context reorder to mitigate the "lost in the middle" effect
-    ordered_documents = long_context_reorder.transform_documents(ranked_documents)
+    # Only the documents that make it this far need their raw code
+    async with deadline.stage('hydrate'):
+        await blobs.hydrate_raw_content(ranked_documents, blobs.get_store())
 
-    return list(ordered_documents)
+    return ranked_documents, skipped
 
 
 async def sim_search(
@@ -90,14 +174,351 @@ async def sim_search(
     Returns:
         Top similar vectors.
     """
-    search_query_embedding = await embeddings.generate_embedding([query], client)
+    async with deadline.stage('embed'):
+        search_query_embedding = [await embeddings.embed_query(query, client)]
+
+    async with deadline.stage('vector_query'):
+        sim_vectors = await storage.query(
+            vector_db.result(),
+            query_embeddings=search_query_embedding,
+            n_results=sim_top_k,
+            include=['documents', 'metadatas', 'distances']
+        )
+
+    return sim_vectors
+
+
+def merge_search_results(results: List[dict], top_k: int) -> dict:
+    """Merge several sim search results into one, keeping the closest distance for documents
+    found more than once.
+
+    Args:
+        results: (List[dict]) the sim search results to merge.
+        top_k: (int) how many documents to keep.
+
+    Returns:
+        A single sim search result, sorted by distance.
+    """
+    best = {}
+
+    for result in results:
+        for idx, document, metadata, distance in zip(
+                result['ids'][0],
+                result['documents'][0],
+                result['metadatas'][0],
+                result['distances'][0]):
+            if idx not in best or distance < best[idx][2]:
+                best[idx] = (document, metadata, distance)
+
+    merged = sorted(best.items(), key=lambda item: item[1][2])[:top_k]
+
+    return {
+        'ids': [[idx for idx, _ in merged]],
+        'documents': [[document for _, (document, _, _) in merged]],
+        'metadatas': [[metadata for _, (_, metadata, _) in merged]],
+        'distances': [[distance for _, (_, _, distance) in merged]],
+    }
+
+
+async def speculative_sim_search(
+        query: str,
+        chat_history: List[Message],
+        sim_top_k: int,
+        vector_db: Task,
+        client: OptimizedAsyncClient) -> dict:
+    """Sim search on the raw query (and optionally the last turn + the query) while the
+    rephrasing is still running, in the hope the rephrased query won't drift too far from it.
+
+    Args:
+        query: (str) the user's raw search query.
+        chat_history (List[Message]): the chat history.
+        sim_top_k: (int) the top_k for the sim search.
+        vector_db: (Task) the vector db.
+        client: (httpx.AsyncClient) the httpx client.
+
+    Returns:
+        The merged sim search results of all the speculative queries, or None if it failed.
+    """
+    speculative_queries = [query]
+
+    if speculative_with_last_turn:
+        speculative_queries.append(f'{chat_history[-1].content.raw}\n{query}')
+
+    try:
+        await vector_db
+        results = await asyncio.gather(*(
+            sim_search(speculative_query, sim_top_k, vector_db, client)
+            for speculative_query in speculative_queries
+        ))
+    except Exception:
+        logger.exception('Speculative sim search failed')
+        return None
+
+    return merge_search_results(results, sim_top_k)
 
-    sim_vectors = vector_db.result().query(
-        query_embeddings=search_query_embedding,
-        n_results=sim_top_k
+
+async def reuse_speculation(
+        query: str,
+        rephrased_query: str,
+        speculation: Task,
+        client: OptimizedAsyncClient) -> dict | None:
+    """Decide if the speculative sim search results can be reused for the rephrased query.
+
+    Returns:
+        The speculative candidates, if the rephrased query is close enough to the raw one,
+        else None (cancelling the speculative search if it's still running).
+    """
+    query_embedding, rephrased_embedding = await asyncio.gather(
+        embeddings.embed_query(query, client),
+        embeddings.embed_query(rephrased_query, client)
     )
+    similarity = cosine_similarity(query_embedding, rephrased_embedding)
 
-    return sim_vectors
+    if similarity >= speculative_reuse_threshold:
+        return await speculation
+
+    logger.info(f'Rephrased query diverged from the raw one (similarity={similarity:.3f}), '
+                f'discarding the speculative sim search')
+    speculation.cancel()
+    return None
+
+
+def cosine_similarity(a: List[float], b: List[float]) -> float:
+    a, b = np.asarray(a), np.asarray(b)
+    return float(a @ b / ((np.linalg.norm(a) * np.linalg.norm(b)) or 1.0))
+
+
+async def rephrase_query(
+        query: str,
+        chat_history: List[Message],
+        client: OptimizedAsyncClient) -> str | None:
+    """Rephrase the query given the chat history, provided there's enough time left for it.
+
+    Returns:
+        The rephrased query, or None if it would've taken up the time (or the llm capacity)
+        needed for the answer.
+    """
+    async def rephrase():
+        async with admission.llm.slot():
+            return await perform_task(
+                rephraser.RephraseGivenHistory(
+                    query=query,
+                    chat_history=chat_history),
+                client=client)
+
+    try:
+        return await deadline.run_stage(
+            'rephrase', rephrase, reserve=deadline.first_token_reserve)
+    except DeadlineExceeded:
+        logger.warning(f'No time left to rephrase the query "{query}", using it as is')
+        return None
+    except Overloaded:
+        logger.warning(f'The llm is saturated, not rephrasing the query "{query}"')
+        return None
+
+
+async def build_context(
+        query: str,
+        subnet: str,
+        chat_history: List[Message],
+        client: OptimizedAsyncClient) -> RAGContext:
+    """Do some query processing first, check if there is any chat history and build the
+    formatted rag context for the query.
+
+    Queries with a chat history are only rephrased if the rephrase gate says so. When they
+    are and speculative retrieval is enabled, the sim search on the raw query runs while the
+    rephrasing is still in flight. Its results are reused if the rephrased query turns out to
+    be close enough to the raw one.
+
+    Args:
+        query (str): the user query.
+        subnet (str): the repo the query is about.
+        chat_history (List[Message]): the chat history, might be an empty list.
+        client: (OptimizedAsyncClient) the client.
+
+    Returns:
+        A RAGContext object with the context, or a previously cached answer.
+    """
+    start = time.perf_counter()
+    # Self-contained queries don't need the history (nor the llm call to fold it in)
+    rephrase = rephraser.needs_rephrase(query, chat_history)
+    mode = 'rephrased' if rephrase else 'direct'
+    speculation = None
+
+    try:
+        try:
+            async with asyncio.TaskGroup() as tg:
+                vector_db_task = tg.create_task(deadline.run_stage(
+                    'get_db',
+                    lambda: storage.get_db(
+                        collection=crawl_targets_by_id[subnet].target_collection,
+                        client=client
+                    )
+                ))
+
+                # Check for a chat history, and if present, rephrase the query given the history.
+                # This step is important to guarantee good simsearch results further down
+                if rephrase:
+                    rephrased_query = tg.create_task(rephrase_query(query, chat_history, client))
+
+                    if speculative_retrieval_enabled:
+                        # Not part of the task group, we don't want to wait for it if unneeded
+                        speculation = asyncio.create_task(speculative_sim_search(
+                            query, chat_history, sim_search_fetch_k, vector_db_task, client))
+
+                # We're going to be using two separate endpoints, so it helps to make sure
+                # they are already 'warmed up' to avoid doing SSL handshake at the last possible
+                # moment
+                reranker_warm_up_task = tg.create_task(deadline.run_stage(
+                    'warmup_reranker',
+                    lambda: client.warmup_if_needed(
+                        reranker.model.url, reranker.model.provider.headers)
+                ))
+
+                embeddings_warm_up_task = tg.create_task(deadline.run_stage(
+                    'warmup_embeddings',
+                    lambda: client.warmup_if_needed(
+                        embeddings.model.url, embeddings.model.provider.headers)
+                ))
+        except ExceptionGroup as group:
+            # Raise the actual failure (e.g. a blown deadline), not the group wrapping it
+            raise group.exceptions[0]
+
+        search_query = rephrased_query.result() if rephrase else None
+        degraded = []
+
+        if search_query:
+            logger.info(f'Rephrased query "{query}" as "{search_query}"')
+        else:
+            if rephrase:
+                degraded.append('rephrase')
+            search_query = query
+
+        collection_version = storage.collection_version(vector_db_task.result())
+        query_embedding = None
+
+        if answer_cache_enabled and not chat_history:
+            # The query embedding gets cached, so the sim search further down won't compute
+            # it again
+            query_embedding = await deadline.run_stage(
+                'embed', lambda: embeddings.embed_query(query, client))
+            cached_answer = answer_cache.lookup(subnet, collection_version, query_embedding)
+
+            if cached_answer:
+                logger.info(f'Replaying cached answer for query "{query}" on {subnet}')
+                return RAGContext(
+                    context=cached_answer.context,
+                    formatted=cached_answer.formatted,
+                    tokens=cached_answer.tokens,
+                    collection_version=collection_version,
+                    cached_answer=cached_answer
+                )
+
+        # The same question on a repo that hasn't been recrawled yields the same context, so
+        # skip the embedding, sim search and reranking altogether
+        cache_key = (
+            subnet,
+            normalize_query(search_query),
+            collection_version,
+            sim_search_top_k
+        )
+        packed = retrieval_cache.get(cache_key)
+
+        if packed is None:
+            candidates = None
+
+            if speculation:
+                candidates = await reuse_speculation(query, search_query, speculation, client)
+                mode = 'speculative_hit' if candidates else 'speculative_miss'
+
+            ranked_documents, skipped_rerank = await context_pipeline(
+                query=search_query,
+                sim_top_k=sim_search_top_k,
+                client=client,
+                vector_db_future=vector_db_task,
+                # todo: below two params should probably be wrapped nicer
+                reranker_warm_up_future=reranker_warm_up_task,
+                embeddings_warm_up_task=embeddings_warm_up_task,
+                candidates=candidates
+            )
+            with deadline.measure('compress'):
+                compressed = compress_context(search_query, ranked_documents)
+            packed = format_context(compressed)
+            candidate_counts.observe(len(packed.documents), stage='kept')
+
+            if skipped_rerank:
+                degraded.append('rerank')
+
+            # A degraded context shouldn't outlive the outage (or the slow request) behind it
+            if not degraded:
+                retrieval_cache.set(cache_key, packed)
+        else:
+            mode = 'cached'
+
+        elapsed = time.perf_counter() - start
+        context_latency.observe(elapsed, mode=mode)
+        logger.info(f'Built context in {elapsed:.2f}s, mode={mode}, {packed.tokens} tokens, '
+                    f'{packed.dropped} docs dropped, degraded={",".join(degraded) or "no"}')
+
+        return RAGContext(
+            context=packed.documents,
+            formatted=packed.formatted,
+            collection_version=collection_version,
+            tokens=packed.tokens,
+            dropped=packed.dropped,
+            degraded=degraded,
+            query_embedding=query_embedding
+        )
+
+    finally:
+        if speculation and not speculation.done():
+            speculation.cancel()
+
+
+def stream_answer(
+        query: str,
+        subnet: str,
+        chat_history: List[Message],
+        rag_context: RAGContext,
+        client: OptimizedAsyncClient) -> AsyncGenerator:
+    """Create the llm prompt based on the rag context and stream back the answer.
+
+    Args:
+        query (str): the user query.
+        subnet (str): the repo the query is about.
+        chat_history (List[Message]): the chat history, might be an empty list.
+        rag_context (RAGContext): the context built for this query.
+        client: (OptimizedAsyncClient) the client.
+
+    Returns:
+        AsyncGenerator: the answer stream.
+    """
+    if rag_context.cached_answer:
+        return replay_stream(rag_context.cached_answer.chunks)
+
+    chat_with_repo_task = ChatWithRepo(
+        question=query,
+        context=rag_context.formatted,
+        github_name=crawl_targets_by_id[subnet].name,
+        repo_name=subnet
+    )
+
+    # The llm slot is held for as long as the answer streams
+    stream = admission.llm.hold(stream_task(chat_with_repo_task, client))
+
+    if answer_cache_enabled and not chat_history and not rag_context.degraded:
+        # Record the answer while it's being streamed to the client
+        stream = tee_stream(stream, lambda chunks: answer_cache.store(CachedAnswer(
+            repo=subnet,
+            version=rag_context.collection_version,
+            embedding=rag_context.query_embedding,
+            chunks=chunks,
+            context=rag_context.context,
+            formatted=rag_context.formatted,
+            tokens=rag_context.tokens
+        )))
+
+    return stream
 
 
 async def answer_query(
@@ -107,6 +528,9 @@ async def answer_query(
     """Do some query processing first, check if there is any chat history, create
     an llm prompt based on the previous facts and send it over to the LLM.
 
+    Identical concurrent queries (same repo, same normalized query, no chat history) share
+    the same context pipeline and, if enabled, the same upstream llm stream.
+
     Args:
         last_message (Message): the last message aka the user query.
         chat_history (List[Message]): the chat history, might be an empty list.
@@ -120,60 +544,34 @@ async def answer_query(
     """
     # todo: Assume all messages are about the same repo
     query, subnet = last_message.content.query, last_message.content.repo
-    assert subnet in crawl_targets, 'Not a valid repo'
+    assert subnet in crawl_targets_by_id, 'Not a valid repo'
 
-    async with asyncio.TaskGroup() as tg:
-        # Check for a chat history, and if present, rephrase the query given the history.
-        # This step is important to guarantee good simsearch results further down
-        if chat_history:
-            rephrased_query = tg.create_task(perform_task(
-                rephraser.RephraseGivenHistory(
-                    query=query,
-                    chat_history=chat_history),
-                client=client))
-
-        # We're going to be using two separate endpoints, so it helps to make sure
-        # they are already 'warmed up' to avoid doing SSL handshake at the last possible moment
-        reranker_warm_up_task = tg.create_task(client.warmup_if_needed(
-            reranker.model.url,
-            reranker.model.provider.headers
-        ))
+    if chat_history or not singleflight_enabled:
+        rag_context = await build_context(query, subnet, chat_history, client)
+        stream = stream_answer(query, subnet, chat_history, rag_context, client)
 
-        embeddings_warm_up_task = tg.create_task(client.warmup_if_needed(
-            embeddings.model.url,
-            embeddings.model.provider.headers
-        ))
-
-        vector_db_task = tg.create_task(
-            storage.get_db(
-                collection=crawl_targets[subnet]['target_collection'],
-                client=client
-            )
+    else:
+        flight_key = (subnet, normalize_query(query))
+        rag_context = await context_flights.do(
+            flight_key,
+            lambda: build_context(query, subnet, chat_history, client)
         )
 
-    context = await context_pipeline(
-        query=query if not chat_history else rephrased_query.result(),
-        sim_top_k=sim_search_top_k,
-        client=client,
-        vector_db_future=vector_db_task,
-        # todo: below two params should probably be wrapped nicer
-        reranker_warm_up_future=reranker_warm_up_task,
-        embeddings_warm_up_task=embeddings_warm_up_task
-    )
-
-    formatted_context = format_context(context)
-
-    chat_with_repo_task = ChatWithRepo(
-        question=query,
-        context=formatted_context,
-        github_name=crawl_targets[subnet]['name'],
-        repo_name=subnet
-    )
+        if singleflight_share_stream:
+            stream = stream_broadcasts.subscribe(
+                flight_key,
+                lambda: stream_answer(query, subnet, chat_history, rag_context, client)
+            )
+        else:
+            stream = stream_answer(query, subnet, chat_history, rag_context, client)
 
     # Hardcode this to stream back the response for now
     return RAGPayload(
-        stream=stream_task(chat_with_repo_task),
-        context=context,
+        stream=stream,
+        context=rag_context.context,
         # todo: Move 'formatted' under 'context'
-        formatted=formatted_context
+        formatted=rag_context.formatted,
+        tokens=rag_context.tokens,
+        dropped=rag_context.dropped,
+        degraded=rag_context.degraded
     )
@@ -16,6 +16,9 @@ logger = logging.getLogger(__name__)
 
 splitters = {}
 contextual_window_snippet_radius = 2
+# Max summaries in flight, for the snippets of a single file, and across the whole crawl
+snippet_summary_concurrency = int(os.getenv('SNIPPET_SUMMARY_CONCURRENCY', 8))
+summary_concurrency = int(os.getenv('SUMMARY_CONCURRENCY', 32))
 vecdb_idx_fmt = "{source}:{index}"
 extra_readme_append_fmt = """
 
@@ -52,7 +55,9 @@ def prepare_splitter(language: Language) -> TextSplitter:
 async def split_document(
         document: Document,
         repo: Repo,
-        client: OptimizedAsyncClient) -> List[Document]:
+        client: OptimizedAsyncClient,
+        summary_slots: asyncio.Semaphore | None = None,
+        snippet_concurrency: int | None = None) -> List[Document]:
     """Most of the heavy lifting associated with splitting and summarizing files and code snippets.
     
     This async func does the following processing steps:
@@ -61,6 +66,7 @@ async def split_document(
     - Summarize the file.
     - Split the file into code chunks.
     - Summarize each code chunk separately, using context like the aforementioned file summary.
+      The chunks are summarized concurrently, at most `snippet_concurrency` at a time.
     - Return the chunks as well as the file summary (merged into a list of Documents).
     
     Note:
@@ -69,20 +75,35 @@ async def split_document(
         which is passed to the embedding function.
         
         When we build the final context for the prompt, we make sure to insert both snippet
-        summaries and raw code.
+        summaries and raw code. The raw code is moved to the blob store before the chunks are
+        inserted into the vector db, see `libs.blobs`.
     
     Args:
         document: (Document) the document to split.
         repo: (Repo) the repo containing the document.
         client: (httpx.AsyncClient) the httpx client.
+        summary_slots: (asyncio.Semaphore) bounds the summaries in flight across files, if
+            passed in.
+        snippet_concurrency: (int) max snippet summaries in flight for this file, defaults to
+            `snippet_summary_concurrency`.
 
     Returns:
         A list of documents (chunks).
     """
     extension = os.path.splitext(document.metadata["source"])[1]
     language = extensions.identify_language(extension)
+    summary_slots = summary_slots or asyncio.Semaphore(summary_concurrency)
+    snippet_slots = asyncio.Semaphore(snippet_concurrency or snippet_summary_concurrency)
 
-    file_summary = perform_task(
+    async def summarize(task):
+        async with summary_slots:
+            return await perform_task(task, client=client)
+
+    async def summarize_snippet(task):
+        async with snippet_slots:
+            return await summarize(task)
+
+    file_summary = summarize(
         summaries.SummarizeFile(
             repo_name=repo.name,
             repo_summary=repo.summary,
@@ -90,8 +111,7 @@ async def split_document(
             file_path=document.metadata['file_path'],
             content=document.page_content,
             language=language
-        ),
-        client=client
+        )
     )
     splitter = prepare_splitter(language=language)
     snippets = splitter.create_documents([document.page_content])
@@ -111,20 +131,33 @@ async def split_document(
         index='summary'
     )
 
-    for idx, snippet in enumerate(snippets):
+    # Every snippet's context is taken from the raw code, before any of them gets swapped for
+    # its summary, so they can all be summarized at once
+    snippet_tasks = [
+        summaries.SummarizeSnippet(
+            repo_name=repo.name,
+            repo_summary=repo.summary,
+            tree=repo.tree,
+            language=language,
+            file_path=document.metadata['file_path'],
+            file_summary=document.page_content,
+            context=wrap_code_snippet_with_neighbours(idx, snippets),
+            content=snippet.page_content)
+        for idx, snippet in enumerate(snippets)
+    ]
+
+    try:
+        async with asyncio.TaskGroup() as tg:
+            snippet_summaries = [
+                tg.create_task(summarize_snippet(task))
+                for task in snippet_tasks
+            ]
+    except ExceptionGroup as group:
+        # Raise the actual failure, not the group wrapping it
+        raise group.exceptions[0]
+
+    for idx, (snippet, snippet_summary) in enumerate(zip(snippets, snippet_summaries)):
         snippet.metadata.update(document.metadata)
-        snippet_summary = perform_task(
-            summaries.SummarizeSnippet(
-                repo_name=repo.name,
-                repo_summary=repo.summary,
-                tree=repo.tree,
-                language=language,
-                file_path=snippet.metadata['file_path'],
-                file_summary=document.page_content,
-                context=wrap_code_snippet_with_neighbours(idx, snippets),
-                content=snippet.page_content),
-            client=client
-        )
         # Store the "raw code" in the metadata, use it when building context
         # but use the summary for sim search
         snippet.metadata['original_page_content'] = snippet.page_content
@@ -133,7 +166,7 @@ async def split_document(
             source=document.metadata['file_path'],
             index=idx
         )
-        snippet.page_content = await snippet_summary
+        snippet.page_content = snippet_summary.result()
 
     # Only add document if we have a summary for it
     if document.page_content:
@@ -148,9 +181,11 @@ async def split_documents(
 ) -> List[Document]:
     """Wrapper function for building a list of coroutines and executing them"""
     chunks = []
+    # Shared by all the files, so a big repo can't fire thousands of summaries at once
+    summary_slots = asyncio.Semaphore(summary_concurrency)
 
     tasks = [
-        split_document(document, repo, client) for document in repo.documents
+        split_document(document, repo, client, summary_slots) for document in repo.documents
     ]
 
     for task in asyncio.as_completed(tasks):
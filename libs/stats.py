@@ -70,7 +70,8 @@ class CrawlStats:
             metadata (RepoCrawlStats): the metadata info for this repo/branch combo.
 
         """
-        metadata = metadata.model_dump()
+        # The crawled commit is only set once its crawl is done, see `update_crawled_commit`
+        metadata = metadata.model_dump(exclude={'last_crawled_sha'})
 
         # todo: might wanna refactor this somehow. not keen on littering with random assignments
         metadata['repo_id'] = repo_id
@@ -85,6 +86,23 @@ class CrawlStats:
             upsert=True
         )
 
+    def update_crawled_commit(self, repo_id, sha):
+        """Save the commit the repo's vector db collection was last built from, for the next
+        crawl to only process the files changed since.
+
+        Args:
+            repo_id (str): The name or identifier of the repository.
+            sha (str): the sha of the crawled commit.
+        """
+        self.collection.update_one(
+            {
+                '_id': repo_id
+            },
+            {
+                '$set': {'last_crawled_sha': sha}
+            }
+        )
+
     def get_repos(self):
         """Get the list of repositories, together will their crawl stats"""
         return [RepoCrawlStats.model_validate(doc) for doc in self.collection.find()]
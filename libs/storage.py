@@ -1,17 +1,156 @@
+import asyncio
+import logging
 import os
+import time
+from collections import defaultdict
+from typing import Callable, List
 
 import chromadb
-from chromadb.api.models import Collection
+from chromadb.api.models.Collection import Collection
 from chromadb.config import Settings
+from chromadb.errors import InvalidCollectionException
 
+from libs import vector_index
+from libs.executors import run_blocking
 from libs.http import OptimizedAsyncClient
 from libs.proxies.embeddings import HFEmbeddingFunc
 
+logger = logging.getLogger(__name__)
+
 vector_db = chromadb.HttpClient(
     host=os.environ['CHROMA_HOST'],
     port=int(os.environ['CHROMA_PORT']),
     settings=Settings(allow_reset=True, anonymized_telemetry=False)
 )
+collection_cache_ttl = float(os.getenv('COLLECTION_CACHE_TTL', 60))
+
+# With 'local', published collections get loaded into an in-process index and queried there,
+# falling back to Chroma while the index for a collection version isn't loaded (yet)
+vector_search_mode = os.getenv('VECTOR_SEARCH_MODE', 'chroma')
+# Collections with more vectors than this get the int8 quantized layout
+local_index_quantize_above = int(os.getenv('LOCAL_INDEX_QUANTIZE_ABOVE', 50_000))
+
+
+def collection_version(collection: Collection) -> str:
+    """The version of a collection. A full crawl publishes a brand-new collection (see
+    `crawler.db.VectorDBCollection`), so the collection id changes, while an incremental one
+    updates the collection in place and bumps its 'revision' metadata instead."""
+    revision = (collection.metadata or {}).get('revision')
+    return f'{collection.id}:{revision}' if revision else str(collection.id)
+
+
+class CollectionCache:
+    """Per-process cache of ChromaDB collection handles, keyed by collection name.
+
+    A cached handle is trusted for `ttl` seconds, after which it gets revalidated against the
+    server. If the crawler has hot-swapped a new collection in the meantime, the version
+    changes, the handle is replaced and the swap listeners get notified.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._handles = {}
+        self._locks = defaultdict(asyncio.Lock)
+        self._swap_listeners: List[Callable[[str, str], None]] = []
+
+    def add_swap_listener(self, listener: Callable[[str, str], None]):
+        """Register a callback, called with (collection name, stale version) whenever a
+        collection is found to be swapped. Use it to drop anything derived from the old one."""
+        self._swap_listeners.append(listener)
+
+    def _get_fresh(self, name: str) -> Collection | None:
+        cached = self._handles.get(name)
+        if cached and time.monotonic() - cached[1] < self.ttl:
+            return cached[0]
+
+    async def get(self, name: str, embedding_function: HFEmbeddingFunc) -> Collection:
+        """Get a collection handle, only going to the server when the cached one expired.
+
+        Args:
+            name: (str) the name of the collection.
+            embedding_function: (HFEmbeddingFunc) the embedding function to bind to the handle.
+
+        Returns:
+            A ChromaDB collection.
+        """
+        if collection := self._get_fresh(name):
+            return collection
+
+        async with self._locks[name]:
+            # Somebody else might have refreshed it while we were waiting for the lock
+            if collection := self._get_fresh(name):
+                return collection
+
+            return await self.refresh(name, embedding_function)
+
+    async def refresh(self, name: str, embedding_function: HFEmbeddingFunc) -> Collection:
+        """Fetch the collection from the server, replacing whatever handle was cached"""
+        collection = await run_blocking(
+            vector_db.get_collection,
+            name=name,
+            embedding_function=embedding_function
+        )
+
+        cached = self._handles.get(name)
+        self._handles[name] = (collection, time.monotonic())
+
+        if cached and collection_version(cached[0]) != collection_version(collection):
+            logger.info(f'Collection {name} was swapped: version {collection_version(cached[0])} '
+                        f'-> {collection_version(collection)}')
+
+            for listener in self._swap_listeners:
+                listener(name, collection_version(cached[0]))
+
+        return collection
+
+
+collection_cache = CollectionCache(ttl=collection_cache_ttl)
+_embedding_function = None
+
+local_indexes = {}
+_local_index_loads = {}
+
+
+async def _load_local_index(collection: Collection):
+    version = collection_version(collection)
+
+    try:
+        count = await run_blocking(collection.count)
+        local_indexes[version] = await run_blocking(
+            vector_index.load_index,
+            collection,
+            quantize=count > local_index_quantize_above
+        )
+    except Exception:
+        logger.exception(f'Failed to load local index for {collection.name}, using Chroma')
+    finally:
+        _local_index_loads.pop(version, None)
+
+
+def ensure_local_index(collection: Collection):
+    """Start loading the local index for this collection version, if it's not already loaded"""
+    version = collection_version(collection)
+
+    if version not in local_indexes and version not in _local_index_loads:
+        _local_index_loads[version] = asyncio.create_task(_load_local_index(collection))
+
+
+def drop_local_index(_: str, stale_version: str):
+    if local_indexes.pop(stale_version, None):
+        logger.info(f'Dropped local index for stale collection version {stale_version}')
+
+
+collection_cache.add_swap_listener(drop_local_index)
+
+
+def get_embedding_function(client: OptimizedAsyncClient) -> HFEmbeddingFunc:
+    """One embedding function (and with it, one worker thread) for the whole process"""
+    global _embedding_function
+
+    if _embedding_function is None:
+        _embedding_function = HFEmbeddingFunc(client)
+
+    return _embedding_function
 
 
 async def get_db(collection, client: OptimizedAsyncClient) -> Collection:
@@ -27,7 +166,42 @@ async def get_db(collection, client: OptimizedAsyncClient) -> Collection:
     Returns:
         A ChromaDB collection.
     """
-    return vector_db.get_collection(
-        name=collection,
-        embedding_function=HFEmbeddingFunc(client)
-    )
+    collection = await collection_cache.get(collection, get_embedding_function(client))
+
+    if vector_search_mode == 'local':
+        ensure_local_index(collection)
+
+    return collection
+
+
+async def query(collection: Collection, **kwargs) -> dict:
+    """Query a ChromaDB collection without blocking the event loop.
+
+    When running in 'local' search mode, and the collection's local index is loaded, the query
+    is answered in-process instead, unless the local index doesn't support it (like a filtered
+    query). Otherwise, if the query fails because the cached handle points to a collection the
+    crawler has since swapped out, refresh the handle and retry once.
+
+    Args:
+        collection: (Collection) the collection to query.
+        **kwargs: passed through to `Collection.query`.
+
+    Returns:
+        The query results.
+    """
+    if index := local_indexes.get(collection_version(collection)):
+        try:
+            return await run_blocking(index.query, **kwargs)
+        except vector_index.UnsupportedQuery as e:
+            logger.warning(f'{e}, querying {collection.name} in Chroma instead')
+
+    try:
+        return await run_blocking(collection.query, **kwargs)
+    except InvalidCollectionException:
+        # Only a missing collection is worth a round trip, not timeouts or an outage
+        fresh = await collection_cache.refresh(collection.name, _embedding_function)
+        if collection_version(fresh) == collection_version(collection):
+            raise
+
+        logger.warning(f'Stale handle for collection {collection.name}, retrying the query')
+        return await run_blocking(fresh.query, **kwargs)
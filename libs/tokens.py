@@ -0,0 +1,38 @@
+import functools
+import logging
+import os
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+# o200k_base is the gpt-4o tokenizer, the model reading the context
+tokenizer_encoding = os.getenv('TOKENIZER_ENCODING', 'o200k_base')
+# Rough chars per token, only used if the tokenizer can't be loaded
+_chars_per_token = 4
+
+
+@functools.cache
+def get_encoding() -> tiktoken.Encoding | None:
+    """The tokenizer, loaded on first use.
+
+    tiktoken downloads its vocabulary on first use (unless it's already in TIKTOKEN_CACHE_DIR,
+    see the api Dockerfile). If that fails, token counts fall back to an estimate rather than
+    failing the request.
+    """
+    try:
+        return tiktoken.get_encoding(tokenizer_encoding)
+    except Exception:
+        logger.exception(f'Could not load the {tokenizer_encoding} tokenizer, '
+                         f'estimating token counts from the text length instead')
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Count the tokens of a text, as the llm would"""
+    encoding = get_encoding()
+
+    if encoding is None:
+        return -(-len(text) // _chars_per_token)
+
+    return len(encoding.encode(text, disallowed_special=()))
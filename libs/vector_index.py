@@ -0,0 +1,159 @@
+import logging
+from typing import List, Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Rows scored per block in the quantized layout, bounds the temporary float32 copies
+_block_size = 4096
+# What a local query can include in its results, also ChromaDB's default
+_includable = ('documents', 'metadatas', 'distances')
+
+
+class UnsupportedQuery(Exception):
+    """Raised for a query the local index can't answer like ChromaDB would, e.g. a filtered one"""
+
+
+class LocalVectorIndex:
+    """In-process, exact nearest neighbour index over a collection's vectors.
+
+    Answers a query with a single vectorized top-k over all the vectors, using the same
+    (squared L2) distance as ChromaDB's default, so results are interchangeable with
+    `Collection.query`. With `quantize=True`, vectors are stored as int8 with a per-vector
+    scale, which takes a quarter of the memory at the cost of slightly approximate distances.
+    """
+
+    def __init__(
+            self,
+            ids: List[str],
+            embeddings: Sequence[Sequence[float]],
+            documents: List[str],
+            metadatas: List[dict],
+            quantize: bool = False):
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1) if ids \
+            else np.zeros((0, 0), dtype=np.float32)
+
+        self.ids = ids
+        self.documents = documents
+        self.metadatas = metadatas
+        self.quantized = quantize
+
+        if quantize:
+            self.scales = np.abs(vectors).max(axis=1, initial=0) / 127
+            self.scales[self.scales == 0] = 1
+            self.codes = np.round(vectors / self.scales[:, None]).astype(np.int8)
+            # Norms of the dequantized vectors, so the distances stay consistent
+            dequantized = self.codes.astype(np.float32) * self.scales[:, None]
+            self.sq_norms = np.einsum('ij,ij->i', dequantized, dequantized)
+            self.vectors = None
+        else:
+            self.vectors = vectors
+            self.sq_norms = np.einsum('ij,ij->i', vectors, vectors)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        if self.quantized:
+            return self.codes.nbytes + self.scales.nbytes + self.sq_norms.nbytes
+        return self.vectors.nbytes + self.sq_norms.nbytes
+
+    def _dot(self, query: np.ndarray) -> np.ndarray:
+        if not self.quantized:
+            return self.vectors @ query
+
+        dots = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), _block_size):
+            block = self.codes[start:start + _block_size].astype(np.float32)
+            dots[start:start + _block_size] = block @ query
+
+        return dots * self.scales
+
+    def query(
+            self,
+            query_embeddings: Sequence[Sequence[float]],
+            n_results: int,
+            include: Sequence[str] = _includable,
+            **kwargs) -> dict:
+        """Find the `n_results` nearest vectors for each query embedding.
+
+        Args:
+            query_embeddings: a list of query embeddings.
+            n_results: (int) the top_k.
+            include: (list) what to include in the results, besides the ids.
+
+        Returns:
+            A dict shaped like the result of `Collection.query`.
+
+        Raises:
+            UnsupportedQuery: for any other argument of `Collection.query` (there's no `where`
+                or `where_document` filtering), or to include the embeddings.
+        """
+        unsupported = sorted(name for name, value in kwargs.items() if value is not None)
+        if unsupported or not set(include) <= set(_includable):
+            raise UnsupportedQuery(
+                f'Unsupported local query, include={list(include)}, arguments={unsupported}')
+
+        results = {'ids': [], 'distances': [], 'documents': [], 'metadatas': []}
+        n_results = min(n_results, len(self))
+
+        for query in np.asarray(query_embeddings, dtype=np.float32):
+            if not n_results:
+                for values in results.values():
+                    values.append([])
+                continue
+
+            distances = self.sq_norms - 2 * self._dot(query) + query @ query
+
+            top_k = np.argpartition(distances, n_results - 1)[:n_results]
+            top_k = top_k[np.argsort(distances[top_k])]
+
+            results['ids'].append([self.ids[idx] for idx in top_k])
+            results['distances'].append(distances[top_k].tolist())
+            results['documents'].append([self.documents[idx] for idx in top_k])
+            # Copies, since the pipeline is free to modify the metadata of its results
+            results['metadatas'].append([dict(self.metadatas[idx]) for idx in top_k])
+
+        # Like ChromaDB, whatever wasn't included is None
+        for field in set(_includable) - set(include):
+            results[field] = None
+
+        return results
+
+
+def load_index(collection, quantize: bool, page_size: int = 1000) -> LocalVectorIndex:
+    """Page through all of a ChromaDB collection's vectors and build a local index from them.
+
+    Args:
+        collection: (Collection) the collection to load.
+        quantize: (bool) whether to use the int8 layout.
+        page_size: (int) how many vectors to fetch per request.
+
+    Returns:
+        A LocalVectorIndex.
+    """
+    ids, embeddings, documents, metadatas = [], [], [], []
+    offset = 0
+
+    while True:
+        page = collection.get(
+            include=['embeddings', 'documents', 'metadatas'],
+            limit=page_size,
+            offset=offset
+        )
+        if not page['ids']:
+            break
+
+        ids.extend(page['ids'])
+        embeddings.extend(page['embeddings'])
+        documents.extend(page['documents'])
+        metadatas.extend(page['metadatas'])
+        offset += len(page['ids'])
+
+    index = LocalVectorIndex(ids, embeddings, documents, metadatas, quantize=quantize)
+    logger.info(f'Loaded local index for {collection.name}: {len(index)} vectors, '
+                f'{index.nbytes / 2 ** 20:.1f}MB, quantized={quantize}')
+
+    return index
@@ -0,0 +1,22 @@
+import os
+import sys
+
+# The libs read their upstreams' settings at import time, none of them get called in the tests
+for name, value in {
+    'HF_API_KEY': 'test',
+    'HF_RERANKER_API': 'http://reranker.test',
+    'HF_EMBEDDINGS_API': 'http://embeddings.test',
+    'CORCEL_API_KEY': 'test',
+    'CHROMA_HOST': 'localhost',
+    'CHROMA_PORT': '8000',
+    'MONGO_HOST': 'localhost',
+    'MONGO_PORT': '27017',
+    'SIM_SEARCH_TOP_K': '35',
+    'GITHUB_API_KEY': 'test',
+    'LOG_LEVEL': 'INFO',
+    'ANONYMIZED_TELEMETRY': 'FALSE',
+}.items():
+    os.environ.setdefault(name, value)
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, root)
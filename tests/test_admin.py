@@ -0,0 +1,67 @@
+import pytest
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+from starlette.requests import Request
+
+from libs import admin, profiling
+
+
+def request(query: str = '', token: str = None) -> Request:
+    headers = [(b'authorization', f'Bearer {token}'.encode())] if token else []
+    return Request({
+        'type': 'http', 'method': 'GET', 'path': '/', 'query_string': query.encode(),
+        'headers': headers,
+    })
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+
+    @app.get('/internal', dependencies=[Depends(admin.require_admin)])
+    async def internal():
+        return {'ok': True}
+
+    return TestClient(app)
+
+
+def test_admin_endpoints_are_hidden_without_a_token_set(client, monkeypatch):
+    monkeypatch.setattr(admin, 'admin_token', None)
+
+    assert client.get('/internal').status_code == 404
+    assert client.get('/internal', headers={'Authorization': 'Bearer '}).status_code == 404
+
+
+def test_admin_endpoints_require_the_token(client, monkeypatch):
+    monkeypatch.setattr(admin, 'admin_token', 'secret')
+
+    assert client.get('/internal').status_code == 401
+    assert client.get('/internal', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    assert client.get('/internal', headers={'Authorization': 'secret'}).status_code == 401
+    assert client.get('/internal', headers={'Authorization': 'Bearer secret'}).json() == {
+        'ok': True}
+
+
+def test_profile_flag_is_ignored_for_non_admins(monkeypatch):
+    monkeypatch.setattr(admin, 'admin_token', 'secret')
+    monkeypatch.setattr(profiling, 'sample_rate', 0)
+    monkeypatch.setattr(profiling, 'slow_threshold', 0)
+
+    assert profiling._profile_reason(request('profile=1')) is None
+    assert profiling._profile_reason(request('profile=1', token='wrong')) is None
+    assert profiling._profile_reason(request('profile=1', token='secret')) == 'flag'
+
+
+def test_forced_profiles_are_rate_limited(monkeypatch):
+    monkeypatch.setattr(admin, 'admin_token', 'secret')
+    monkeypatch.setattr(profiling, 'sample_rate', 0)
+    monkeypatch.setattr(profiling, 'slow_threshold', 0)
+    monkeypatch.setattr(profiling, 'flag_per_minute', 2)
+    monkeypatch.setattr(profiling, '_flagged_at', profiling.deque(maxlen=2))
+
+    reasons = [profiling._profile_reason(request('profile=1', token='secret')) for _ in range(3)]
+    assert reasons == ['flag', 'flag', None]
+
+    # A minute later, there's room for another one
+    profiling._flagged_at[0] -= 60
+    assert profiling._profile_reason(request('profile=1', token='secret')) == 'flag'
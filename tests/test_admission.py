@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+from libs.admission import Bulkhead, Overloaded
+
+
+async def hold(bulkhead: Bulkhead, release: asyncio.Event):
+    async with bulkhead.slot():
+        await release.wait()
+
+
+def test_rejects_when_the_queue_is_full():
+    async def run():
+        bulkhead = Bulkhead('test', max_concurrent=1, max_queue=1, max_wait=1)
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold(bulkhead, release))
+        queued = asyncio.create_task(hold(bulkhead, release))
+        await asyncio.sleep(0)
+
+        with pytest.raises(Overloaded) as rejected:
+            async with bulkhead.slot():
+                pass
+
+        release.set()
+        await asyncio.gather(holder, queued)
+        return rejected.value
+
+    rejected = asyncio.run(run())
+    assert rejected.reason == 'queue_full'
+    assert rejected.retry_after >= 1
+
+
+def test_rejects_after_max_wait():
+    async def run():
+        bulkhead = Bulkhead('test', max_concurrent=1, max_queue=1, max_wait=0.02)
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold(bulkhead, release))
+        await asyncio.sleep(0)
+
+        with pytest.raises(Overloaded) as rejected:
+            async with bulkhead.slot():
+                pass
+
+        release.set()
+        await holder
+        # The timed out waiter left the queue, and the slot is free again
+        async with bulkhead.slot():
+            pass
+        return bulkhead, rejected.value
+
+    bulkhead, rejected = asyncio.run(run())
+    assert rejected.reason == 'max_wait'
+    assert bulkhead.stats()['waiting'] == 0
+
+
+def test_retry_after_goes_by_the_hold_times_and_queue():
+    bulkhead = Bulkhead('test', max_concurrent=2, max_queue=10, max_wait=1)
+    assert bulkhead.retry_after() == 1
+
+    bulkhead._hold_times.extend([3.0, 5.0])
+    bulkhead._waiting = 3
+    # 4s per call, 4 calls ahead over 2 slots
+    assert bulkhead.retry_after() == 8
+
+
+def test_held_stream_releases_its_slot_when_closed_early():
+    closed = []
+
+    async def chunks():
+        try:
+            for idx in range(10):
+                yield idx
+        finally:
+            closed.append(True)
+
+    async def run():
+        bulkhead = Bulkhead('test', max_concurrent=1, max_queue=0, max_wait=0.01)
+        stream = bulkhead.hold(chunks())
+        assert await stream.__anext__() == 0
+
+        # Held for as long as it's streaming
+        with pytest.raises(Overloaded):
+            async with bulkhead.slot():
+                pass
+
+        await stream.aclose()
+        async with bulkhead.slot():
+            pass
+
+    asyncio.run(run())
+    assert closed == [True]
+
+
+def test_held_stream_closes_the_upstream_when_rejected():
+    closed = []
+
+    async def chunks():
+        try:
+            yield 'chunk'
+        finally:
+            closed.append(True)
+
+    async def run():
+        bulkhead = Bulkhead('test', max_concurrent=1, max_queue=0, max_wait=0.01)
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold(bulkhead, release))
+        await asyncio.sleep(0)
+
+        upstream = chunks()
+        await upstream.__anext__()
+        with pytest.raises(Overloaded):
+            async for _ in bulkhead.hold(upstream):
+                pass
+
+        release.set()
+        await holder
+
+    asyncio.run(run())
+    assert closed == [True]
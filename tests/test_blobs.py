@@ -0,0 +1,53 @@
+import os
+import sys
+import uuid
+
+import chromadb
+from langchain_core.documents import Document
+
+from libs.blobs import BlobStore, offload_raw_content
+
+# The crawler runs from its own folder, importing its modules top level
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'crawler'))
+
+import db  # noqa: E402
+
+
+class MemoryStore:
+    def __init__(self):
+        self.blobs = {}
+
+    def put_many(self, contents):
+        keys = [BlobStore.key(content) for content in contents]
+        self.blobs.update(zip(keys, contents))
+        return keys
+
+
+def test_only_the_snippets_code_is_offloaded():
+    store = MemoryStore()
+    summary = Document(page_content='A file', metadata={
+        'document_type': 'file-summary', 'original_page_content': 'the whole file'})
+    snippet = Document(page_content='A snippet', metadata={
+        'document_type': 'code-snippet', 'original_page_content': 'def f(): pass'})
+
+    offload_raw_content([summary, snippet], store)
+
+    assert summary.metadata == {'document_type': 'file-summary'}
+    assert snippet.metadata == {
+        'document_type': 'code-snippet', 'content_hash': BlobStore.key('def f(): pass')}
+    assert list(store.blobs.values()) == ['def f(): pass']
+
+
+def test_blob_keys_of_every_collection(monkeypatch):
+    client = chromadb.EphemeralClient()
+    monkeypatch.setattr(db, 'connect', lambda: client)
+    for name in client.list_collections():
+        client.delete_collection(name.name)
+
+    live = client.create_collection(f'test-{uuid.uuid4().hex}')
+    live.add(ids=['a', 'b', 'c'], embeddings=[[1.0], [2.0], [3.0]], metadatas=[
+        {'content_hash': 'x'}, {'document_type': 'file-summary'}, {'content_hash': 'y'}])
+    temp = client.create_collection(f'test-{uuid.uuid4().hex}.temp')
+    temp.add(ids=['a'], embeddings=[[1.0]], metadatas=[{'content_hash': 'z'}])
+
+    assert db.get_blob_keys(page_size=2) == {'x', 'y', 'z'}
@@ -0,0 +1,136 @@
+import asyncio
+
+import pytest
+
+from libs.proxies.breaker import CircuitBreaker, CircuitOpen
+
+
+def breaker(**kwargs):
+    settings = dict(timeout=1, slow_call=0.5, failure_rate=0.5, window=4, min_calls=4,
+                    open_for=0.05)
+    return CircuitBreaker('test', **{**settings, **kwargs})
+
+
+async def ok():
+    return 'ok'
+
+
+async def fail():
+    raise ValueError('upstream failed')
+
+
+async def trip(circuit: CircuitBreaker):
+    for func in (ok, fail, ok, fail):
+        try:
+            await circuit.call(func)
+        except ValueError:
+            pass
+
+
+def test_opens_at_the_failure_rate_and_rejects_without_calling():
+    calls = 0
+
+    async def counted():
+        nonlocal calls
+        calls += 1
+
+    async def run():
+        circuit = breaker()
+        await trip(circuit)
+        assert circuit.state == CircuitBreaker.open
+
+        with pytest.raises(CircuitOpen):
+            await circuit.call(counted)
+
+    asyncio.run(run())
+    assert calls == 0
+
+
+def test_stays_closed_below_min_calls():
+    async def run():
+        circuit = breaker()
+        for _ in range(3):
+            with pytest.raises(ValueError):
+                await circuit.call(fail)
+        return circuit.state
+
+    assert asyncio.run(run()) == CircuitBreaker.closed
+
+
+def test_slow_calls_count_as_failures():
+    async def slow():
+        await asyncio.sleep(0.02)
+
+    async def run():
+        circuit = breaker(slow_call=0.01)
+        for _ in range(4):
+            await circuit.call(slow)
+        return circuit.state
+
+    assert asyncio.run(run()) == CircuitBreaker.open
+
+
+def test_half_open_lets_a_single_probe_through_and_closes_on_success():
+    async def run():
+        started = asyncio.Event()
+
+        async def probe():
+            started.set()
+            await asyncio.sleep(0.02)
+            return 'probed'
+
+        circuit = breaker()
+        await trip(circuit)
+        await asyncio.sleep(0.06)
+
+        probing = asyncio.create_task(circuit.call(probe))
+        await started.wait()
+        assert circuit.state == CircuitBreaker.half_open
+
+        # Only the probe goes through while half-open
+        with pytest.raises(CircuitOpen):
+            await circuit.call(ok)
+
+        assert await probing == 'probed'
+        assert circuit.state == CircuitBreaker.closed
+        assert await circuit.call(ok) == 'ok'
+
+    asyncio.run(run())
+
+
+def test_failed_probe_opens_the_breaker_again():
+    async def run():
+        circuit = breaker()
+        await trip(circuit)
+        await asyncio.sleep(0.06)
+
+        with pytest.raises(ValueError):
+            await circuit.call(fail)
+        assert circuit.state == CircuitBreaker.open
+
+        with pytest.raises(CircuitOpen):
+            await circuit.call(ok)
+
+    asyncio.run(run())
+
+
+def test_cancelled_probe_doesnt_leave_the_breaker_stuck():
+    async def hang():
+        await asyncio.sleep(10)
+
+    async def run():
+        circuit = breaker()
+        await trip(circuit)
+        await asyncio.sleep(0.06)
+
+        probing = asyncio.create_task(circuit.call(hang))
+        await asyncio.sleep(0)
+        probing.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probing
+
+        # The next call is let through as the probe
+        assert await circuit.call(ok) == 'ok'
+        assert circuit.state == CircuitBreaker.closed
+
+    asyncio.run(run())
@@ -0,0 +1,111 @@
+import asyncio
+
+import httpx
+import pytest
+
+from libs.admission import Bulkhead
+from libs.caching import LRUCache, SemanticAnswerCache, tee_stream
+from libs.models import CachedAnswer
+from libs.proxies import stream_task
+from libs.proxies.chat import ChatWithRepo
+from libs.utils import async_chain
+
+
+def answer(version='v1', embedding=(1.0, 0.0), chunks=('abcd',), repo='repo'):
+    return CachedAnswer(repo=repo, version=version, embedding=list(embedding),
+                        chunks=list(chunks), context=[], formatted='')
+
+
+def test_lru_evicts_the_least_recently_used_past_max_size():
+    cache = LRUCache(max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_answer_cache_evicts_the_least_recently_used_past_max_bytes():
+    cache = SemanticAnswerCache(threshold=0.9, max_bytes=8)
+    cache.store(answer(version='old', chunks=['abcd']))
+    cache.store(answer(version='new', chunks=['efgh']))
+    # Touch the first one, so the second one is the least recently used
+    assert cache.lookup('repo', 'old', [1.0, 0.0])
+
+    cache.store(answer(version='newer', chunks=['ijkl']))
+
+    assert cache.size_bytes == 8
+    assert cache.lookup('repo', 'new', [1.0, 0.0]) is None
+    assert cache.lookup('repo', 'old', [1.0, 0.0])
+    assert cache.lookup('repo', 'newer', [1.0, 0.0])
+
+
+def test_answer_cache_evict_version():
+    cache = SemanticAnswerCache(threshold=0.9, max_bytes=1024)
+    cache.store(answer(version='v1'))
+    cache.store(answer(version='v1', embedding=(0.0, 1.0)))
+    cache.store(answer(version='v2'))
+
+    assert cache.evict_version('v1') == 2
+    assert cache.size_bytes == 4
+    assert cache.lookup('repo', 'v1', [1.0, 0.0]) is None
+    assert cache.lookup('repo', 'v2', [1.0, 0.0])
+
+
+def test_answer_cache_lookup_threshold():
+    cache = SemanticAnswerCache(threshold=0.9, max_bytes=1024)
+    cache.store(answer(embedding=(1.0, 0.0)))
+
+    # cos = 0.8 and 0.995, the stored embedding doesn't have to be normalized either
+    assert cache.lookup('repo', 'v1', [0.8, 0.6]) is None
+    assert cache.lookup('repo', 'v1', [10.0, 1.0])
+    # Same embedding, different repo or collection version
+    assert cache.lookup('other', 'v1', [1.0, 0.0]) is None
+    assert cache.lookup('repo', 'v2', [1.0, 0.0]) is None
+    assert (cache.hits, cache.misses) == (1, 3)
+
+
+def test_llm_error_is_never_cached():
+    def upstream(request):
+        return httpx.Response(429, text='Too many requests')
+
+    task = ChatWithRepo(question='q', context='c', github_name='name', repo_name='repo')
+    completed = []
+
+    async def consume():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(upstream)) as client:
+            async for _ in tee_stream(stream_task(task, client), completed.append):
+                pass
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(consume())
+    assert not completed
+
+
+def test_closing_the_tee_early_releases_the_llm_slot():
+    bulkhead = Bulkhead('test', max_concurrent=1, max_queue=1, max_wait=1)
+    closed = []
+    completed = []
+
+    async def upstream():
+        try:
+            for chunk in ['a', 'b', 'c']:
+                yield chunk
+        finally:
+            closed.append(True)
+
+    async def run():
+        stream = tee_stream(bulkhead.hold(upstream()), completed.append)
+        chain = async_chain(await stream.__anext__(), stream)
+        assert await chain.__anext__() == 'a'
+        assert await chain.__anext__() == 'b'
+        await chain.aclose()
+        return bulkhead._semaphore.locked()
+
+    assert asyncio.run(run()) is False
+    assert closed == [True]
+    assert not completed
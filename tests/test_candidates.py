@@ -0,0 +1,63 @@
+from libs.candidates import collapse_duplicates, cut_point, select_candidates
+
+
+def sim_vectors(*candidates):
+    """A sim search result, from (summary, document type, file path, distance) tuples"""
+    return {
+        'ids': [[f'{idx}' for idx in range(len(candidates))]],
+        'documents': [[summary for summary, _, _, _ in candidates]],
+        'metadatas': [[{'document_type': document_type, 'file_path': file_path}
+                       for _, document_type, file_path, _ in candidates]],
+        'distances': [[distance for _, _, _, distance in candidates]],
+    }
+
+
+def test_cut_at_a_distance_gap():
+    distances = [0.50, 0.51, 0.52, 0.53, 0.54, 0.70, 0.71, 0.72]
+
+    assert cut_point(distances, min_k=2, max_k=8) == 5
+
+
+def test_cut_where_distances_drift_from_the_best():
+    # Evenly spread out, so no gap stands out
+    distances = [0.40 + 0.03 * idx for idx in range(12)]
+
+    # 0.61 is the first more than 50% further than 0.40
+    assert cut_point(distances, min_k=2, max_k=12) == 7
+
+
+def test_cut_within_the_bounds():
+    distances = [0.50, 0.90, 0.91, 0.92, 0.93, 0.94]
+
+    assert cut_point(distances, min_k=3, max_k=6) == 3
+    assert cut_point([0.5] * 10, min_k=2, max_k=4) == 4
+    assert cut_point([0.5, 0.9], min_k=3, max_k=6) == 2
+
+
+def test_collapse_duplicate_summaries_and_covered_files():
+    candidates = sim_vectors(
+        ('Opens the db', 'code-snippet', 'db.py', 0.1),
+        ('Opens  the DB', 'code-snippet', 'other.py', 0.2),
+        ('The db module', 'file-summary', 'db.py', 0.3),
+        ('The api module', 'file-summary', 'api.py', 0.4),
+        ('Serves chat', 'code-snippet', 'api.py', 0.5),
+    )
+
+    # Same summary whatever the file, and a file summary ranking below its own snippet
+    assert collapse_duplicates(candidates) == [0, 3, 4]
+
+
+def test_select_candidates_keeps_the_result_shape():
+    candidates = sim_vectors(
+        ('Opens the db', 'code-snippet', 'db.py', 0.50),
+        ('The db module', 'file-summary', 'db.py', 0.51),
+        ('The api module', 'file-summary', 'api.py', 0.52),
+        ('Serves chat', 'code-snippet', 'api.py', 0.53),
+    )
+
+    selected = select_candidates(candidates, min_k=1, max_k=10)
+
+    assert selected['ids'] == [['0', '2', '3']]
+    assert selected['distances'] == [[0.50, 0.52, 0.53]]
+    assert [metadata['file_path'] for metadata in selected['metadatas'][0]] == [
+        'db.py', 'api.py', 'api.py']
@@ -0,0 +1,164 @@
+import asyncio
+
+import pytest
+
+from libs import deadline
+from libs.coalescing import SingleFlight, StreamBroadcast, StreamBroadcasts
+from libs.deadline import DeadlineExceeded
+
+
+def test_leader_failure_reaches_every_waiter():
+    calls = 0
+
+    async def fail():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        raise ValueError('upstream failed')
+
+    async def run():
+        flight = SingleFlight('test')
+        results = await asyncio.gather(
+            *(flight.do('key', fail) for _ in range(3)), return_exceptions=True)
+        return flight, results
+
+    flight, results = asyncio.run(run())
+
+    assert calls == 1
+    assert all(isinstance(result, ValueError) for result in results)
+    # The failed call isn't kept around, the next caller gets to retry
+    assert len(flight) == 0
+
+
+def test_waiter_going_away_doesnt_cancel_the_call():
+    async def slow():
+        await asyncio.sleep(0.02)
+        return 'done'
+
+    async def run():
+        flight = SingleFlight('test')
+        leader = asyncio.create_task(flight.do('key', slow))
+        waiter = asyncio.create_task(flight.do('key', slow))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await waiter
+
+    assert asyncio.run(run()) == 'done'
+
+
+def test_call_is_cancelled_once_every_caller_left():
+    finished = []
+
+    async def slow():
+        await asyncio.sleep(0.05)
+        finished.append(True)
+
+    async def run():
+        flight = SingleFlight('test')
+        callers = [asyncio.create_task(flight.do('key', slow)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.sleep(0.1)
+        return flight
+
+    flight = asyncio.run(run())
+
+    assert not finished
+    assert len(flight) == 0
+
+
+def test_every_caller_gets_the_stages_of_the_call():
+    async def embed():
+        async with deadline.stage('embed'):
+            await asyncio.sleep(0.02)
+        return 'done'
+
+    async def call(flight, budget):
+        request_deadline = deadline.start(budget)
+        try:
+            return await flight.do('key', embed), request_deadline
+        except DeadlineExceeded:
+            return 'exceeded', request_deadline
+
+    async def run():
+        flight = SingleFlight('test')
+        leader = asyncio.create_task(call(flight, budget=1))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(call(flight, budget=1))
+        # Runs out of budget before the call is done, without taking it down for the others
+        impatient = asyncio.create_task(call(flight, budget=0.005))
+        return await asyncio.gather(leader, follower, impatient)
+
+    (leader, leader_deadline), (follower, follower_deadline), (impatient, impatient_deadline) = \
+        asyncio.run(run())
+
+    assert leader == follower == 'done'
+    assert impatient == 'exceeded'
+    for request_deadline in (leader_deadline, follower_deadline):
+        assert set(request_deadline.stages) == {'embed', 'test_flight'}
+        # Recorded once into each caller's deadline, not into the leader's as it ran
+        assert 0.02 <= request_deadline.stages['embed'] < 0.04
+    assert impatient_deadline.skipped == ['test_flight']
+
+
+async def numbers(count, pulled, delay=0.005):
+    for idx in range(count):
+        await asyncio.sleep(delay)
+        pulled.append(idx)
+        yield idx
+
+
+def test_late_subscriber_replays_the_stream_from_the_start():
+    pulled = []
+
+    async def run():
+        broadcast = StreamBroadcast(numbers(5, pulled))
+        early = broadcast.subscribe()
+        first = [await early.__anext__(), await early.__anext__()]
+
+        late = [chunk async for chunk in broadcast.subscribe()]
+        rest = [chunk async for chunk in early]
+        return first + rest, late
+
+    early, late = asyncio.run(run())
+
+    assert early == late == [0, 1, 2, 3, 4]
+    # The upstream was only pulled once
+    assert pulled == [0, 1, 2, 3, 4]
+
+
+def test_upstream_failure_reaches_every_subscriber():
+    async def failing():
+        yield 'partial'
+        raise ValueError('upstream failed')
+
+    async def consume(stream):
+        chunks = []
+        with pytest.raises(ValueError):
+            async for chunk in stream:
+                chunks.append(chunk)
+        return chunks
+
+    async def run():
+        broadcast = StreamBroadcast(failing())
+        return await asyncio.gather(consume(broadcast.subscribe()), consume(broadcast.subscribe()))
+
+    assert asyncio.run(run()) == [['partial'], ['partial']]
+
+
+def test_upstream_closed_when_every_subscriber_leaves():
+    pulled = []
+
+    async def run():
+        broadcasts = StreamBroadcasts()
+        stream = broadcasts.subscribe('key', lambda: numbers(100, pulled))
+        await stream.__anext__()
+        await stream.aclose()
+        await asyncio.sleep(0.05)
+        return broadcasts
+
+    broadcasts = asyncio.run(run())
+
+    assert len(pulled) < 100
+    assert len(broadcasts) == 0
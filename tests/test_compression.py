@@ -0,0 +1,65 @@
+from libs.compression import compress_context, terms, trim_code
+from libs.models import RAGDocument
+
+code = '''class Storage:
+    def __init__(self, host):
+        self.host = host
+        self.port = 8000
+        self.retries = 3
+        self.timeout = 10
+        self.pool = None
+
+    def get_collection(self, name):
+        client = self.connect()
+        return client.get_collection(name)'''
+
+
+def snippet(summary, code, file_path='storage.py'):
+    return RAGDocument(page_content=summary, metadata={
+        'document_type': 'code-snippet', 'file_path': file_path, 'language': 'python',
+        'original_page_content': code})
+
+
+def test_identifiers_are_split_into_terms():
+    assert terms('get_db() getDb()') == {'get', 'db', 'getdb'}
+    assert 'the' not in terms('the db')
+
+
+def test_trimming_keeps_the_matching_lines_and_their_signatures():
+    trimmed = trim_code(code, terms('client connect'), window=0)
+
+    assert trimmed == '''class Storage:
+...
+    def get_collection(self, name):
+        client = self.connect()
+        return client.get_collection(name)'''
+
+
+def test_trimming_keeps_the_signatures_of_every_enclosing_definition():
+    trimmed = trim_code(code, terms('port'), window=1)
+
+    assert trimmed == '''class Storage:
+    def __init__(self, host):
+        self.host = host
+        self.port = 8000
+        self.retries = 3
+...'''
+
+
+def test_code_matching_nothing_is_left_alone():
+    assert trim_code(code, terms('unrelated words'), window=2) == code
+
+
+def test_duplicate_summaries_of_a_file_are_kept_once():
+    documents = [
+        snippet('Gets a collection from the vector db', code),
+        snippet('Gets the collection from the vector db', code),
+        snippet('Gets a collection from the vector db', code, file_path='other.py'),
+    ]
+
+    compressed = compress_context('get collection', documents)
+
+    assert [doc.page_content for doc in compressed] == [
+        'Gets a collection from the vector db', '', 'Gets a collection from the vector db']
+    # Snippets keep their code even without a summary
+    assert all(doc.metadata['original_page_content'] for doc in compressed)
@@ -0,0 +1,59 @@
+from libs.models import RAGDocument
+from libs.proxies.chat import format_context, prompt_separator
+from libs.tokens import count_tokens
+
+
+def summary(file_path, words):
+    return RAGDocument(
+        page_content=' '.join(f'word{idx}' for idx in range(words)),
+        metadata={'document_type': 'file-summary', 'file_path': file_path})
+
+
+def budget_for(*documents):
+    """Tokens of the docs, packed with separators between them"""
+    return sum(count_tokens(str(doc)) for doc in documents) + \
+        count_tokens(prompt_separator) * (len(documents) - 1)
+
+
+def paths(packed):
+    return sorted(doc.metadata['file_path'] for doc in packed.documents)
+
+
+def test_everything_fits_in_the_budget():
+    documents = [summary(f'{idx}.py', 10) for idx in range(4)]
+
+    packed = format_context(documents, token_budget=budget_for(*documents))
+
+    assert paths(packed) == ['0.py', '1.py', '2.py', '3.py']
+    assert packed.dropped == 0
+    assert packed.tokens == count_tokens(packed.formatted)
+
+
+def test_docs_over_the_budget_are_skipped_for_smaller_ones():
+    best, too_big, small = summary('best.py', 20), summary('big.py', 500), summary('small.py', 5)
+
+    packed = format_context([best, too_big, small], token_budget=budget_for(best, small))
+
+    assert paths(packed) == ['best.py', 'small.py']
+    assert packed.dropped == 1
+    assert 'big.py' not in packed.formatted
+    assert packed.tokens <= budget_for(best, small)
+
+
+def test_nothing_fits_in_the_budget():
+    packed = format_context([summary('a.py', 50), summary('b.py', 50)], token_budget=5)
+
+    assert packed.documents == []
+    assert packed.dropped == 2
+    assert packed.formatted == ''
+
+
+def test_the_best_docs_end_up_at_the_edges():
+    documents = [summary(f'{idx}.py', 10) for idx in range(5)]
+
+    packed = format_context(documents, token_budget=budget_for(*documents))
+
+    ordered = [doc.metadata['file_path'] for doc in packed.documents]
+    # Least relevant in the middle, "lost in the middle" hurts them the least
+    assert ordered[2] == '4.py'
+    assert {ordered[0], ordered[-1]} == {'0.py', '1.py'}
@@ -0,0 +1,48 @@
+import asyncio
+import warnings
+
+import pytest
+
+from libs import deadline
+from libs.deadline import DeadlineExceeded
+
+
+def test_skipped_stage_never_creates_its_coroutine():
+    calls = 0
+
+    async def work():
+        nonlocal calls
+        calls += 1
+
+    async def run():
+        request_deadline = deadline.start(budget=1)
+        with pytest.raises(DeadlineExceeded):
+            await deadline.run_stage('rerank', work, reserve=2)
+        return request_deadline
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        request_deadline = asyncio.run(run())
+
+    assert calls == 0
+    assert request_deadline.skipped == ['rerank']
+
+
+def test_stage_times_out_with_the_remaining_budget():
+    async def run():
+        request_deadline = deadline.start(budget=0.02)
+        with pytest.raises(DeadlineExceeded) as exceeded:
+            await deadline.run_stage('rephrase', lambda: asyncio.sleep(1))
+        return request_deadline, exceeded.value
+
+    request_deadline, exceeded = asyncio.run(run())
+
+    assert exceeded.stage == 'rephrase'
+    assert request_deadline.stages['rephrase'] < 0.5
+
+
+def test_run_stage_outside_of_a_request():
+    async def answer():
+        return 42
+
+    assert asyncio.run(deadline.run_stage('embed', answer)) == 42
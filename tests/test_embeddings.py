@@ -0,0 +1,99 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from libs.proxies import embeddings
+from libs.proxies.breaker import CircuitBreaker
+from libs.proxies.embeddings import EmbeddingDispatcher
+
+
+@pytest.fixture(autouse=True)
+def breaker(monkeypatch):
+    # The module's breaker would carry the failures of one test over to the next
+    monkeypatch.setattr(
+        embeddings, 'breaker', CircuitBreaker.from_env('test', 'TEST', timeout=1, slow_call=1))
+
+
+def upstream(batches, status=200):
+    """An embeddings endpoint embedding each text as its length, recording the batches"""
+    def handler(request):
+        inputs = json.loads(request.content)['inputs']
+        batches.append(inputs)
+        if status != 200:
+            return httpx.Response(status, text='Unavailable')
+        return httpx.Response(200, json=[[float(len(text))] for text in inputs])
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def test_concurrent_callers_share_a_batch():
+    batches = []
+
+    async def run():
+        dispatcher = EmbeddingDispatcher(max_wait=0.01, max_batch_size=8)
+        async with upstream(batches) as client:
+            return await asyncio.gather(
+                *(dispatcher.embed(text, client) for text in ['a', 'bb', 'ccc']))
+
+    assert asyncio.run(run()) == [[1.0], [2.0], [3.0]]
+    assert batches == [['a', 'bb', 'ccc']]
+
+
+def test_duplicate_texts_are_embedded_once():
+    batches = []
+
+    async def run():
+        dispatcher = EmbeddingDispatcher(max_wait=0.01, max_batch_size=8)
+        async with upstream(batches) as client:
+            return await asyncio.gather(
+                *(dispatcher.embed(text, client) for text in ['a', 'bb', 'a']))
+
+    assert asyncio.run(run()) == [[1.0], [2.0], [1.0]]
+    assert batches == [['a', 'bb']]
+
+
+def test_full_batch_is_sent_without_waiting():
+    batches = []
+
+    async def run():
+        # Way past the test's timeout, only a full batch gets sent
+        dispatcher = EmbeddingDispatcher(max_wait=60, max_batch_size=2)
+        async with upstream(batches) as client:
+            return await asyncio.wait_for(asyncio.gather(
+                dispatcher.embed('a', client), dispatcher.embed('bb', client)), timeout=1)
+
+    assert asyncio.run(run()) == [[1.0], [2.0]]
+    assert batches == [['a', 'bb']]
+
+
+def test_partial_batch_is_sent_after_max_wait():
+    batches = []
+
+    async def run():
+        dispatcher = EmbeddingDispatcher(max_wait=0.01, max_batch_size=3)
+        async with upstream(batches) as client:
+            first = await asyncio.gather(
+                dispatcher.embed('a', client), dispatcher.embed('bb', client))
+            second = await dispatcher.embed('ccc', client)
+        return first, second
+
+    assert asyncio.run(run()) == ([[1.0], [2.0]], [3.0])
+    assert batches == [['a', 'bb'], ['ccc']]
+
+
+def test_upstream_error_fails_every_caller():
+    batches = []
+
+    async def run():
+        dispatcher = EmbeddingDispatcher(max_wait=0.01, max_batch_size=8)
+        async with upstream(batches, status=503) as client:
+            return await asyncio.gather(
+                *(dispatcher.embed(text, client) for text in ['a', 'bb', 'a']),
+                return_exceptions=True)
+
+    results = asyncio.run(run())
+
+    assert len(batches) == 1
+    assert all(isinstance(result, httpx.HTTPStatusError) for result in results)
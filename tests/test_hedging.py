@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+from libs.proxies.hedging import Hedger
+
+
+def hedger(delay=0.02, **kwargs):
+    hedge = Hedger('test', url='primary', secondary_url='secondary', min_samples=5, **kwargs)
+    # A p95 of `delay`
+    hedge._latencies.extend([delay] * 5)
+    return hedge
+
+
+def test_hedge_fires_after_the_delay_and_the_loser_is_cancelled():
+    started, cancelled = {}, []
+
+    async def request(url):
+        started[url] = time.perf_counter()
+        try:
+            await asyncio.sleep(1 if url == 'primary' else 0.01)
+        except asyncio.CancelledError:
+            cancelled.append(url)
+            raise
+        return url
+
+    async def run():
+        start = time.perf_counter()
+        result = await hedger(delay=0.02).call(request)
+        # Let the cancellation go through
+        await asyncio.sleep(0.01)
+        return start, result
+
+    start, result = asyncio.run(run())
+
+    assert result == 'secondary'
+    assert started['secondary'] - start >= 0.02
+    assert cancelled == ['primary']
+
+
+def test_no_hedge_when_the_request_is_fast():
+    urls = []
+
+    async def request(url):
+        urls.append(url)
+        return url
+
+    assert asyncio.run(hedger(delay=0.05).call(request)) == 'primary'
+    assert urls == ['primary']
+
+
+def test_no_hedge_without_budget():
+    urls = []
+
+    async def request(url):
+        urls.append(url)
+        await asyncio.sleep(0.03 if url == 'primary' else 0.001)
+        return url
+
+    async def run():
+        hedge = hedger(delay=0.01, budget=0.0)
+        first = await hedge.call(request)
+        # The starting token was spent on the first hedge
+        second = await hedge.call(request)
+        return first, second
+
+    assert asyncio.run(run()) == ('secondary', 'primary')
+    assert urls == ['primary', 'secondary', 'primary']
+
+
+def test_failed_hedge_falls_back_to_the_primary():
+    async def request(url):
+        if url == 'secondary':
+            raise ValueError('secondary failed')
+        await asyncio.sleep(0.03)
+        return url
+
+    assert asyncio.run(hedger(delay=0.01).call(request)) == 'primary'
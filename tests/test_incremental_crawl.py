@@ -0,0 +1,209 @@
+import asyncio
+import os
+import sys
+import uuid
+
+import chromadb
+import pytest
+from chromadb import EmbeddingFunction
+from langchain_core.documents import Document
+
+git = pytest.importorskip('git')
+pytest.importorskip('directory_tree')
+
+# The crawler runs from its own folder, importing its modules top level
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'crawler'))
+
+import main  # noqa: E402
+from libs.models import Repo, RepoChanges  # noqa: E402
+from repository import diff_since  # noqa: E402
+
+readme = '\n'.join(f'Line {i} of what the repo does, see docs/setup.md' for i in range(20))
+
+
+class GitRepo:
+    """A throwaway git repo, to commit files to"""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.repo = git.Repo.init(self.path)
+        self.repo.config_writer().set_value('user', 'name', 'test').release()
+        self.repo.config_writer().set_value('user', 'email', 'test@test').release()
+
+    def commit(self, files=None, deleted=(), moved=None) -> str:
+        for file_path, content in (files or {}).items():
+            os.makedirs(os.path.dirname(os.path.join(self.path, file_path)), exist_ok=True)
+            mode = 'wb' if isinstance(content, bytes) else 'w'
+            with open(os.path.join(self.path, file_path), mode) as f:
+                f.write(content)
+            self.repo.index.add([file_path])
+
+        for old_path, new_path in (moved or {}).items():
+            self.repo.git.mv(old_path, new_path)
+
+        if deleted:
+            self.repo.index.remove(list(deleted), working_tree=True)
+
+        return self.repo.index.commit('change').hexsha
+
+    def as_repo(self) -> Repo:
+        return Repo(name='repo', branch='main', url='https://github.com/test/repo', documents=[],
+                    tree='', path=self.path, commit=self.repo.head.commit.hexsha)
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    monkeypatch.delenv('FORCE_CRAWL', raising=False)
+    monkeypatch.setattr(main, 'incremental_crawl', True)
+    return GitRepo(tmp_path)
+
+
+def test_diff_since_parses_every_kind_of_change(repo):
+    base = repo.commit({
+        'changed.py': 'a = 1\n', 'gone.py': 'b = 1\n', 'old name.py': 'c = 1\n'
+    })
+    repo.commit(
+        {'changed.py': 'a = 2\n', 'tab\tand ünïcode.py': 'd = 1\n'},
+        deleted=['gone.py'],
+        moved={'old name.py': 'new name.py'},
+    )
+
+    changes = diff_since(repo.path, base)
+
+    assert sorted(changes.added) == ['new name.py', 'tab\tand ünïcode.py']
+    assert changes.modified == ['changed.py']
+    assert sorted(changes.deleted) == ['gone.py', 'old name.py']
+
+
+def test_diff_since_a_missing_commit(repo):
+    repo.commit({'a.py': 'a = 1\n'})
+
+    assert diff_since(repo.path, '0' * 40) is None
+
+
+def test_small_changes_crawl_incrementally(repo):
+    base = repo.commit({'README.md': readme, **{f'{i}.py': f'x = {i}\n' for i in range(10)}})
+    repo.commit({'0.py': 'x = 10\n', 'README.md': readme + '\nOne more line'})
+
+    changes = main.plan_incremental_crawl(repo.as_repo(), base)
+
+    assert changes == RepoChanges(modified=['0.py', 'README.md'])
+
+
+def test_rewritten_readme_crawls_everything(repo):
+    base = repo.commit({'README.md': readme, 'a.py': 'a = 1\n'})
+    repo.commit({'README.md': 'Something else entirely'})
+
+    assert main.plan_incremental_crawl(repo.as_repo(), base) is None
+
+
+def test_rewritten_referenced_markdown_crawls_everything(repo):
+    base = repo.commit({'README.md': readme, 'docs/setup.md': 'Setup ' * 200, 'a.py': ''})
+    repo.commit({'docs/setup.md': 'Something else entirely'})
+
+    assert main.plan_incremental_crawl(repo.as_repo(), base) is None
+
+
+def test_rewritten_unreferenced_markdown_crawls_incrementally(repo):
+    base = repo.commit({'README.md': readme, 'docs/notes.md': 'Notes ' * 200, 'a.py': ''})
+    repo.commit({'docs/notes.md': 'Something else entirely'})
+
+    changes = main.plan_incremental_crawl(repo.as_repo(), base)
+
+    assert changes == RepoChanges(modified=['docs/notes.md'])
+
+
+def test_large_tree_change_crawls_everything(repo):
+    base = repo.commit({'README.md': readme, **{f'{i}.py': '' for i in range(9)}})
+    repo.commit({f'new_{i}.py': '' for i in range(3)})
+
+    assert main.plan_incremental_crawl(repo.as_repo(), base) is None
+
+
+def test_tree_change_counts_binaries_on_both_sides(repo):
+    # Only 2 files get loaded as documents, but the tree has 10
+    base = repo.commit({
+        'README.md': readme, 'a.py': '', **{f'{i}.png': bytes([i, 0, 255]) for i in range(8)}
+    })
+    repo.commit({'new.png': b'\0\1\2'})
+
+    changes = main.plan_incremental_crawl(repo.as_repo(), base)
+
+    assert changes == RepoChanges(added=['new.png'])
+
+
+class LengthEmbeddings(EmbeddingFunction):
+    def __call__(self, input):
+        return [[float(len(text)), 1.0] for text in input]
+
+
+def chunks_of(file_path: str, snippets: int):
+    return [
+        Document(
+            page_content=f'{file_path} {index}',
+            metadata={'vecdb_idx': f'{file_path}:{index}'},
+        )
+        for index in ['summary', *range(snippets)]
+    ]
+
+
+@pytest.fixture
+def collection():
+    collection = chromadb.EphemeralClient().create_collection(
+        name=f'test-{uuid.uuid4().hex}',
+        embedding_function=LengthEmbeddings(),
+        metadata={'revision': 'old', 'repo_summary': 'The stored summary'},
+    )
+    chunks = chunks_of('shrunk.py', 3) + chunks_of('gone.py', 1) + chunks_of('same.py', 1)
+    collection.add(
+        documents=[chunk.page_content for chunk in chunks],
+        ids=[chunk.metadata['vecdb_idx'] for chunk in chunks],
+    )
+    return collection
+
+
+@pytest.fixture
+def crawled(monkeypatch):
+    crawled = []
+
+    async def split_documents(repo, client):
+        crawled.append((repo.summary, [doc.metadata['file_path'] for doc in repo.documents]))
+        return chunks_of('shrunk.py', 1)
+
+    async def summarize_repo(repo, client):
+        raise AssertionError('The stored repo summary should be reused')
+
+    monkeypatch.setattr(main.splitting, 'split_documents', split_documents)
+    monkeypatch.setattr(main, 'summarize_repo', summarize_repo)
+    monkeypatch.setattr(main.blobs, 'get_store', lambda: None)
+    monkeypatch.setattr(main.blobs, 'offload_raw_content', lambda chunks, store: None)
+    return crawled
+
+
+def test_update_collection_drops_leftover_chunks(collection, crawled):
+    repo = Repo(
+        name='repo', branch='main', url='https://github.com/test/repo', tree='', commit='new',
+        documents=[
+            Document(page_content='', metadata={'file_path': file_path})
+            for file_path in ['shrunk.py', 'same.py']
+        ])
+    changes = RepoChanges(modified=['shrunk.py'], deleted=['gone.py'])
+
+    asyncio.run(main.update_collection(collection, repo, changes, client=None))
+
+    assert crawled == [('The stored summary', ['shrunk.py'])]
+    assert sorted(collection.get()['ids']) == [
+        'same.py:0', 'same.py:summary', 'shrunk.py:0', 'shrunk.py:summary']
+    assert collection.metadata == {'revision': 'new', 'repo_summary': 'The stored summary'}
+
+
+def test_update_collection_without_chunk_changes_keeps_the_revision(collection, crawled):
+    repo = Repo(name='repo', branch='main', url='https://github.com/test/repo', tree='',
+                commit='new', documents=[])
+    changes = RepoChanges(modified=['logo.png'])
+
+    asyncio.run(main.update_collection(collection, repo, changes, client=None))
+
+    assert crawled == []
+    assert collection.count() == 8
+    assert collection.metadata['revision'] == 'old'
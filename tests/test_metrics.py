@@ -0,0 +1,46 @@
+import pytest
+
+from libs.metrics import Counter, Gauge, Histogram, Metric
+
+
+def test_metric_kinds_must_implement_their_samples():
+    with pytest.raises(TypeError):
+        Metric('test', 'A metric of no kind')
+
+
+def test_counter_in_the_prometheus_format():
+    counter = Counter('test_requests_total', 'Requests, by stage')
+    counter.inc(stage='embed')
+    counter.inc(2, stage='embed')
+
+    assert counter.value(stage='embed') == 3
+    assert counter.snapshot() == {'stage=embed': 3}
+    assert counter.prometheus() == '\n'.join([
+        '# HELP test_requests_total Requests, by stage',
+        '# TYPE test_requests_total counter',
+        'test_requests_total{stage="embed"} 3.0',
+    ])
+
+
+def test_gauge_goes_up_and_down():
+    gauge = Gauge('test_in_flight', 'Calls in flight')
+    gauge.inc(3)
+    gauge.dec()
+
+    assert gauge.value() == 2
+    gauge.set(5)
+    assert gauge.samples() == ['test_in_flight 5']
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram('test_latency_seconds', 'Latency', buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value)
+
+    assert histogram.samples() == [
+        'test_latency_seconds_bucket{le="0.1"} 1',
+        'test_latency_seconds_bucket{le="1"} 2',
+        'test_latency_seconds_bucket{le="+Inf"} 3',
+        'test_latency_seconds_sum 5.55',
+        'test_latency_seconds_count 3',
+    ]
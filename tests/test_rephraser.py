@@ -0,0 +1,51 @@
+import pytest
+
+from libs.models import ChatAnswer, ChatQuery, Message
+from libs.proxies import rephraser
+from libs.proxies.rephraser import classify_query, needs_rephrase
+
+history = [
+    Message(role='user', content=ChatQuery(query='How are documents split into chunks?',
+                                           repo='repo')),
+    Message(role='assistant', content=ChatAnswer(answer='With langchain splitters.',
+                                                 repo='repo')),
+]
+
+
+@pytest.mark.parametrize('query, reason', [
+    ('And for markdown files?', 'follow_up'),
+    ('What about the crawler?', 'follow_up'),
+    ('Why does it need a semaphore?', 'anaphora'),
+    ('Show me an example', 'anaphora'),
+    ('Chunks?', 'too_short'),
+    ('Documents split how?', 'overlaps_previous'),
+])
+def test_follow_ups_get_rephrased(query, reason):
+    assert classify_query(query, history) == (True, reason)
+
+
+@pytest.mark.parametrize('query, reason', [
+    ('What does splitting.py do?', 'anchored'),
+    ('Where is `expand_root_readme` called?', 'anchored'),
+    ('How is OptimizedAsyncClient configured?', 'anchored'),
+    ('How does the crawler store raw code blobs', 'long'),
+    ('Explain redis caching', 'new_topic'),
+])
+def test_standalone_queries_skip_the_rephrase(query, reason):
+    assert classify_query(query, history) == (False, reason)
+
+
+def test_short_queries_without_a_previous_question_stand_alone():
+    answer_only = [history[1]]
+
+    assert classify_query('Explain redis caching', answer_only) == (False, 'no_previous_query')
+
+
+@pytest.mark.parametrize('mode, rephrased', [('off', True), ('shadow', True), ('on', False)])
+def test_gate_modes(monkeypatch, mode, rephrased):
+    monkeypatch.setattr(rephraser, 'rephrase_gate_mode', mode)
+
+    assert needs_rephrase('What does splitting.py do?', history) is rephrased
+    # Follow ups always get rephrased, and queries without a history never do
+    assert needs_rephrase('And for markdown files?', history) is True
+    assert needs_rephrase('And for markdown files?', []) is False
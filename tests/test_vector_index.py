@@ -0,0 +1,30 @@
+import pytest
+
+from libs.vector_index import LocalVectorIndex, UnsupportedQuery
+
+
+@pytest.fixture
+def index():
+    return LocalVectorIndex(
+        ids=['a', 'b'],
+        embeddings=[[0.0, 1.0], [1.0, 0.0]],
+        documents=['doc a', 'doc b'],
+        metadatas=[{'file_path': 'a.py'}, {'file_path': 'b.py'}])
+
+
+def test_query_only_includes_what_was_asked_for(index):
+    results = index.query([[1.0, 0.0]], n_results=1, include=['documents'])
+
+    assert results['ids'] == [['b']]
+    assert results['documents'] == [['doc b']]
+    assert results['metadatas'] is None and results['distances'] is None
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'where': {'file_path': 'a.py'}},
+    {'where_document': {'$contains': 'a'}},
+    {'include': ['documents', 'embeddings']},
+])
+def test_unsupported_queries_raise_instead_of_ignoring_arguments(index, kwargs):
+    with pytest.raises(UnsupportedQuery):
+        index.query([[1.0, 0.0]], n_results=1, **kwargs)